@@ -103,12 +103,9 @@ class BruteForceExperimentAnalysis:
         top_k_input = 10
         top_k_out = 3  # how many of the most likely output to show
 
-        test_data = self.results.test_data
-        test_patch_data = self.results.test_patch_data
-
         topk_most_adversarial = torch.topk(metrics, k=top_k_input, sorted=True)
-        topk_most_adversarial_input = test_data[topk_most_adversarial.indices, :]
-        topk_most_adversarial_patch_input = test_patch_data[topk_most_adversarial.indices, :]
+        topk_most_adversarial_input = self.results.inputs(topk_most_adversarial.indices)
+        topk_most_adversarial_patch_input = self.results.patch_inputs(topk_most_adversarial.indices)
 
         topk_losses = topk_most_adversarial.values
 
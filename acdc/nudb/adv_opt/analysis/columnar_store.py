@@ -0,0 +1,328 @@
+"""An append-only columnar store (Parquet) for the results of adv_opt runs (main.py) and brute-force runs
+(main_circuit_performance_distribution.py), so that analyses don't have to walk hydra output directories and
+torch.load every artifact of every run again.
+
+Layout of the store:
+  - runs/part-*.parquet: the index, one row per run, with its run_id, kind, task, source directory, config
+    (flattened: 'config.task.task_name', 'config.num_epochs', ...) and some per-run results; every ingest appends a
+    part;
+  - <table>/task=<task>/run=<run_id>/part-0.parquet: the per-example results of a run, for the tables
+    'adv_opt_examples' (base inputs and coefficients), 'brute_force_pairs' (pair indices and the metric of every
+    circuit) and 'brute_force_inputs' (the test data and patch data that the pairs index into).
+
+Example:
+    python -m acdc.nudb.adv_opt.analysis.columnar_store /data/results_store /data/outputs/2024-04-13-*
+
+    store = ColumnarResultsStore(Path("/data/results_store"))
+    examples = store.adv_opt_examples(["coefficients_final"], where={"config.task.task_name": "IOI"})
+"""
+
+import hashlib
+import json
+import uuid
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from typing import Annotated, Any, Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import torch
+import typer
+
+from acdc.nudb.adv_opt.analysis.output_parser import HydraConfig
+from acdc.nudb.adv_opt.data_fetchers import AdvOptTaskName
+from acdc.nudb.adv_opt.main_circuit_performance_distribution import CircuitPerformanceDistributionResults
+from acdc.nudb.adv_opt.results_store import ConsolidatedResults
+from acdc.nudb.adv_opt.settings import ExperimentArtifacts
+
+
+class RunKind(str, Enum):
+    ADV_OPT = "adv_opt"
+    BRUTE_FORCE = "brute_force"
+
+
+# the fields of ExperimentArtifacts with a value per example; final_losses_all_restarts is stored in the index
+_ADV_OPT_EXAMPLE_FIELDS = (
+    "base_input",
+    "base_patch_input",
+    "coefficients_init",
+    "coefficients_final",
+    "coefficients_init_patch",
+    "coefficients_final_patch",
+    "coefficients_init_all_restarts",
+    "coefficients_final_all_restarts",
+    "coefficients_init_patch_all_restarts",
+    "coefficients_final_patch_all_restarts",
+)
+_PARTITIONING = ds.partitioning(pa.schema([("task", pa.string()), ("run", pa.string())]), flavor="hive")
+
+
+class ColumnarResultsStore:
+    root: Path
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    # --- writing ---
+
+    def ingest(self, paths: Iterable[Path]) -> list[str]:
+        """Adds the runs in 'paths' that are not in the store yet, and returns their run ids. A path can be a hydra
+        output directory of main.py or of the brute-force experiment, a ConsolidatedResults directory, or a
+        directory that contains any of those."""
+        known_run_ids = set(self.runs()["run_id"])
+        rows = []
+        for source, config, load_results in _find_runs(paths):
+            run_id = _run_id(source)
+            if run_id in known_run_ids:
+                continue
+            results = load_results()
+            if isinstance(results, ExperimentArtifacts):
+                rows.append(self._write_adv_opt_run(run_id, source, config, results))
+            else:
+                rows.append(self._write_brute_force_run(run_id, source, config, results))
+            known_run_ids.add(run_id)
+
+        # the index is written last, so that the runs of an ingest that crashed are not in the store
+        if rows:
+            index_dir = self.root / "runs"
+            index_dir.mkdir(parents=True, exist_ok=True)
+            part_name = f"part-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+            # (from_pylist takes the columns of the first row only)
+            columns = list(dict.fromkeys(column for row in rows for column in row))
+            pq.write_table(
+                pa.Table.from_pylist([{column: row.get(column) for column in columns} for row in rows]),
+                index_dir / part_name,
+            )
+        return [row["run_id"] for row in rows]
+
+    def _write_adv_opt_run(self, run_id: str, source: str, config: dict, artifacts: ExperimentArtifacts) -> dict:
+        columns = {}
+        for name in _ADV_OPT_EXAMPLE_FIELDS:
+            if (value := getattr(artifacts, name)) is not None:
+                # the restart fields get one row per example, with the values of all restarts
+                columns[name] = _to_arrow(value.T if name in ExperimentArtifacts.RESTART_FIELDS else value)
+        num_examples = len(next(iter(columns.values()))) if columns else 0
+        task = HydraConfig(config).task_name
+        self._write_table("adv_opt_examples", task, run_id, {"example": pa.array(np.arange(num_examples))} | columns)
+
+        final_losses = artifacts.final_losses_all_restarts
+        return self._index_row(run_id, RunKind.ADV_OPT, source, config, num_examples) | {
+            "final_losses_all_restarts": None if final_losses is None else final_losses.detach().cpu().tolist()
+        }
+
+    def _write_brute_force_run(
+        self, run_id: str, source: str, config: dict, results: CircuitPerformanceDistributionResults
+    ) -> dict:
+        task = results.experiment_name
+        # streaming experiments don't have the metrics of every pair, only their summaries (which are not stored)
+        if results.metrics:
+            pair_indices = results.pair_indices.detach().cpu()
+            self._write_table(
+                "brute_force_pairs",
+                task,
+                run_id,
+                {
+                    "input_index": _to_arrow(pair_indices[:, 0]),
+                    "patch_input_index": _to_arrow(pair_indices[:, 1]),
+                }
+                | {f"metric_{circuit}": _to_arrow(metrics) for circuit, metrics in results.metrics.items()},
+            )
+        num_inputs = max(len(results.test_data), len(results.test_patch_data))
+        self._write_table(
+            "brute_force_inputs",
+            task,
+            run_id,
+            {
+                "index": pa.array(np.arange(num_inputs)),
+                "input": _to_nullable_list_array(results.test_data, num_inputs),
+                "patch_input": _to_nullable_list_array(results.test_patch_data, num_inputs),
+            },
+        )
+        num_pairs = len(results.pair_indices) if results.metrics else 0
+        return self._index_row(run_id, RunKind.BRUTE_FORCE, source, config, num_pairs) | {
+            "circuits": sorted(results.metrics)
+        }
+
+    def _write_table(self, table: str, task: AdvOptTaskName, run_id: str, columns: dict[str, pa.Array]) -> None:
+        run_dir = self.root / table / f"task={task.name}" / f"run={run_id}"
+        run_dir.mkdir(parents=True, exist_ok=True)
+        pq.write_table(pa.table(columns), run_dir / "part-0.parquet")
+
+    @staticmethod
+    def _index_row(run_id: str, kind: RunKind, source: str, config: dict, num_rows: int) -> dict:
+        return {
+            "run_id": run_id,
+            "kind": kind.value,
+            "task": HydraConfig(config).task_name.name,
+            "source": source,
+            "ingested_at": datetime.now().isoformat(timespec="seconds"),
+            "num_rows": num_rows,
+        } | {f"config.{key}": value for key, value in _flatten_config(config).items()}
+
+    # --- reading ---
+
+    def runs(self, where: dict[str, Any] | None = None) -> pd.DataFrame:
+        """The index of the runs, one row per run, optionally filtered with 'where' (see `_filter`)."""
+        parts = sorted((self.root / "runs").glob("part-*.parquet"))
+        if not parts:
+            return pd.DataFrame(columns=["run_id", "kind", "task", "source", "ingested_at", "num_rows"])
+        # the parts can have different columns (e.g. runs of other experiments have other config fields)
+        index = pa.concat_tables([pq.read_table(part) for part in parts], promote_options="permissive")
+        return _filter(index.to_pandas(), where).reset_index(drop=True)
+
+    def adv_opt_examples(self, columns: list[str] | None = None, where: dict[str, Any] | None = None) -> pd.DataFrame:
+        """The per-example results of the adv_opt runs that match 'where': a row per (run, example), with the columns
+        'run_id', 'example' and 'columns' (all, if None) of base_input, base_patch_input, coefficients_init,
+        coefficients_final, coefficients_init_patch, coefficients_final_patch and the '*_all_restarts' fields."""
+        return self._read_table("adv_opt_examples", RunKind.ADV_OPT, ["example"], columns, where)
+
+    def brute_force_pairs(self, columns: list[str] | None = None, where: dict[str, Any] | None = None) -> pd.DataFrame:
+        """The metrics of the brute-force runs that match 'where': a row per (run, pair), with the columns 'run_id',
+        'input_index', 'patch_input_index' and 'columns' (all, if None) of 'metric_<circuit>'."""
+        return self._read_table(
+            "brute_force_pairs", RunKind.BRUTE_FORCE, ["input_index", "patch_input_index"], columns, where
+        )
+
+    def brute_force_inputs(self, columns: list[str] | None = None, where: dict[str, Any] | None = None) -> pd.DataFrame:
+        """The inputs that the pairs of the brute-force runs index into: a row per (run, index), with the columns
+        'run_id', 'index' and 'columns' (all, if None) of 'input' and 'patch_input'."""
+        return self._read_table("brute_force_inputs", RunKind.BRUTE_FORCE, ["index"], columns, where)
+
+    def adv_opt_artifacts(self, run_id: str) -> ExperimentArtifacts:
+        """The ExperimentArtifacts of the adv_opt run 'run_id', as main.py stored them."""
+        examples = self.adv_opt_examples(where={"run_id": run_id}).sort_values("example")
+        fields = {}
+        for name in _ADV_OPT_EXAMPLE_FIELDS:
+            if name in examples.columns and examples[name].notna().all():
+                values = stack_column(examples, name)
+                fields[name] = values.T if name in ExperimentArtifacts.RESTART_FIELDS else values
+        final_losses = self.runs(where={"run_id": run_id})["final_losses_all_restarts"].iloc[0]
+        return ExperimentArtifacts(
+            **fields, final_losses_all_restarts=None if final_losses is None else torch.tensor(final_losses)
+        )
+
+    def _read_table(
+        self,
+        table: str,
+        kind: RunKind,
+        key_columns: list[str],
+        columns: list[str] | None,
+        where: dict[str, Any] | None,
+    ) -> pd.DataFrame:
+        runs = self.runs(where)
+        runs = runs[runs["kind"] == kind.value]
+        files = [
+            path
+            for task, run_id in zip(runs["task"], runs["run_id"])
+            if (path := self.root / table / f"task={task}" / f"run={run_id}" / "part-0.parquet").exists()
+        ]
+        if not files:
+            return pd.DataFrame(columns=["run_id"] + key_columns + (columns or []))
+        # only the files of the selected runs, and only the selected columns of those, are read; runs can be missing
+        # columns (e.g. the restart fields of runs from before restarts were added), which are then null
+        dataset = ds.dataset(
+            [str(file) for file in files],
+            schema=pa.unify_schemas([pq.read_schema(file) for file in files] + [_PARTITIONING.schema]),
+            format="parquet",
+            partitioning=_PARTITIONING,
+            partition_base_dir=str(self.root / table),
+        )
+        if columns is None:
+            columns = [name for name in dataset.schema.names if name not in ["task", "run"] + key_columns]
+        frame = dataset.to_table(columns=["run"] + key_columns + columns).to_pandas()
+        return frame.rename(columns={"run": "run_id"})
+
+
+def stack_column(frame: pd.DataFrame, column: str) -> torch.Tensor:
+    """The values of 'column' (of one run) as a tensor, with a row per row of 'frame'."""
+    return torch.from_numpy(np.stack(frame[column].to_numpy()))
+
+
+def _filter(frame: pd.DataFrame, where: dict[str, Any] | None) -> pd.DataFrame:
+    """The rows of 'frame' where, for every column in 'where', the value is equal to (or, for a list, tuple or set,
+    is one of) the value in 'where'."""
+    mask = pd.Series(True, index=frame.index)
+    for column, value in (where or {}).items():
+        if column not in frame.columns:
+            raise KeyError(f"Unknown column {column}; the columns of the runs are {list(frame.columns)}")
+        mask &= frame[column].isin(value) if isinstance(value, (list, tuple, set)) else frame[column] == value
+    return frame[mask]
+
+
+def _flatten_config(config: dict, prefix: str = "") -> dict[str, Any]:
+    """The config with dotted keys, like 'task.task_name'; lists are stored as json, so that the columns of the
+    index have a single type."""
+    flat = {}
+    for key, value in config.items():
+        if isinstance(value, dict):
+            flat |= _flatten_config(value, prefix=f"{prefix}{key}.")
+        elif isinstance(value, list):
+            flat[f"{prefix}{key}"] = json.dumps(value)
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def _run_id(source: str) -> str:
+    """Runs are identified by the directory they were ingested from, so that ingesting a directory twice doesn't
+    add its runs twice."""
+    return hashlib.blake2b(source.encode(), digest_size=8).hexdigest()
+
+
+def _to_arrow(tensor: torch.Tensor) -> pa.Array:
+    """A 1D tensor as a plain array, a 2D tensor as a fixed size list per row."""
+    values = tensor.detach().cpu().numpy()
+    if values.ndim == 1:
+        return pa.array(values)
+    assert values.ndim == 2, f"Can't store a tensor of shape {values.shape}"
+    return pa.FixedSizeListArray.from_arrays(pa.array(values.reshape(-1)), values.shape[1])
+
+
+def _to_nullable_list_array(tensor: torch.Tensor, length: int) -> pa.Array:
+    rows = tensor.detach().cpu().tolist()
+    return pa.array(rows + [None] * (length - len(rows)), type=pa.list_(pa.int64()))
+
+
+def _find_runs(paths: Iterable[Path]) -> Iterator[tuple[str, dict, Any]]:
+    """(source, config, a function that loads the results) for every run in 'paths'."""
+    for path in paths:
+        if ConsolidatedResults.is_consolidated_results_dir(path):
+            for run in ConsolidatedResults.load(path).runs:
+                # the source of a consolidated run is its own output dir, so that it's not added twice
+                source = str(run.output_dir.resolve()) if run.output_dir is not None else f"{path.resolve()}#{run.name}"
+                yield source, run.config, lambda run=run: run.artifacts
+        elif (path / ".hydra" / "config.yaml").exists():
+            config = HydraConfig.from_file(path / ".hydra" / "config.yaml").cfg_dict
+            artifact_dir = path / "artifacts"
+            if (artifact_dir / "coefficients_final.pt").exists():
+                yield str(path.resolve()), config, lambda artifact_dir=artifact_dir: ExperimentArtifacts.load(
+                    artifact_dir
+                )
+            elif (artifact_dir / "test_data.pt").exists():
+                yield str(path.resolve()), config, lambda artifact_dir=artifact_dir, config=config: (
+                    CircuitPerformanceDistributionResults.load(
+                        artifact_dir, experiment_name=HydraConfig(config).task_name, append_exp_name_to_dir=False
+                    )
+                )
+        elif path.is_dir():
+            yield from _find_runs(sorted(child for child in path.iterdir() if child.is_dir()))
+
+
+app = typer.Typer()
+
+
+@app.command()
+def ingest(
+    store_dir: Annotated[Path, typer.Argument(help="the directory of the store; created if it doesn't exist")],
+    paths: Annotated[list[Path], typer.Argument(help="hydra output dirs, consolidated results, or dirs with those")],
+):
+    run_ids = ColumnarResultsStore(store_dir).ingest(paths)
+    typer.echo(f"Added {len(run_ids)} runs to {store_dir}")
+
+
+if __name__ == "__main__":
+    app()
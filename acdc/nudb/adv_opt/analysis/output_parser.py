@@ -5,6 +5,7 @@ import torch
 import yaml
 
 from acdc.nudb.adv_opt.data_fetchers import AdvOptExperimentData, AdvOptTaskName, get_standard_experiment_data
+from acdc.nudb.adv_opt.results_store import ConsolidatedResults, SweepRun
 from acdc.nudb.adv_opt.settings import ExperimentArtifacts
 
 
@@ -74,3 +75,26 @@ class AdvOptHydraOutputDir(HydraOutputDir):
         loss = experiment_data.loss_fn(outputs_from_circuit, outputs_from_full_model)
 
         return loss
+
+
+class AdvOptSweepRun:
+    """A run from the consolidated results of a sweep (see ConsolidatedResults), with the same 'config' and
+    'artifacts' as an AdvOptHydraOutputDir."""
+
+    name: str
+    config: HydraConfig
+    artifacts: ExperimentArtifacts
+
+    def __init__(self, run: SweepRun):
+        self.name = run.name
+        self.config = HydraConfig(run.config)
+        self.artifacts = run.artifacts
+
+    @cached_property
+    def standard_experiment_data_for_task(self) -> AdvOptExperimentData:
+        return get_standard_experiment_data(self.config.task_name)
+
+    @classmethod
+    def load_all(cls, path: Path) -> list["AdvOptSweepRun"]:
+        """All runs in the consolidated results in 'path'."""
+        return [cls(run) for run in ConsolidatedResults.load(path).runs]
@@ -42,9 +42,11 @@ class AdvOptExperimentData:
     loss_fn: Callable[
         [Float[torch.Tensor, "batch pos vocab"], Float[torch.Tensor, "batch pos vocab"]], Float[torch.Tensor, " batch"]
     ]
+    # whether loss_fn only looks at the last sequence position
+    metric_last_sequence_position_only: bool = False
 
     @cached_property
-    def ablated_edges(self) -> set[Edge]:
+    def ablated_edges(self) -> frozenset[Edge]:
         # see comment at the bottom of this file about why I believe this works.
         return self.masked_runner.all_ablatable_edges - set(self.circuit_edges)
 
@@ -124,6 +126,7 @@ class ACDCAdvOptDataProvider(AdvOptDataProvider):
             loss_fn=partial(
                 kl_div_on_output_logits, last_sequence_position_only=self.metric_last_sequence_position_only
             ),
+            metric_last_sequence_position_only=self.metric_last_sequence_position_only,
         )
 
 
@@ -202,10 +205,17 @@ EXPERIMENT_DATA_PROVIDERS: dict[AdvOptTaskName, AdvOptDataProvider] = {
 #    I'm not 100% sure that the ACDC correspondence does not include such dangling edges/nodes, but I think so.
 
 
-def get_standard_experiment_data(task_name: AdvOptTaskName) -> AdvOptExperimentData:
-    experiment_data = EXPERIMENT_DATA_PROVIDERS[task_name].get_experiment_data(
+def standard_experiment_parameters(task_name: AdvOptTaskName) -> dict[str, int | str]:
+    """The arguments (besides the device) that get_standard_experiment_data passes to the data provider."""
+    return dict(
         num_examples=1000 if task_name != AdvOptTaskName.TRACR_REVERSE else 30,
         metric_name="kl_div" if task_name != AdvOptTaskName.TRACR_REVERSE else "l2",
+    )
+
+
+def get_standard_experiment_data(task_name: AdvOptTaskName) -> AdvOptExperimentData:
+    experiment_data = EXPERIMENT_DATA_PROVIDERS[task_name].get_experiment_data(
+        **standard_experiment_parameters(task_name),  # pyright: ignore
         device=device,
     )
     return experiment_data
@@ -0,0 +1,197 @@
+"""A cache for the experiment data of the standard tasks, so that runs don't have to download models and build
+datasets every time.
+
+The cache stores what is needed to rebuild the experiment data, in formats that don't depend on the code:
+  - <cache_dir>/<task_name>/metadata.json: the version of the cache format, the parameters the data was made with,
+    the model config, the content hash of the model weights, the circuit and the starting point type;
+  - <cache_dir>/<task_name>/<name>.pt: the task tensors (data, patch data, labels, masks), one file each;
+  - <cache_dir>/weights/<hash>.pt: the state dict of the model, shared by all tasks that use the same weights.
+
+The validation and test metrics of the task data are closures, so they are not cached: use
+get_standard_experiment_data if you need them.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from functools import partial
+from pathlib import Path
+
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from acdc.docstring.utils import AllDataThings
+from acdc.nudb.adv_opt.data_fetchers import (
+    AdvOptExperimentData,
+    AdvOptTaskName,
+    get_standard_experiment_data,
+    standard_experiment_parameters,
+)
+from acdc.nudb.adv_opt.edge_serdes import EdgeJSONDecoder, EdgeJSONEncoder
+from acdc.nudb.adv_opt.loss_fn import kl_div_on_output_logits
+from acdc.nudb.adv_opt.masked_runner import MaskedRunner
+from acdc.nudb.adv_opt.utils import CIRCUITBENCHMARKS_DATA_DIR, device
+from subnetwork_probing.masked_transformer import CircuitStartingPointType
+
+logger = logging.getLogger(__name__)
+
+# Increase this when the format of the cache changes, or when the data providers start returning different data:
+# caches with another version are rebuilt.
+EXPERIMENT_DATA_CACHE_VERSION = 1
+EXPERIMENT_DATA_CACHE_DIR = CIRCUITBENCHMARKS_DATA_DIR / "experiment_data"
+
+TASK_TENSOR_NAMES = (
+    "validation_data",
+    "validation_labels",
+    "validation_mask",
+    "validation_patch_data",
+    "test_data",
+    "test_labels",
+    "test_mask",
+    "test_patch_data",
+)
+
+
+class ExperimentDataCacheMiss(Exception):
+    pass
+
+
+class MetricsNotCached(Exception):
+    """Raised when the validation metric of experiment data loaded from the cache is called."""
+
+
+def get_experiment_data_cached(
+    task_name: AdvOptTaskName, cache_dir: Path = EXPERIMENT_DATA_CACHE_DIR
+) -> AdvOptExperimentData:
+    """Loads the experiment data of 'task_name' from the cache, or gets it with get_standard_experiment_data and
+    stores it in the cache if it's not there (or was made with another version or other parameters)."""
+    parameters = standard_experiment_parameters(task_name)
+    try:
+        return load_experiment_data(cache_dir, task_name, parameters)
+    except ExperimentDataCacheMiss as e:
+        logger.info("Experiment data for %s is not cached (%s); creating it", task_name.value, e)
+
+    experiment_data = get_standard_experiment_data(task_name)
+    save_experiment_data(cache_dir, experiment_data, parameters)
+    return experiment_data
+
+
+def save_experiment_data(cache_dir: Path, experiment_data: AdvOptExperimentData, parameters: dict) -> None:
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    model = experiment_data.masked_runner.masked_transformer.model
+    state_dict = {name: tensor.detach().cpu() for name, tensor in model.state_dict().items()}
+    weights_hash = _state_dict_hash(state_dict)
+    weights_path = cache_dir / "weights" / f"{weights_hash}.pt"
+    if not weights_path.exists():
+        weights_path.parent.mkdir(exist_ok=True)
+        _atomic_save(state_dict, weights_path)
+
+    # write everything to a temporary directory first, so that other processes never see a half-written cache
+    tmp_dir = Path(tempfile.mkdtemp(dir=cache_dir, prefix=f".{experiment_data.task_name.value}_"))
+    for name in TASK_TENSOR_NAMES:
+        value = getattr(experiment_data.task_data, name)
+        torch.save(None if value is None else value.detach().cpu(), tmp_dir / f"{name}.pt")
+    # (to_dict returns the attributes of the config itself, so don't modify it)
+    model_config = model.cfg.to_dict() | {"dtype": str(model.cfg.dtype).removeprefix("torch.")}
+    metadata = {
+        "version": EXPERIMENT_DATA_CACHE_VERSION,
+        "task_name": experiment_data.task_name.value,
+        "parameters": parameters,
+        "model_config": model_config,
+        "weights_hash": weights_hash,
+        "starting_point_type": experiment_data.masked_runner.masked_transformer.starting_point_type.value,
+        "circuit_edges": experiment_data.circuit_edges,
+        "metric_last_sequence_position_only": experiment_data.metric_last_sequence_position_only,
+    }
+    (tmp_dir / "metadata.json").write_text(json.dumps(metadata, cls=EdgeJSONEncoder, indent=2))
+
+    task_dir = cache_dir / experiment_data.task_name.value
+    try:
+        _read_metadata(cache_dir, experiment_data.task_name, parameters)
+    except ExperimentDataCacheMiss:
+        # the entry is missing or stale (another version or other parameters): replace it
+        shutil.rmtree(task_dir, ignore_errors=True)
+    else:
+        # another process stored it in the meantime; keep that one, since other processes may be loading it
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+    try:
+        tmp_dir.rename(task_dir)
+    except OSError:  # another process stored it first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_experiment_data(cache_dir: Path, task_name: AdvOptTaskName, parameters: dict) -> AdvOptExperimentData:
+    """Raises ExperimentDataCacheMiss if there is no usable cache for 'task_name' with 'parameters'."""
+    task_dir = cache_dir / task_name.value
+    metadata = _read_metadata(cache_dir, task_name, parameters)
+    weights_path = cache_dir / "weights" / f"{metadata['weights_hash']}.pt"
+
+    model_config = metadata["model_config"] | {
+        "dtype": getattr(torch, metadata["model_config"]["dtype"]),
+        "device": device,
+    }
+    model = HookedTransformer(HookedTransformerConfig.from_dict(model_config))
+    try:
+        model.load_state_dict(torch.load(weights_path, map_location=device, weights_only=True))
+        tensors = {
+            name: torch.load(task_dir / f"{name}.pt", map_location=device, weights_only=True)
+            for name in TASK_TENSOR_NAMES
+        }
+    except FileNotFoundError as e:  # another process replaced the entry while it was loaded
+        raise ExperimentDataCacheMiss(f"missing file {Path(e.filename).name}") from e
+    return AdvOptExperimentData(
+        task_name=task_name,
+        task_data=AllDataThings(
+            tl_model=model,
+            validation_metric=_metric_not_cached,
+            test_metrics={},
+            **tensors,
+        ),
+        circuit_edges=metadata["circuit_edges"],
+        masked_runner=MaskedRunner(
+            model=model, starting_point_type=CircuitStartingPointType(metadata["starting_point_type"])
+        ),
+        loss_fn=partial(
+            kl_div_on_output_logits, last_sequence_position_only=metadata["metric_last_sequence_position_only"]
+        ),
+        metric_last_sequence_position_only=metadata["metric_last_sequence_position_only"],
+    )
+
+
+def _read_metadata(cache_dir: Path, task_name: AdvOptTaskName, parameters: dict) -> dict:
+    """The metadata of the cache entry of 'task_name'; raises ExperimentDataCacheMiss if the entry is missing, or was
+    made with another version or other parameters."""
+    try:
+        metadata = json.loads((cache_dir / task_name.value / "metadata.json").read_text(), cls=EdgeJSONDecoder)
+    except FileNotFoundError as e:
+        raise ExperimentDataCacheMiss("no cache") from e
+    if metadata["version"] != EXPERIMENT_DATA_CACHE_VERSION:
+        raise ExperimentDataCacheMiss(f"cache version {metadata['version']} != {EXPERIMENT_DATA_CACHE_VERSION}")
+    if metadata["parameters"] != parameters:
+        raise ExperimentDataCacheMiss(f"cached with {metadata['parameters']} instead of {parameters}")
+    if not (cache_dir / "weights" / f"{metadata['weights_hash']}.pt").exists():
+        raise ExperimentDataCacheMiss(f"missing weights {metadata['weights_hash']}.pt")
+    return metadata
+
+
+def _metric_not_cached(*args, **kwargs):
+    raise MetricsNotCached("The metrics of the task are not cached; use get_standard_experiment_data")
+
+
+def _state_dict_hash(state_dict: dict[str, torch.Tensor]) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(state_dict):
+        tensor = state_dict[name]
+        digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        digest.update(tensor.reshape(-1).contiguous().view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _atomic_save(obj, path: Path) -> None:
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
@@ -0,0 +1,200 @@
+"""Runs a sweep of adv_opt main on the local machine, in a pool of worker processes, instead of one k8s pod per run
+(see k8s_launcher.py). The workers keep the experiment data of every task they have seen loaded, so that runs on the
+same task don't load the model and the data again.
+
+Every run gets an output directory like the ones hydra makes (with .hydra/config.yaml, main.log and artifacts/), and
+the artifacts of all runs are also collected in a single ConsolidatedResults directory.
+
+Example:
+    python -m acdc.nudb.adv_opt.experiments.core.local_launcher task=tracr_reverse random_seed=range(0,20) \\
+        num_epochs=100 --workers 8 --threads-per-worker 1
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+import traceback
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Annotated, Optional
+
+import hydra
+import omegaconf
+import torch
+import typer
+from hydra.core.config_store import ConfigStore
+from hydra.core.override_parser.overrides_parser import OverridesParser
+
+from acdc.nudb.adv_opt.data_fetchers import AdvOptExperimentData, AdvOptTaskName, get_standard_experiment_data
+from acdc.nudb.adv_opt.experiment_data_cache import get_experiment_data_cached
+from acdc.nudb.adv_opt.main import run_experiment
+from acdc.nudb.adv_opt.results_store import ConsolidatedResults, SweepRun
+from acdc.nudb.adv_opt.settings import ExperimentArtifacts, ExperimentSettings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LocalRun:
+    name: str
+    overrides: list[str]
+    settings: omegaconf.DictConfig
+    output_dir: Path
+
+
+@dataclass
+class LocalRunResult:
+    run: LocalRun
+    artifacts: ExperimentArtifacts | None
+    error: str | None = None
+
+
+def expand_sweep(overrides: list[str]) -> list[list[str]]:
+    """All combinations of the values of the sweep overrides (like 'random_seed=1,2,3' or 'task=ioi,greaterthan'),
+    as lists of plain overrides, like hydra's basic sweeper."""
+    values_per_override = [
+        (
+            [f"{override.get_key_element()}={value}" for value in override.sweep_string_iterator()]
+            if override.is_sweep_override()
+            else [override.input_line]
+        )
+        for override in OverridesParser.create().parse_overrides(overrides)
+    ]
+    return [list(combination) for combination in itertools.product(*values_per_override)]
+
+
+def compose_runs(overrides: list[str], output_dir: Path, config_name: str = "config") -> list[LocalRun]:
+    """The runs of the sweep given by 'overrides', including the sweeps in 'hydra.sweeper.params' of the config
+    (e.g. from '+experiment=...'), ordered by task."""
+    runs = []
+    # the other entry points (e.g. main_token_search) store their own config_schema when they are imported
+    ConfigStore.instance().store(name="config_schema", node=ExperimentSettings)
+    with hydra.initialize_config_module(config_module="acdc.nudb.adv_opt.conf", version_base=None):
+        for command_line_overrides in expand_sweep(overrides):
+            config = hydra.compose(config_name, command_line_overrides, return_hydra_config=True)
+            # like in hydra, overrides on the command line win from the sweeper params of the config
+            overridden_keys = {override.split("=")[0].lstrip("+~") for override in command_line_overrides}
+            sweeper_params = omegaconf.OmegaConf.select(config, "hydra.sweeper.params") or {}
+            sweeper_overrides = [
+                f"{key}={value}" for key, value in sweeper_params.items() if key not in overridden_keys
+            ]
+            for extra_overrides in expand_sweep(sweeper_overrides):
+                run_overrides = command_line_overrides + extra_overrides
+                index = len(runs)
+                runs.append(
+                    LocalRun(
+                        name=str(index),
+                        overrides=run_overrides,
+                        settings=hydra.compose(config_name, run_overrides),
+                        output_dir=output_dir / str(index),
+                    )
+                )
+    return sorted(runs, key=lambda run: str(run.settings.task.task_name))
+
+
+# the experiment data that a worker has loaded, per task
+_experiment_data_per_task: dict[AdvOptTaskName, AdvOptExperimentData] = {}
+
+
+def _initialize_worker(threads_per_worker: int) -> None:
+    torch.set_num_threads(threads_per_worker)
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s][%(name)s][%(levelname)s] - %(message)s")
+
+
+def _run(run: LocalRun) -> LocalRunResult:
+    run.output_dir.mkdir(parents=True, exist_ok=True)
+    (run.output_dir / ".hydra").mkdir(exist_ok=True)
+    omegaconf.OmegaConf.save(run.settings, run.output_dir / ".hydra" / "config.yaml", resolve=True)
+    (run.output_dir / ".hydra" / "overrides.yaml").write_text(omegaconf.OmegaConf.to_yaml(run.overrides))
+    log_handler = logging.FileHandler(run.output_dir / "main.log")
+    log_handler.setFormatter(logging.Formatter("[%(asctime)s][%(name)s][%(levelname)s] - %(message)s"))
+    logging.getLogger().addHandler(log_handler)
+
+    settings: ExperimentSettings = run.settings  # pyright: ignore
+    task_name = settings.task.task_name
+    try:
+        if task_name not in _experiment_data_per_task:
+            _experiment_data_per_task[task_name] = (
+                get_experiment_data_cached(task_name)
+                if settings.use_experiment_cache
+                else get_standard_experiment_data(task_name)
+            )
+        experiment_data = _experiment_data_per_task[task_name]
+        model = experiment_data.masked_runner.masked_transformer.model
+        weights_versions = [parameter._version for parameter in model.parameters()]
+        artifacts = run_experiment(settings, run.output_dir, experiment_data=experiment_data)
+        if [parameter._version for parameter in model.parameters()] != weights_versions:
+            # the run changed the model (e.g. tracr's artificially_corrupt_model), so don't reuse it
+            del _experiment_data_per_task[task_name]
+        return LocalRunResult(run=run, artifacts=artifacts)
+    except Exception:
+        _experiment_data_per_task.pop(task_name, None)
+        logger.exception("Run %s failed", run.name)
+        return LocalRunResult(run=run, artifacts=None, error=traceback.format_exc())
+    finally:
+        logging.getLogger().removeHandler(log_handler)
+        log_handler.close()
+
+
+def run_sweep(
+    runs: list[LocalRun], consolidated_dir: Path, workers: int, threads_per_worker: int
+) -> tuple[ConsolidatedResults, list[LocalRunResult]]:
+    """Runs 'runs' in 'workers' processes, and stores the artifacts of the runs in 'consolidated_dir' as they
+    finish. Returns the consolidated results and the runs that failed."""
+    results, failures = ConsolidatedResults(), []
+    # spawn, because forked workers can't use CUDA
+    with multiprocessing.get_context("spawn").Pool(
+        processes=workers, initializer=_initialize_worker, initargs=(threads_per_worker,)
+    ) as pool:
+        for result in pool.imap_unordered(_run, runs):
+            if result.artifacts is None:
+                failures.append(result)
+                logger.error("Run %s (%s) failed:\n%s", result.run.name, result.run.overrides, result.error)
+                continue
+            sweep_run = SweepRun(
+                name=result.run.name,
+                config=omegaconf.OmegaConf.to_container(  # pyright: ignore
+                    result.run.settings, resolve=True, enum_to_str=True
+                ),
+                artifacts=result.artifacts,
+                output_dir=result.run.output_dir,
+            )
+            results.add(sweep_run)
+            # only saves this run; the runs that finished before are already saved
+            ConsolidatedResults.save_run(consolidated_dir, sweep_run)
+            logger.info("Finished run %s (%s/%s done)", result.run.name, len(results.runs) + len(failures), len(runs))
+    return results, failures
+
+
+app = typer.Typer()
+
+
+@app.command()
+def launch(
+    overrides: Annotated[Optional[list[str]], typer.Argument(help="hydra overrides, with sweeps like a=1,2")] = None,
+    workers: Annotated[int, typer.Option(help="number of worker processes")] = max(1, (os.cpu_count() or 1) // 2),
+    threads_per_worker: Annotated[int, typer.Option(help="torch threads per worker")] = 1,
+    output_dir: Annotated[Optional[Path], typer.Option(help="defaults to outputs/<date>-<time>-local_sweep")] = None,
+):
+    if output_dir is None:
+        output_dir = (
+            Path(os.environ.get("ACDC_OUTPUT_DIR", "."))
+            / "outputs"
+            / f"{datetime.now().strftime('%Y-%m-%d-%H%M%S')}-local_sweep"
+        )
+    runs = compose_runs(overrides or [], output_dir)
+    typer.echo(f"Running {len(runs)} runs with {workers} workers; storing output in {output_dir}")
+
+    results, failures = run_sweep(runs, output_dir / "consolidated", workers, threads_per_worker)
+
+    typer.echo(f"{len(results.runs)} runs finished; results stored in {output_dir / 'consolidated'}")
+    if failures:
+        typer.echo(f"{len(failures)} runs failed: {[failure.run.name for failure in failures]}", err=True)
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s][%(name)s][%(levelname)s] - %(message)s")
+    app()
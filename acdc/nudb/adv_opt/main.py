@@ -1,7 +1,6 @@
 import logging
 import random
 from pathlib import Path
-from typing import cast
 
 import hydra
 import hydra.core.hydra_config as hydra_config
@@ -18,11 +17,9 @@ from acdc.nudb.adv_opt.adam_lr_scheduler import (
     GradientBasedAdamLRScheduler,
     GradientWatchingAdamLRScheduler,
 )
-from acdc.nudb.adv_opt.data_fetchers import (
-    AdvOptExperimentData,
-    AdvOptTaskName,
-    get_standard_experiment_data,
-)
+from acdc.nudb.adv_opt.data_fetchers import AdvOptExperimentData, AdvOptTaskName, get_standard_experiment_data
+from acdc.nudb.adv_opt.experiment_data_cache import get_experiment_data_cached
+from acdc.nudb.adv_opt.masked_runner import sparse_support
 from acdc.nudb.adv_opt.noise_generators import (
     ClampedSPNoiseGenerator,
     IntermittentNoiseGenerator,
@@ -37,7 +34,7 @@ from acdc.nudb.adv_opt.settings import (
     TaskSpecificSettings,
     TracrReverseTaskSpecificSettings,
 )
-from acdc.nudb.adv_opt.utils import device, joblib_memory
+from acdc.nudb.adv_opt.utils import device
 
 logger = logging.getLogger(__name__)
 
@@ -49,18 +46,22 @@ cs.store(group="task", name="greaterthan_schema", node=TaskSpecificSettings)
 cs.store(group="task", name="tracr_reverse_schema", node=TracrReverseTaskSpecificSettings)
 
 
-@joblib_memory.cache
-def get_experiment_data_cached(task_name: AdvOptTaskName) -> AdvOptExperimentData:
-    return get_standard_experiment_data(task_name)
-
-
 @hydra.main(config_path="conf", config_name="config", version_base=None)
 def main(settings: ExperimentSettings) -> None:
+    run_experiment(settings, Path(hydra_config.HydraConfig.get().runtime.output_dir))
+
+
+def run_experiment(
+    settings: ExperimentSettings, output_base_dir: Path, experiment_data: AdvOptExperimentData | None = None
+) -> ExperimentArtifacts:
+    """Runs the optimization and stores the artifacts in 'output_base_dir'.
+
+    'experiment_data' can be passed to reuse the data (and model) of an earlier run on the same task, as the local
+    sweep launcher does; otherwise, it is loaded for the task in 'settings'."""
     if settings.random_seed is not None:
         torch.manual_seed(settings.random_seed)
         random.seed(settings.random_seed)
 
-    output_base_dir = Path(hydra_config.HydraConfig.get().runtime.output_dir)
     artifacts = ExperimentArtifacts()
 
     # Log in to your W&B account
@@ -75,13 +76,12 @@ def main(settings: ExperimentSettings) -> None:
     )
     wandb.define_metric("loss", summary="max", goal="maximize")  # creates wandb summary statistic
 
-    experiment_data = cast(
-        AdvOptExperimentData,  # pyright needs this unfortunately
-        get_experiment_data_cached(task_name=settings.task.task_name)  # pyright: ignore  # mistake in pyright
-        if settings.use_experiment_cache
-        else get_standard_experiment_data(task_name=settings.task.task_name),
-    )
-    assert experiment_data is not None
+    if experiment_data is None:
+        experiment_data = (
+            get_experiment_data_cached(task_name=settings.task.task_name)
+            if settings.use_experiment_cache
+            else get_standard_experiment_data(task_name=settings.task.task_name)
+        )
     experiment_data.masked_runner.masked_transformer.freeze_weights()
 
     # stack test_data and validation_data
@@ -99,36 +99,27 @@ def main(settings: ExperimentSettings) -> None:
 
     dummy_input = experiment_data.task_data.test_data[0, ...]
 
-    convex_coefficients = torch.rand(base_input.shape[0], requires_grad=True, device=device)
-    convex_coefficients_patch = torch.rand(base_input.shape[0], requires_grad=True, device=device)
-
-    match settings.optimization_method:
-        case "adam":
-            optimizer = torch.optim.Adam([convex_coefficients, convex_coefficients_patch], lr=settings.adam_lr)
-        case "adamw":
-            optimizer = torch.optim.AdamW([convex_coefficients, convex_coefficients_patch], lr=settings.adam_lr)
-        case "lbfgs":
-            optimizer = torch.optim.LBFGS([convex_coefficients, convex_coefficients_patch], lr=settings.adam_lr)
-            assert settings.noise_schedule == "absent"
-        case _:
-            raise ValueError(f"Unknown optimization method: {settings.optimization_method}")
-
-    match settings.adam_lr_schedule:
-        case "constant":
-            scheduler = None
-        case "step_increase":
-            scheduler = StepLR(optimizer, step_size=100, gamma=2)
-        case "step_decrease":
-            scheduler = StepLR(optimizer, step_size=int(0.1 * settings.num_epochs), gamma=0.5)
-        case "gradient_based":
-            scheduler = GradientBasedAdamLRScheduler(optimizer, base_lr=settings.adam_lr, ceiling_lr=2.0)
-        case "gradient_watching":
-            scheduler = GradientWatchingAdamLRScheduler(optimizer, base_lr=settings.adam_lr)
-        case _:
-            raise NotImplementedError(f"Unknown learning rate schedule: {settings.adam_lr_schedule}")
-
-    artifacts.coefficients_init = convex_coefficients.detach().clone()
-    artifacts.coefficients_init_patch = convex_coefficients_patch.detach().clone()
+    # all restarts are run in one batched forward pass: row r of the coefficients is restart r. Every restart has its
+    # own coefficient tensors, optimizer and learning rate schedule, so that it is optimized as if it ran alone.
+    num_restarts = settings.num_restarts
+    coefficients_per_restart = [
+        row.clone().requires_grad_() for row in torch.rand(num_restarts, base_input.shape[0], device=device)
+    ]
+    coefficients_patch_per_restart = [
+        row.clone().requires_grad_() for row in torch.rand(num_restarts, base_input.shape[0], device=device)
+    ]
+    if settings.optimization_method == "lbfgs":
+        # the line search would couple the restarts
+        assert num_restarts == 1, "LBFGS does not support several restarts"
+    optimizers = [
+        _get_optimizer(settings.optimization_method, [coefficients, coefficients_patch], settings)
+        for coefficients, coefficients_patch in zip(coefficients_per_restart, coefficients_patch_per_restart)
+    ]
+    schedulers = [_get_lr_scheduler(settings.adam_lr_schedule, optimizer, settings) for optimizer in optimizers]
+    optimizer = optimizers[0]  # for LBFGS, which only supports one restart
+
+    artifacts.coefficients_init_all_restarts = torch.stack(coefficients_per_restart).detach().clone()
+    artifacts.coefficients_init_patch_all_restarts = torch.stack(coefficients_patch_per_restart).detach().clone()
 
     temperature = 1.0
 
@@ -142,61 +133,87 @@ def main(settings: ExperimentSettings) -> None:
             torch.nn.init.normal_(experiment_data.masked_runner.masked_transformer.model.blocks[3].mlp.W_in)
             torch.nn.init.normal_(experiment_data.masked_runner.masked_transformer.model.blocks[3].mlp.W_out)
 
-    noise_generator = _get_noise_generator(settings.noise_schedule, convex_coefficients.shape)
+    noise_generator = _get_noise_generator(settings.noise_schedule, (num_restarts, base_input.shape[0]))
+
+    # per-restart early stopping: a restart stops when its loss has not improved for 'early_stopping_patience' epochs
+    best_loss = torch.full((num_restarts,), float("-inf"), device=device)
+    epochs_without_improvement = torch.zeros(num_restarts, dtype=torch.long, device=device)
+    active_restarts = torch.ones(num_restarts, dtype=torch.bool, device=device)
+
+    # in sparse mode, only the examples with the largest coefficients are combined (see masked_runner.sparse_support)
+    support, support_patch = None, None
 
     for i in range(settings.num_epochs):
         if settings.optimization_method != "lbfgs":
-            optimizer.zero_grad()
+            active = active_restarts.nonzero().flatten().tolist()
+            for restart_optimizer in optimizers:
+                restart_optimizer.zero_grad()
+            convex_coefficients = torch.stack(coefficients_per_restart)
+            convex_coefficients_patch = torch.stack(coefficients_patch_per_restart)
+            if settings.sparse_support_k is not None and i % settings.sparse_support_update_period == 0:
+                support = sparse_support(
+                    convex_coefficients, settings.sparse_support_k, settings.sparse_support_epsilon
+                )
+                support_patch = sparse_support(
+                    convex_coefficients_patch, settings.sparse_support_k, settings.sparse_support_epsilon
+                )
             noise, noise_patch = noise_generator.generate_noise(i, settings.num_epochs)
             convex_coefficients_with_noise_and_temp = (convex_coefficients + noise) / temperature
             convex_coefficients_patch_with_noise_and_temp = (convex_coefficients_patch + noise_patch) / temperature
 
-            circuit_output = experiment_data.masked_runner.run_with_linear_combination_of_input_and_patch(
-                input_embedded=base_input_embedded,
-                patch_input_embedded=base_patch_input_embedded,
-                dummy_input=dummy_input,
-                coefficients=convex_coefficients_with_noise_and_temp,
-                coefficients_patch=convex_coefficients_patch_with_noise_and_temp,
-                edges_to_ablate=list(experiment_data.ablated_edges),
-                retain_patch_gradient=True,
-            )
-            full_output = experiment_data.masked_runner.run_with_linear_combination_of_input_and_patch(
-                input_embedded=base_input_embedded,
-                patch_input_embedded=base_patch_input_embedded,
-                dummy_input=dummy_input,
-                coefficients=convex_coefficients_with_noise_and_temp,
-                coefficients_patch=convex_coefficients_patch_with_noise_and_temp,
-                edges_to_ablate=[],
-                retain_patch_gradient=True,
+            masked_runner = experiment_data.masked_runner
+            circuit_output, full_output = (
+                masked_runner.run_circuit_and_full_model_with_linear_combination_of_input_and_patch(
+                    input_embedded=base_input_embedded,
+                    patch_input_embedded=base_patch_input_embedded,
+                    dummy_input=dummy_input,
+                    coefficients=convex_coefficients_with_noise_and_temp,
+                    coefficients_patch=convex_coefficients_patch_with_noise_and_temp,
+                    edges_to_ablate=experiment_data.ablated_edges,
+                    retain_patch_gradient=True,
+                    support=support,
+                    support_patch=support_patch,
+                )
             )
             negative_loss = -1 * experiment_data.loss_fn(
                 circuit_output,
                 full_output,
             )
-            negative_loss.backward()
+            negative_loss.sum().backward()
 
             with torch.no_grad():
-                gradient_norm = torch.norm(convex_coefficients.grad).item()
+                loss = -1 * negative_loss
+                improved = loss > best_loss
+                best_loss = torch.where(improved, loss, best_loss)
+                epochs_without_improvement = torch.where(improved, 0, epochs_without_improvement + 1)
+
+                gradient = torch.stack([coefficients.grad for coefficients in coefficients_per_restart])
+                gradient_patch = torch.stack([coefficients.grad for coefficients in coefficients_patch_per_restart])
+                gradient_norm = gradient.norm(dim=-1)  # per restart, for the gradient-based learning rate schedules
                 wandb.log(
                     {
-                        "loss": -1 * negative_loss,
+                        "loss": loss.max(),
+                        "loss_mean": loss.mean(),
+                        "num_active_restarts": active_restarts.sum().item(),
                         "temperature": temperature,
                         "epoch": i,
-                        "lr": optimizer.param_groups[0]["lr"],
+                        "lr": sum(optimizers[restart].param_groups[0]["lr"] for restart in active) / len(active),
                         "coefficients_entropy": torch.distributions.Categorical(logits=convex_coefficients)
                         .entropy()
+                        .mean()
                         .item(),
                         "coefficients_patch_entropy": torch.distributions.Categorical(logits=convex_coefficients_patch)
                         .entropy()
+                        .mean()
                         .item(),
-                        "gradient_norm": gradient_norm,
-                        "gradient_patch_norm": torch.norm(convex_coefficients_patch.grad).item(),
+                        "gradient_norm": gradient_norm.mean().item(),
+                        "gradient_patch_norm": gradient_patch.norm(dim=-1).mean().item(),
                         "coefficients_norm": torch.norm(convex_coefficients).item(),
                         "coefficients_patch_norm": torch.norm(convex_coefficients_patch).item(),
                         "coefficients_hist": wandb.Histogram(convex_coefficients.detach().cpu()),  # pyright: ignore
                         "coefficients_patch_hist": wandb.Histogram(convex_coefficients_patch.detach().cpu()),  # pyright: ignore
-                        "gradient_hist": wandb.Histogram(convex_coefficients.grad.detach().cpu()),  # pyright: ignore
-                        "gradient_patch_hist": wandb.Histogram(convex_coefficients_patch.grad.detach().cpu()),  # pyright: ignore
+                        "gradient_hist": wandb.Histogram(gradient.cpu()),  # pyright: ignore
+                        "gradient_patch_hist": wandb.Histogram(gradient_patch.cpu()),  # pyright: ignore
                         "noise_kl_div": F.kl_div(
                             convex_coefficients,
                             convex_coefficients_with_noise_and_temp * temperature,
@@ -206,7 +223,9 @@ def main(settings: ExperimentSettings) -> None:
                     }
                 )
 
-            optimizer.step()
+            # the restarts that early stopping stopped are not updated anymore
+            for restart in active:
+                optimizers[restart].step()
 
             match settings.temperature_schedule:
                 case "stable":  # this is stable, then drops linearly in last 80%
@@ -221,61 +240,64 @@ def main(settings: ExperimentSettings) -> None:
                 case "linear":
                     temperature = 0.0001 + 1 - i / settings.num_epochs
 
-            if scheduler is not None:
-                if isinstance(scheduler, GradientAdamLRScheduler):
-                    scheduler.step(gradient_norm)
-                else:
-                    scheduler.step()
-
+            for restart in active:
+                scheduler = schedulers[restart]
+                if scheduler is not None:
+                    if isinstance(scheduler, GradientAdamLRScheduler):
+                        scheduler.step(gradient_norm[restart].item())
+                    else:
+                        scheduler.step()
+
+            # (the coefficients of the restarts that stopped are left as they are)
+            active_coefficients = [coefficients_per_restart[restart] for restart in active] + [
+                coefficients_patch_per_restart[restart] for restart in active
+            ]
             if (
                 settings.coefficient_renormalization == CoefficientRenormalization.halving
             ):  # this is for halving the coefficients; update code while it is running
                 if i % 100 == 0:
                     with torch.no_grad():
-                        convex_coefficients.div_(2.0)
-                        convex_coefficients_patch.div_(2.0)
+                        for coefficients in active_coefficients:
+                            coefficients.div_(2.0)
             elif settings.coefficient_renormalization == CoefficientRenormalization.baseline:
                 if i % 100 == 0:
                     with torch.no_grad():
-                        convex_coefficients.div_(torch.norm(convex_coefficients) / (i / 5))
-                        convex_coefficients_patch.div_(torch.norm(convex_coefficients_patch) / (i / 5))
+                        for coefficients in active_coefficients:
+                            coefficients.div_(torch.norm(coefficients) / (i / 5))
             elif settings.coefficient_renormalization == CoefficientRenormalization.gradual:
                 epoch_period = 10
                 factor = 0.9
                 if i % epoch_period == 0:
                     with torch.no_grad():
-                        convex_coefficients.mul_(factor)
-                        convex_coefficients_patch.mul_(factor)
+                        for coefficients in active_coefficients:
+                            coefficients.mul_(factor)
 
-            logger.info(f"Epoch {i}, loss: {-1 * negative_loss.item()}")
+            logger.info(f"Epoch {i}, loss: {loss.max().item()}")
+
+            if settings.early_stopping_patience is not None:
+                active_restarts &= epochs_without_improvement < settings.early_stopping_patience
+                if not active_restarts.any():
+                    logger.info("All restarts stopped improving after epoch %s", i)
+                    break
 
         elif isinstance(optimizer, torch.optim.LBFGS):
 
             def closure():
                 optimizer.zero_grad()
                 # differences from above: we're not using any noise
-                circuit_output = experiment_data.masked_runner.run_with_linear_combination_of_input_and_patch(
-                    input_embedded=base_input_embedded,
-                    patch_input_embedded=base_patch_input_embedded,
-                    dummy_input=dummy_input,
-                    coefficients=convex_coefficients,
-                    coefficients_patch=convex_coefficients_patch,
-                    edges_to_ablate=list(experiment_data.ablated_edges),
-                    retain_patch_gradient=True,
-                )
-                full_output = experiment_data.masked_runner.run_with_linear_combination_of_input_and_patch(
-                    input_embedded=base_input_embedded,
-                    patch_input_embedded=base_patch_input_embedded,
-                    dummy_input=dummy_input,
-                    coefficients=convex_coefficients,
-                    coefficients_patch=convex_coefficients_patch,
-                    edges_to_ablate=[],
-                    retain_patch_gradient=True,
-                )
-                negative_loss = -1e5 * experiment_data.loss_fn(
-                    circuit_output,
-                    full_output,
+                masked_runner = experiment_data.masked_runner
+                circuit_output, full_output = (
+                    masked_runner.run_circuit_and_full_model_with_linear_combination_of_input_and_patch(
+                        input_embedded=base_input_embedded,
+                        patch_input_embedded=base_patch_input_embedded,
+                        dummy_input=dummy_input,
+                        coefficients=torch.stack(coefficients_per_restart),
+                        coefficients_patch=torch.stack(coefficients_patch_per_restart),
+                        edges_to_ablate=experiment_data.ablated_edges,
+                        retain_patch_gradient=True,
+                    )
                 )
+                negative_loss = -1e5 * experiment_data.loss_fn(circuit_output, full_output).sum()
                 negative_loss.backward()
 
                 return negative_loss.item()
@@ -287,13 +309,71 @@ def main(settings: ExperimentSettings) -> None:
             if i % 10 == 0:
                 logger.info(f"Epoch {i}, loss: {-1e-5 * closure()}")
 
-    artifacts.coefficients_final = convex_coefficients.detach().clone()
-    artifacts.coefficients_final_patch = convex_coefficients_patch.detach().clone()
+    # report the restart whose final coefficients (without noise, and on all examples) give the highest loss
+    convex_coefficients = torch.stack(coefficients_per_restart).detach()
+    convex_coefficients_patch = torch.stack(coefficients_patch_per_restart).detach()
+    with torch.no_grad():
+        circuit_output, full_output = (
+            experiment_data.masked_runner.run_circuit_and_full_model_with_linear_combination_of_input_and_patch(
+                input_embedded=base_input_embedded,
+                patch_input_embedded=base_patch_input_embedded,
+                dummy_input=dummy_input,
+                coefficients=convex_coefficients,
+                coefficients_patch=convex_coefficients_patch,
+                edges_to_ablate=experiment_data.ablated_edges,
+            )
+        )
+        final_losses = experiment_data.loss_fn(circuit_output, full_output)
+    best_restart = final_losses.argmax().item()
+    logger.info("Final losses of the restarts: %s, best restart: %s", final_losses.tolist(), best_restart)
+
+    artifacts.coefficients_init = artifacts.coefficients_init_all_restarts[best_restart]
+    artifacts.coefficients_init_patch = artifacts.coefficients_init_patch_all_restarts[best_restart]
+    artifacts.coefficients_final_all_restarts = convex_coefficients.detach().clone()
+    artifacts.coefficients_final_patch_all_restarts = convex_coefficients_patch.detach().clone()
+    artifacts.coefficients_final = artifacts.coefficients_final_all_restarts[best_restart]
+    artifacts.coefficients_final_patch = artifacts.coefficients_final_patch_all_restarts[best_restart]
+    artifacts.final_losses_all_restarts = final_losses.detach().clone()
     artifacts.save(output_base_dir / "artifacts")
     logger.info("Finished training. Output stored in %s", output_base_dir)
 
     wandb.finish()
 
+    return artifacts
+
+
+def _get_optimizer(
+    optimization_method: str, parameters: list[torch.Tensor], settings: ExperimentSettings
+) -> torch.optim.Optimizer:
+    match optimization_method:
+        case "adam":
+            return torch.optim.Adam(parameters, lr=settings.adam_lr)
+        case "adamw":
+            return torch.optim.AdamW(parameters, lr=settings.adam_lr)
+        case "lbfgs":
+            assert settings.noise_schedule == "absent"
+            return torch.optim.LBFGS(parameters, lr=settings.adam_lr)
+        case _:
+            raise ValueError(f"Unknown optimization method: {optimization_method}")
+
+
+def _get_lr_scheduler(
+    lr_schedule: str, optimizer: torch.optim.Optimizer, settings: ExperimentSettings
+) -> StepLR | GradientAdamLRScheduler | None:
+    match lr_schedule:
+        case "constant":
+            return None
+        case "step_increase":
+            return StepLR(optimizer, step_size=100, gamma=2)
+        case "step_decrease":
+            return StepLR(optimizer, step_size=int(0.1 * settings.num_epochs), gamma=0.5)
+        case "gradient_based":
+            return GradientBasedAdamLRScheduler(optimizer, base_lr=settings.adam_lr, ceiling_lr=2.0)
+        case "gradient_watching":
+            return GradientWatchingAdamLRScheduler(optimizer, base_lr=settings.adam_lr)
+        case _:
+            raise NotImplementedError(f"Unknown learning rate schedule: {lr_schedule}")
+
 
 def _get_noise_generator(noise_schedule: str, shape: tuple[int, ...]) -> ScheduledNoiseGenerator:
     match noise_schedule:
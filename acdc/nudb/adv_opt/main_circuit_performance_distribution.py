@@ -1,22 +1,23 @@
 import json
 import logging
 import random
-import typing
 from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
+from typing import Iterable, Iterator
 
 import hydra
 import torch
 import torch.utils.data
 from hydra.core import hydra_config
 from hydra.core.config_store import ConfigStore
-from jaxtyping import Float
+from jaxtyping import Float, Integer
 from tqdm import tqdm
 
 from acdc.nudb.adv_opt.data_fetchers import AdvOptExperimentData, AdvOptTaskName, get_standard_experiment_data
 from acdc.nudb.adv_opt.edge_serdes import EdgeJSONDecoder, EdgeJSONEncoder
 from acdc.nudb.adv_opt.settings import TaskSpecificSettings, TracrReverseTaskSpecificSettings
+from acdc.nudb.adv_opt.streaming_summary import StreamingMetricSummary
 from acdc.nudb.adv_opt.utils import device
 from acdc.TLACDCEdge import Edge
 
@@ -40,6 +41,14 @@ class BruteForceExperimentSettings:
     circuits: list[CirctuitType] = field(
         default_factory=lambda: [CirctuitType.RANDOM, CirctuitType.CANONICAL, CirctuitType.CORRUPTED_CANONICAL]
     )
+    # If True, only keep a summary of the metrics of every circuit (see StreamingMetricSummary), instead of the
+    # metrics for all pairs; the memory then doesn't grow with the number of pairs.
+    streaming: bool = False
+    streaming_top_k: int = 100
+    streaming_histogram_min: float = 0.0
+    streaming_histogram_max: float = 10.0
+    streaming_histogram_num_bins: int = 100
+    streaming_spill_metrics: bool = False  # also write the metrics for all pairs to disk
 
 
 cs = ConfigStore.instance()
@@ -50,6 +59,71 @@ cs.store(group="task", name="greaterthan_schema", node=TaskSpecificSettings)
 cs.store(group="task", name="tracr_reverse_schema", node=TracrReverseTaskSpecificSettings)
 
 
+class InputPatchPairDataset(torch.utils.data.Dataset):
+    """Pairs of an input and a patch input, without materializing them: pair k is
+    (inputs[input_index], patch_inputs[patch_index]) with (input_index, patch_index) = pair_indices(k).
+
+    With 'cartesian_product', these are all pairs of inputs and patch inputs, ordered by patch input (pair k is
+    (k % len(inputs), k // len(inputs))); otherwise, input i is paired with patch input i.
+
+    The dataset is indexed by a range of pairs, which gives a whole batch at once; see `data_loader`.
+    If all pairs in a batch have the same patch input, the patch input of the batch is that single patch input
+    (batch size 1), so that its ablation cache can be reused for all inputs.
+    """
+
+    def __init__(
+        self,
+        inputs: Integer[torch.Tensor, "input pos"],
+        patch_inputs: Integer[torch.Tensor, "patch_input pos"],
+        cartesian_product: bool,
+    ):
+        assert cartesian_product or len(inputs) == len(patch_inputs)
+        self.inputs = inputs
+        self.patch_inputs = patch_inputs
+        self.cartesian_product = cartesian_product
+
+    def __len__(self) -> int:
+        return len(self.inputs) * len(self.patch_inputs) if self.cartesian_product else len(self.inputs)
+
+    def pair_indices(self, pairs: range | None = None) -> Integer[torch.Tensor, "pair 2"]:
+        """The (input index, patch index) of 'pairs' (default: all pairs)."""
+        pairs = range(len(self)) if pairs is None else pairs
+        k = torch.arange(pairs.start, pairs.stop, device=self.inputs.device)
+        if not self.cartesian_product:
+            return torch.stack([k, k], dim=-1)
+        return torch.stack([k % len(self.inputs), k // len(self.inputs)], dim=-1)
+
+    def __getitem__(
+        self, pairs: range
+    ) -> tuple[Integer[torch.Tensor, "batch pos"], Integer[torch.Tensor, "batch pos"]]:
+        input_indices, patch_indices = self.pair_indices(pairs).unbind(dim=-1)
+        if (patch_indices == patch_indices[0]).all():
+            patch_indices = patch_indices[:1]
+        return self.inputs[input_indices], self.patch_inputs[patch_indices]
+
+    def batches(self, batch_size: int) -> list[range]:
+        """Ranges of at most 'batch_size' consecutive pairs. For a Cartesian product, every batch has a single patch
+        input if 'batch_size' is smaller than the number of inputs, and otherwise all pairs of whole patch inputs."""
+        if not self.cartesian_product:
+            return [range(start, min(start + batch_size, len(self))) for start in range(0, len(self), batch_size)]
+        num_inputs = len(self.inputs)
+        if batch_size < num_inputs:
+            return [
+                range(patch_start + start, patch_start + min(start + batch_size, num_inputs))
+                for patch_start in range(0, len(self), num_inputs)
+                for start in range(0, num_inputs, batch_size)
+            ]
+        # whole patch inputs per batch
+        step = (batch_size // num_inputs) * num_inputs
+        return [range(start, min(start + step, len(self))) for start in range(0, len(self), step)]
+
+    def data_loader(
+        self, batch_size: int
+    ) -> torch.utils.data.DataLoader[tuple[Integer[torch.Tensor, "batch pos"], Integer[torch.Tensor, "batch pos"]]]:
+        """Batches in the order of the pairs, so the metrics for the batches can be concatenated."""
+        return torch.utils.data.DataLoader(self, batch_size=None, sampler=self.batches(batch_size))
+
+
 @dataclass
 class CircuitPerformanceDistributionExperiment:
     """A class to run a circuit performance distribution experiment.
@@ -63,12 +137,12 @@ class CircuitPerformanceDistributionExperiment:
     def calculate_circuit_performance_for_large_sample(
         self,
         circuit: list[Edge],
-        data_loader: torch.utils.data.DataLoader[
+        data_loader: Iterable[
             tuple[
                 Float[torch.Tensor, "batch pos vocab"],
                 Float[torch.Tensor, "batch pos vocab"],
             ]
-        ],  # tuples of (input, patch_input)
+        ],  # tuples of (input, patch_input); the patch input may have batch size 1, if it's the same for all inputs
     ) -> Float[torch.Tensor, " batch"]:
         """
         Run and calculate an individual circuit performance metrics for each input in `test_data`.
@@ -80,29 +154,71 @@ class CircuitPerformanceDistributionExperiment:
         Otherwise, the average metric will be calculated across all sequence positions.
 
         """
+        return self.calculate_circuit_performances_for_large_sample({"circuit": circuit}, data_loader)["circuit"]
 
-        def process_batch(
-            batch: tuple[Float[torch.Tensor, "batch pos vocab"], Float[torch.Tensor, "batch pos vocab"]],
-        ) -> Float[torch.Tensor, " batch"]:
-            input, patch_input = batch
+    def calculate_circuit_performances_for_large_sample(
+        self,
+        circuits: dict[str, list[Edge]],
+        data_loader: Iterable[
+            tuple[
+                Float[torch.Tensor, "batch pos vocab"],
+                Float[torch.Tensor, "batch pos vocab"],
+            ]
+        ],  # tuples of (input, patch_input); the patch input may have batch size 1, if it's the same for all inputs
+    ) -> dict[str, Float[torch.Tensor, " batch"]]:
+        """Like `calculate_circuit_performance_for_large_sample`, for several circuits at once.
 
-            masked_output_logits: Float[torch.Tensor, "batch pos vocab"] = self.experiment_data.masked_runner.run(
-                input=input,
-                patch_input=patch_input,
-                edges_to_ablate=list(self.experiment_data.masked_runner.all_ablatable_edges - set(circuit)),
-            )
-            base_output_logits: Float[torch.Tensor, "batch pos vocab"] = self.experiment_data.masked_runner.run(
-                input=input,
-                patch_input=patch_input,
-                edges_to_ablate=[],
-            )
+        The output of the full model is the same for every circuit, so it's calculated only once per batch and then
+        compared with the output of every circuit. If the metric only looks at the last sequence position, only the
+        log probabilities for that position are kept."""
+        metrics_per_batch = list(self._circuit_performances_per_batch(circuits, data_loader))
+        return {name: torch.cat([metrics[name] for metrics in metrics_per_batch]) for name in circuits}
 
-            return self.experiment_data.loss_fn(
-                base_output_logits,
-                masked_output_logits,
+    def summarize_circuit_performances(
+        self,
+        circuits: dict[str, list[Edge]],
+        dataset: InputPatchPairDataset,
+        batch_size: int,
+        summaries: dict[str, StreamingMetricSummary],
+    ) -> None:
+        """Like `calculate_circuit_performances_for_large_sample`, but instead of returning the metrics for all pairs,
+        adds them to 'summaries' (one for every circuit) batch by batch, so that the memory doesn't grow with the
+        number of pairs."""
+        metrics_per_batch = self._circuit_performances_per_batch(circuits, dataset.data_loader(batch_size))
+        for pairs, metrics in zip(dataset.batches(batch_size), metrics_per_batch):
+            for name, metrics_for_circuit in metrics.items():
+                summaries[name].update(metrics_for_circuit, dataset.pair_indices(pairs))
+
+    def _circuit_performances_per_batch(
+        self,
+        circuits: dict[str, list[Edge]],
+        data_loader: Iterable[tuple[Float[torch.Tensor, "batch pos vocab"], Float[torch.Tensor, "batch pos vocab"]]],
+    ) -> Iterator[dict[str, Float[torch.Tensor, " batch"]]]:
+        masked_runner = self.experiment_data.masked_runner
+        last_sequence_position_only = self.experiment_data.metric_last_sequence_position_only
+        # the same for every batch, so that the masked runner only compiles them once
+        edges_to_ablate_per_circuit = {
+            name: masked_runner.all_ablatable_edges - set(circuit) for name, circuit in circuits.items()
+        }
+
+        def compact(logits: Float[torch.Tensor, "batch pos vocab"]) -> Float[torch.Tensor, "batch pos vocab"]:
+            return logits[:, -1:, :] if last_sequence_position_only else logits
+
+        for input, patch_input in tqdm(data_loader):
+            # the loss function takes the log softmax of the logits, which doesn't change log probabilities
+            base_output_logprobs: Float[torch.Tensor, "batch pos vocab"] = torch.log_softmax(
+                compact(masked_runner.run(input=input, patch_input=patch_input, edges_to_ablate=[])), dim=-1
             )
 
-        return torch.cat([process_batch(batch) for batch in tqdm(data_loader)])
+            metrics = {}
+            for name, edges_to_ablate in edges_to_ablate_per_circuit.items():
+                masked_output_logits: Float[torch.Tensor, "batch pos vocab"] = masked_runner.run(
+                    input=input,
+                    patch_input=None,  # the ablation cache for patch_input has been calculated above
+                    edges_to_ablate=edges_to_ablate,
+                )
+                metrics[name] = self.experiment_data.loss_fn(base_output_logprobs, compact(masked_output_logits))
+            yield metrics
 
     def random_circuit(self) -> list[Edge]:
         """TODO: this can be made smarter; e.g., we probably don't want to leave dangling nodes."""
@@ -117,11 +233,27 @@ class CircuitPerformanceDistributionExperiment:
 
 @dataclass
 class CircuitPerformanceDistributionResults:
+    """metrics[circuit][k] is the metric for the pair of input test_data[pair_indices[k, 0]] and patch input
+    test_patch_data[pair_indices[k, 1]]."""
+
     experiment_name: AdvOptTaskName
-    metrics: dict[str, Float[torch.Tensor, " batch"]]
+    metrics: dict[str, Float[torch.Tensor, " batch"]]  # empty for streaming experiments
     test_data: Float[torch.Tensor, "batch pos vocab"]
     test_patch_data: Float[torch.Tensor, "batch pos vocab"]
     random_circuit: list[Edge]
+    pair_indices: Integer[torch.Tensor, "batch 2"]
+    # for streaming experiments, which don't have the metrics for all pairs
+    summaries: dict[str, StreamingMetricSummary] = field(default_factory=dict)
+
+    def inputs(self, indices: Integer[torch.Tensor, " n"]) -> Float[torch.Tensor, "n pos vocab"]:
+        """The inputs of the pairs with the given indices (in the metrics)."""
+        return self.test_data[self.pair_indices[indices.to(self.pair_indices.device), 0].to(self.test_data.device)]
+
+    def patch_inputs(self, indices: Integer[torch.Tensor, " n"]) -> Float[torch.Tensor, "n pos vocab"]:
+        """The patch inputs of the pairs with the given indices (in the metrics)."""
+        return self.test_patch_data[
+            self.pair_indices[indices.to(self.pair_indices.device), 1].to(self.test_patch_data.device)
+        ]
 
     def save(self, artifact_dir: Path):
         artifact_dir.mkdir()
@@ -129,6 +261,9 @@ class CircuitPerformanceDistributionResults:
             torch.save(value, artifact_dir / f"metrics_{key}.pt")
         torch.save(self.test_data, artifact_dir / "test_data.pt")
         torch.save(self.test_patch_data, artifact_dir / "test_patch_data.pt")
+        torch.save(self.pair_indices, artifact_dir / "pair_indices.pt")
+        for key, summary in self.summaries.items():
+            summary.save(artifact_dir / f"summary_{key}.pt")
         (artifact_dir / "random_circuit.json").write_text(json.dumps(self.random_circuit, cls=EdgeJSONEncoder))
 
     @classmethod
@@ -136,6 +271,7 @@ class CircuitPerformanceDistributionResults:
         cls, artifact_dir: Path, experiment_name: AdvOptTaskName, append_exp_name_to_dir: bool = True
     ) -> "CircuitPerformanceDistributionResults":
         storage_dir = artifact_dir / experiment_name if append_exp_name_to_dir else artifact_dir
+        test_data = torch.load(storage_dir / "test_data.pt", map_location=device)
 
         return cls(
             experiment_name=experiment_name,
@@ -145,14 +281,29 @@ class CircuitPerformanceDistributionResults:
                 for filename in storage_dir.glob("metrics_*.pt")
                 if (key := filename.stem.removeprefix("metrics_"))
             },  # torch.load(storage_dir / "metrics.pt"),
-            test_data=torch.load(storage_dir / "test_data.pt", map_location=device),
+            test_data=test_data,
             test_patch_data=torch.load(storage_dir / "test_patch_data.pt", map_location=device),
             random_circuit=json.loads((storage_dir / "random_circuit.json").read_text(), cls=EdgeJSONDecoder),
+            # older results stored every pair in test_data and test_patch_data
+            pair_indices=(
+                torch.load(storage_dir / "pair_indices.pt")
+                if (storage_dir / "pair_indices.pt").exists()
+                else torch.arange(len(test_data)).unsqueeze(-1).expand(-1, 2)
+            ),
+            summaries={
+                filename.stem.removeprefix("summary_"): StreamingMetricSummary.load(filename)
+                for filename in storage_dir.glob("summary_*.pt")
+            },
         )
 
     def print(self):
         print(f"Experiment: {self.experiment_name}")
         print(f"Metrics: {self.metrics}")
+        for key, summary in self.summaries.items():
+            print(
+                f"Summary for {key}: {summary.count} pairs, mean {summary.mean}, variance {summary.variance}, "
+                f"max {summary.max}, top {summary.k}: {summary.top_values}"
+            )
         # print(f"Topk most adversarial values: {self.topk_most_adversarial_values}")
         # print(f"Topk most adversarial inputs: {self.topk_most_adversarial_input}")
 
@@ -169,31 +320,12 @@ def main(
 
     experiment = CircuitPerformanceDistributionExperiment(experiment_data=get_standard_experiment_data(experiment_name))
 
-    def create_cartesian_product(
-        test_data: torch.Tensor, test_patch_data: torch.Tensor
-    ) -> tuple[torch.Tensor, torch.Tensor]:
-        return (
-            torch.repeat_interleave(test_data, len(test_patch_data), dim=0),
-            torch.cat(len(test_data) * [test_patch_data]),
-        )
-
-    test_data, test_patch_data = (
-        (experiment.experiment_data.task_data.test_data, experiment.experiment_data.task_data.test_patch_data)
-        if not settings.optimize_over_patch_data
-        else create_cartesian_product(
-            experiment.experiment_data.task_data.test_data, experiment.experiment_data.task_data.test_patch_data
-        )
-    )
-
-    data_loader = typing.cast(
-        torch.utils.data.DataLoader[
-            tuple[Float[torch.Tensor, "batch pos vocab"], Float[torch.Tensor, "batch pos vocab"]]
-        ],
-        torch.utils.data.DataLoader(
-            dataset=torch.utils.data.TensorDataset(test_data, test_patch_data),
-            batch_size=settings.batch_size,
-        ),
+    dataset = InputPatchPairDataset(
+        experiment.experiment_data.task_data.test_data,
+        experiment.experiment_data.task_data.test_patch_data,
+        cartesian_product=settings.optimize_over_patch_data,
     )
+    data_loader = dataset.data_loader(settings.batch_size)
 
     collected_metrics: dict[str, Float[torch.Tensor, " batch"]] = {}
 
@@ -212,22 +344,39 @@ def main(
             case _:
                 raise ValueError(f"Unknown circuit type: {circuit_type}")
 
-    for circuit in settings.circuits:
-        logger.info(f"Running with circuit {circuit}")
-        metrics_for_circuit = experiment.calculate_circuit_performance_for_large_sample(
-            circuit=get_circuit_edges(circuit),
-            data_loader=data_loader,
-        ).to("cpu")
-        # regarding '.to("cpu")': torch.histogram does not work for CUDA, so moving to CPU
-        # see https://github.com/pytorch/pytorch/issues/69519
-        collected_metrics[circuit] = metrics_for_circuit
+    logger.info(f"Running with circuits {settings.circuits}")
+    # all circuits at once, so that the output of the full model is only calculated once for every batch
+    circuits = {circuit: get_circuit_edges(circuit) for circuit in settings.circuits}
+    summaries: dict[str, StreamingMetricSummary] = {}
+    if settings.streaming:
+        summaries = {
+            circuit: StreamingMetricSummary(
+                k=settings.streaming_top_k,
+                histogram_range=(settings.streaming_histogram_min, settings.streaming_histogram_max),
+                num_bins=settings.streaming_histogram_num_bins,
+                spill_dir=output_base_dir / f"spilled_metrics_{circuit}" if settings.streaming_spill_metrics else None,
+            )
+            for circuit in circuits
+        }
+        experiment.summarize_circuit_performances(circuits, dataset, settings.batch_size, summaries)
+    else:
+        metrics_per_circuit = experiment.calculate_circuit_performances_for_large_sample(circuits, data_loader)
+        for circuit, metrics_for_circuit in metrics_per_circuit.items():
+            # regarding '.to("cpu")': torch.histogram does not work for CUDA, so moving to CPU
+            # see https://github.com/pytorch/pytorch/issues/69519
+            collected_metrics[circuit] = metrics_for_circuit.to("cpu")
 
     results = CircuitPerformanceDistributionResults(
         experiment_name=experiment_name,
         metrics=collected_metrics,
-        test_data=test_data,
-        test_patch_data=test_patch_data,
+        test_data=dataset.inputs,
+        test_patch_data=dataset.patch_inputs,
         random_circuit=random_circuit,
+        # for streaming experiments, the pair indices are in the summaries
+        pair_indices=(
+            dataset.pair_indices().to("cpu") if not settings.streaming else torch.empty((0, 2), dtype=torch.long)
+        ),
+        summaries=summaries,
     )
 
     results.save(artifact_dir)
@@ -0,0 +1,310 @@
+import logging
+import random
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Collection
+
+import hydra
+import torch
+import torch.nn.functional as F
+from hydra.core import hydra_config
+from hydra.core.config_store import ConfigStore
+from jaxtyping import Bool, Float, Integer
+
+from acdc.nudb.adv_opt.data_fetchers import AdvOptExperimentData, AdvOptTaskName, get_standard_experiment_data
+from acdc.nudb.adv_opt.experiment_data_cache import get_experiment_data_cached
+from acdc.nudb.adv_opt.settings import TaskSpecificSettings, TracrReverseTaskSpecificSettings
+from acdc.nudb.adv_opt.utils import device
+from acdc.TLACDCEdge import Edge
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TokenSearchExperimentSettings:
+    """Settings for the discrete search for inputs on which the canonical circuit differs most from the model."""
+
+    task: TaskSpecificSettings
+    num_rounds: int = 100
+    beam_width: int = 16  # number of inputs that are kept after every round
+    num_candidates: int = 256  # number of mutated inputs that are scored in every round
+    top_k_tokens: int = 32  # the candidates for a position are drawn from the tokens with the largest gradient
+    batch_size: int = 256  # inputs per forward pass (every input is run through the circuit and the full model)
+    use_experiment_cache: bool = False
+    random_seed: int | None = None
+
+
+cs = ConfigStore.instance()
+cs.store(name="config_schema", node=TokenSearchExperimentSettings)
+cs.store(group="task", name="greaterthan_schema", node=TaskSpecificSettings)
+cs.store(group="task", name="tracr_reverse_schema", node=TracrReverseTaskSpecificSettings)
+
+
+@dataclass
+class TokenConstraints:
+    """Which sequences the search may produce: position i may only have the tokens in allowed_tokens[i], and
+    'is_valid' (if given) decides which sequences are valid for the task."""
+
+    allowed_tokens: Bool[torch.Tensor, "pos vocab"]
+    is_valid: Callable[[Integer[torch.Tensor, "batch pos"]], Bool[torch.Tensor, " batch"]] | None = None
+
+    @classmethod
+    def from_examples(
+        cls,
+        examples: Integer[torch.Tensor, "batch pos"],
+        d_vocab: int,
+        is_valid: Callable[[Integer[torch.Tensor, "batch pos"]], Bool[torch.Tensor, " batch"]] | None = None,
+    ) -> "TokenConstraints":
+        """Allows the tokens that occur at a position in 'examples' at that position. This keeps the tokens that
+        are the same in all examples (e.g. the template of a task) fixed."""
+        allowed_tokens = torch.zeros(examples.shape[1], d_vocab, dtype=torch.bool, device=examples.device)
+        allowed_tokens[torch.arange(examples.shape[1], device=examples.device).expand_as(examples), examples] = True
+        return cls(allowed_tokens=allowed_tokens, is_valid=is_valid)
+
+    @property
+    def mutable_positions(self) -> Integer[torch.Tensor, " mutable_pos"]:
+        return torch.nonzero(self.allowed_tokens.sum(dim=-1) > 1).squeeze(-1)
+
+    def filter(self, sequences: Integer[torch.Tensor, "batch pos"]) -> Bool[torch.Tensor, " batch"]:
+        """Whether each sequence satisfies the constraints."""
+        positions = torch.arange(sequences.shape[1], device=sequences.device).expand_as(sequences)
+        valid = self.allowed_tokens[positions, sequences].all(dim=-1)
+        if self.is_valid is not None:
+            valid &= self.is_valid(sequences)
+        return valid
+
+
+@dataclass
+class TokenSearchResults:
+    """The 'beam_width' most adversarial (input, patch input) pairs that were found, with the most adversarial
+    first; loss_history[i] is the highest loss after round i (round 0 is the loss on the task's own data)."""
+
+    experiment_name: AdvOptTaskName
+    inputs: Integer[torch.Tensor, "beam pos"]
+    patch_inputs: Integer[torch.Tensor, "beam pos"]
+    losses: Float[torch.Tensor, " beam"]
+    loss_history: Float[torch.Tensor, " round"]
+    num_evaluated: int
+
+    def save(self, artifact_dir: Path):
+        artifact_dir.mkdir()
+        torch.save(self.inputs, artifact_dir / "inputs.pt")
+        torch.save(self.patch_inputs, artifact_dir / "patch_inputs.pt")
+        torch.save(self.losses, artifact_dir / "losses.pt")
+        torch.save(self.loss_history, artifact_dir / "loss_history.pt")
+        (artifact_dir / "num_evaluated.txt").write_text(str(self.num_evaluated))
+
+    @classmethod
+    def load(cls, artifact_dir: Path, experiment_name: AdvOptTaskName) -> "TokenSearchResults":
+        return cls(
+            experiment_name=experiment_name,
+            inputs=torch.load(artifact_dir / "inputs.pt", map_location=device),
+            patch_inputs=torch.load(artifact_dir / "patch_inputs.pt", map_location=device),
+            losses=torch.load(artifact_dir / "losses.pt", map_location=device),
+            loss_history=torch.load(artifact_dir / "loss_history.pt", map_location=device),
+            num_evaluated=int((artifact_dir / "num_evaluated.txt").read_text()),
+        )
+
+    def print(self):
+        print(f"Experiment: {self.experiment_name}")
+        print(f"Evaluated {self.num_evaluated} inputs; highest loss per round: {self.loss_history}")
+        print(f"Losses of the most adversarial inputs: {self.losses}")
+
+
+class TokenSearchExperiment:
+    """A beam search over token substitutions in the inputs, guided by the gradient of the loss with respect to the
+    one-hot encoding of the input tokens (as in greedy coordinate gradient search).
+
+    In every round, the gradient for the inputs in the beam gives the 'top_k_tokens' most promising substitutions
+    for every position; 'num_candidates' inputs are made by doing one of those substitutions in an input in the beam,
+    and they are scored in batches, with the circuit and the full model in the same forward pass. The beam then
+    keeps the inputs with the highest loss among the old beam and the candidates. The patch input of a candidate is
+    that of the input it was made from."""
+
+    def __init__(
+        self,
+        experiment_data: AdvOptExperimentData,
+        constraints: TokenConstraints,
+        batch_size: int = 256,
+        edges_to_ablate: Collection[Edge] | None = None,
+    ):
+        self.experiment_data = experiment_data
+        self.constraints = constraints
+        self.batch_size = batch_size
+        self.edges_to_ablate = experiment_data.ablated_edges if edges_to_ablate is None else edges_to_ablate
+
+    def _circuit_and_full_model_losses(
+        self, output: Float[torch.Tensor, "circuit batch pos vocab"]
+    ) -> Float[torch.Tensor, " batch"]:
+        return self.experiment_data.loss_fn(output[1], output[0])
+
+    @torch.no_grad()
+    def losses(
+        self, inputs: Integer[torch.Tensor, "batch pos"], patch_inputs: Integer[torch.Tensor, "batch pos"]
+    ) -> Float[torch.Tensor, " batch"]:
+        """The loss between the full model and the circuit for every pair of an input and a patch input."""
+        masked_runner = self.experiment_data.masked_runner
+        losses = []
+        for start in range(0, len(inputs), self.batch_size):
+            output = masked_runner.run_many(
+                inputs[start : start + self.batch_size],
+                patch_inputs[start : start + self.batch_size],
+                [self.edges_to_ablate, []],
+            )
+            losses.append(self._circuit_and_full_model_losses(output))
+        return torch.cat(losses) if losses else torch.empty(0, device=inputs.device)
+
+    def token_gradients(
+        self, inputs: Integer[torch.Tensor, "batch pos"], patch_inputs: Integer[torch.Tensor, "batch pos"]
+    ) -> Float[torch.Tensor, "batch pos vocab"]:
+        """The gradient of the loss with respect to the one-hot encoding of 'inputs'."""
+        masked_runner = self.experiment_data.masked_runner
+        W_E = masked_runner.masked_transformer.model.W_E
+        one_hot = F.one_hot(inputs, W_E.shape[0]).to(W_E.dtype).requires_grad_(True)
+        embedded = one_hot @ W_E
+
+        # calculate the ablation cache before adding the hook, which should only change the inputs (no gradient is
+        # needed for the patch inputs, so the cache of earlier rounds of the search is reused)
+        masked_runner._calculate_and_store_ablation_cache(patch_inputs)
+        with masked_runner.hooks(
+            fwd_hooks=[
+                ("hook_embed", lambda hook_point_out, hook: embedded.repeat(len(hook_point_out) // len(embedded), 1, 1))
+            ]
+        ):
+            output = masked_runner.run_many(inputs, None, [self.edges_to_ablate, []])
+        (gradient,) = torch.autograd.grad(self._circuit_and_full_model_losses(output).sum(), one_hot)
+        return gradient
+
+    def candidates(
+        self,
+        beam: Integer[torch.Tensor, "beam pos"],
+        gradients: Float[torch.Tensor, "beam pos vocab"],
+        num_candidates: int,
+        top_k_tokens: int,
+        generator: torch.Generator | None = None,
+    ) -> tuple[Integer[torch.Tensor, "candidate pos"], Integer[torch.Tensor, " candidate"]]:
+        """Inputs that differ from an input in the beam in a single position, and the index of that input in the
+        beam. Only inputs that satisfy the constraints are returned."""
+        mutable_positions = self.constraints.mutable_positions
+        top_tokens = (
+            gradients.masked_fill(~self.constraints.allowed_tokens, float("-inf"))
+            .topk(min(top_k_tokens, gradients.shape[-1]), dim=-1)
+            .indices
+        )
+
+        parents = torch.arange(num_candidates, device=beam.device) % len(beam)
+        positions = mutable_positions[
+            torch.randint(len(mutable_positions), (num_candidates,), generator=generator).to(beam.device)
+        ]
+        choices = torch.randint(top_tokens.shape[-1], (num_candidates,), generator=generator).to(beam.device)
+        candidates = beam[parents].clone()
+        candidates[torch.arange(num_candidates, device=beam.device), positions] = top_tokens[
+            parents, positions, choices
+        ]
+
+        valid = self.constraints.filter(candidates) & (candidates != beam[parents]).any(dim=-1)
+        return candidates[valid], parents[valid]
+
+    def search(
+        self,
+        inputs: Integer[torch.Tensor, "batch pos"],
+        patch_inputs: Integer[torch.Tensor, "batch pos"],
+        num_rounds: int,
+        beam_width: int,
+        num_candidates: int,
+        top_k_tokens: int,
+        generator: torch.Generator | None = None,
+    ) -> TokenSearchResults:
+        """Starts from the 'beam_width' most adversarial pairs (inputs[i], patch_inputs[i])."""
+        losses = self.losses(inputs, patch_inputs)
+        num_evaluated = len(inputs)
+        beam_losses, beam_indices = losses.topk(min(beam_width, len(losses)))
+        beam, beam_patch = inputs[beam_indices], patch_inputs[beam_indices]
+        loss_history = [beam_losses[0].item()]
+
+        for round_index in range(num_rounds):
+            gradients = self.token_gradients(beam, beam_patch)
+            candidates, parents = self.candidates(beam, gradients, num_candidates, top_k_tokens, generator)
+            candidate_losses = self.losses(candidates, beam_patch[parents])
+            num_evaluated += len(candidates)
+
+            beam, beam_patch, beam_losses = self._best_unique(
+                torch.cat([beam, candidates]),
+                torch.cat([beam_patch, beam_patch[parents]]),
+                torch.cat([beam_losses, candidate_losses]),
+                beam_width,
+            )
+            loss_history.append(beam_losses[0].item())
+            logger.info("Round %s: highest loss %s, evaluated %s inputs", round_index, loss_history[-1], num_evaluated)
+
+        return TokenSearchResults(
+            experiment_name=self.experiment_data.task_name,
+            inputs=beam,
+            patch_inputs=beam_patch,
+            losses=beam_losses,
+            loss_history=torch.tensor(loss_history),
+            num_evaluated=num_evaluated,
+        )
+
+    @staticmethod
+    def _best_unique(
+        inputs: Integer[torch.Tensor, "batch pos"],
+        patch_inputs: Integer[torch.Tensor, "batch pos"],
+        losses: Float[torch.Tensor, " batch"],
+        k: int,
+    ) -> tuple[Integer[torch.Tensor, "k pos"], Integer[torch.Tensor, "k pos"], Float[torch.Tensor, " k"]]:
+        """The k pairs with the highest losses, without duplicates (which would make the beam collapse)."""
+        seen, keep = set(), []
+        for index in losses.argsort(descending=True).tolist():
+            key = (tuple(inputs[index].tolist()), tuple(patch_inputs[index].tolist()))
+            if key not in seen:
+                seen.add(key)
+                keep.append(index)
+                if len(keep) == k:
+                    break
+        return inputs[keep], patch_inputs[keep], losses[keep]
+
+
+@hydra.main(config_path="conf", config_name="config_token_search", version_base=None)
+def main(settings: TokenSearchExperimentSettings) -> TokenSearchResults:
+    if settings.random_seed is not None:
+        torch.manual_seed(settings.random_seed)
+        random.seed(settings.random_seed)
+
+    experiment_name = settings.task.task_name
+    output_base_dir = Path(hydra_config.HydraConfig.get().runtime.output_dir)
+    logger.info("Starting token search for '%s'; storing output in %s", experiment_name, output_base_dir)
+
+    experiment_data = (
+        get_experiment_data_cached(experiment_name)
+        if settings.use_experiment_cache
+        else get_standard_experiment_data(experiment_name)
+    )
+    experiment_data.masked_runner.masked_transformer.freeze_weights()
+    test_data = experiment_data.task_data.test_data
+    experiment = TokenSearchExperiment(
+        experiment_data,
+        TokenConstraints.from_examples(test_data, experiment_data.masked_runner.masked_transformer.model.cfg.d_vocab),
+        batch_size=settings.batch_size,
+    )
+
+    results = experiment.search(
+        test_data,
+        experiment_data.task_data.test_patch_data,
+        num_rounds=settings.num_rounds,
+        beam_width=settings.beam_width,
+        num_candidates=settings.num_candidates,
+        top_k_tokens=settings.top_k_tokens,
+    )
+    results.save(output_base_dir / "artifacts")
+    results.print()
+
+    logger.info("Output stored in %s", output_base_dir)
+
+    return results
+
+
+if __name__ == "__main__":
+    logger.info("Using device %s", device)
+
+    main()
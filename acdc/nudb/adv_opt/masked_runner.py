@@ -1,16 +1,51 @@
+import collections
+import hashlib
 import itertools
 from contextlib import contextmanager
 from functools import cached_property
-from typing import Callable, Iterator
+from typing import Callable, Collection, Iterator, Sequence
 
 import torch
 from jaxtyping import Float, Integer, Num
 from transformer_lens import HookedTransformer
+from transformer_lens.ActivationCache import ActivationCache
 from transformer_lens.hook_points import HookPoint
 
 from acdc.TLACDCEdge import Edge, HookPointName, IndexedHookPointName
 from subnetwork_probing.masked_transformer import CircuitStartingPointType, EdgeLevelMaskedTransformer
 
+# (shape, dtype, device, hash of the contents) of a patch input
+PatchInputFingerprint = tuple[tuple[int, ...], torch.dtype, torch.device, bytes]
+
+
+def convex_combination(
+    coefficients: Num[torch.Tensor, "*restart batch"],
+    embedded: Float[torch.Tensor, "batch pos d_resid"],
+    support: Integer[torch.Tensor, "*restart k"] | None = None,
+) -> Float[torch.Tensor, "*restart pos d_resid"]:
+    """The convex combination of 'embedded' with weights softmax('coefficients').
+
+    If 'support' is given (see `sparse_support`), only the examples at those indices are combined, with the softmax
+    taken over their coefficients only. This costs O(k) instead of O(batch) in the forward and the backward pass,
+    and the other coefficients get no gradient."""
+    if support is None:
+        return torch.einsum("... b, b p d -> ... p d", [torch.nn.functional.softmax(coefficients, dim=-1), embedded])
+    return torch.einsum(
+        "... k, ... k p d -> ... p d",
+        [torch.nn.functional.softmax(coefficients.gather(-1, support), dim=-1), embedded[support]],
+    )
+
+
+@torch.no_grad()
+def sparse_support(
+    coefficients: Num[torch.Tensor, "*restart batch"], k: int, epsilon: float = 0.0
+) -> Integer[torch.Tensor, "*restart k_or_more"]:
+    """The indices of the 'k' largest coefficients, and of all coefficients whose softmax weight is above 'epsilon'.
+    With a leading 'restart' dimension, all restarts get the same number of indices: the most any restart needs."""
+    weights = torch.nn.functional.softmax(coefficients, dim=-1)
+    num_above_epsilon = int((weights > epsilon).sum(dim=-1).max().item()) if epsilon > 0 else 0
+    return torch.topk(weights, k=min(max(k, num_above_epsilon), weights.shape[-1]), dim=-1).indices
+
 
 class MaskedRunner:
     """
@@ -22,8 +57,26 @@ class MaskedRunner:
 
     _parent_index_per_child: dict[tuple[HookPointName, IndexedHookPointName], int]
     _indexed_parents_per_child: dict[HookPointName, list[IndexedHookPointName]]
+    # the most recently used sets of edges, compiled into the indices of their mask logits
+    _compiled_edges: "collections.OrderedDict[frozenset[Edge], Integer[torch.Tensor, ' n_edges']]"
+
+    # the ablation caches of the most recently used patch inputs, and their size in bytes
+    _ablation_caches: "collections.OrderedDict[PatchInputFingerprint, tuple[ActivationCache, int]]"
+    _ablation_caches_weights_versions: tuple[int, ...] | None  # the versions of the weights they were calculated with
+    ablation_cache_max_bytes: int
+    ablation_cache_hits: int
+    ablation_cache_misses: int
 
-    def __init__(self, model: HookedTransformer, starting_point_type: CircuitStartingPointType):
+    MAX_COMPILED_EDGE_SETS = 64
+
+    def __init__(
+        self,
+        model: HookedTransformer,
+        starting_point_type: CircuitStartingPointType,
+        ablation_cache_max_bytes: int = 2**30,
+    ):
+        """'ablation_cache_max_bytes' is the memory that the ablation caches of previous patch inputs may take up;
+        use 0 to only keep the ablation cache of the last patch input."""
         assert (
             model.cfg.positional_embedding_type in {"standard"}
         ), "This is a temporary check; I don't know what values are possible here and what to do with them (in terms of whether or not they're using pos embed)"
@@ -32,6 +85,9 @@ class MaskedRunner:
         self._freeze_all_masks()
         self._set_all_masks_to_pos_infty()
         self._set_up_parent_index_per_child()
+        self._compiled_edges = collections.OrderedDict()
+        self.ablation_cache_max_bytes = ablation_cache_max_bytes
+        self.clear_ablation_caches()
 
     def _set_up_parent_index_per_child(self):
         # For every child, every possible parent in the edge has an index; this is the index of the mask in the list of masks for that child.
@@ -53,35 +109,128 @@ class MaskedRunner:
                 self._parent_index_per_child[(child, indexed_parent)] = index
 
     def _freeze_all_masks(self):
-        """In the MaskedTransformer, every mask is a parameter. In this case, however,
+        """In the MaskedTransformer, the masks are a parameter. In this case, however,
         we only want to run the model with fixed masks, so we freeze all the masks."""
-        for value in self.masked_transformer._mask_parameter_dict.values():
-            value.requires_grad = False
+        self.masked_transformer.flat_mask_parameters.requires_grad = False
 
     def _set_all_masks_to_pos_infty(self):
-        for parameter in self.masked_transformer._mask_parameter_dict.values():
-            parameter.data.fill_(float("inf"))
+        self.masked_transformer.flat_mask_parameters.data.fill_(float("inf"))
 
-    def _set_mask_for_edge(self, child: IndexedHookPointName, parent: IndexedHookPointName, value: float) -> None:
-        parent_index = self._parent_index_per_child[(child.hook_name, parent)]
-        # self._mask_logits_dict is dict[HookPointName of child, Num[torch.nn.Parameter, "parent (IndexedHookPoint), TorchIndex of child"]
+    def _flat_mask_index(self, edge: Edge) -> int:
+        """The index of the mask logit for 'edge' in the flat mask parameters of the masked transformer."""
+        parent_index = self._parent_index_per_child[(edge.child.hook_name, edge.parent)]
         # todo: I think child.index.as_index[-1] shows that we're not using the right abstraction here; or maybe it doesn't?
-        self.masked_transformer._mask_parameter_dict[child.hook_name][parent_index][child.index.as_index[-1]] = value  # pyright: ignore
+        child_index = edge.child.index.as_index[-1]
+        # hook points with a single instance (mlp_in, resid_post) have index [:]; their mask has a single column
+        child_col = child_index if isinstance(child_index, int) else 0
+        return self.masked_transformer.flat_mask_index(edge.child.hook_name, parent_index, child_col)
+
+    def compile_edges(self, edges: Collection[Edge]) -> Integer[torch.Tensor, " n_edges"]:
+        """The indices of the mask logits for 'edges' in the flat mask parameters of the masked transformer.
+
+        The indices of the last MAX_COMPILED_EDGE_SETS sets of edges are cached, so that ablating the same edges
+        again (e.g. 'all edges minus the circuit' for every batch) only costs a lookup. Pass a frozenset if you
+        use the same edges several times: its hash is only calculated once."""
+        key = edges if isinstance(edges, frozenset) else frozenset(edges)
+        if key in self._compiled_edges:
+            self._compiled_edges.move_to_end(key)
+            return self._compiled_edges[key]
+
+        assert key <= self.all_ablatable_edges  # safety check
+        indices = torch.tensor(
+            sorted(self._flat_mask_index(edge) for edge in key),
+            dtype=torch.long,
+            device=self.masked_transformer.flat_mask_parameters.device,
+        )
+        self._compiled_edges[key] = indices
+        if len(self._compiled_edges) > self.MAX_COMPILED_EDGE_SETS:
+            self._compiled_edges.popitem(last=False)
+        return indices
+
+    def clear_ablation_caches(self) -> None:
+        """Forgets the ablation caches of previous patch inputs, and resets the hit and miss counters."""
+        self._ablation_caches = collections.OrderedDict()
+        self._ablation_caches_weights_versions = None
+        self.ablation_cache_hits = 0
+        self.ablation_cache_misses = 0
+
+    @staticmethod
+    def _fingerprint(patch_input: torch.Tensor) -> PatchInputFingerprint:
+        contents = patch_input.detach().reshape(-1).contiguous().cpu().view(torch.uint8).numpy().tobytes()
+        return (
+            tuple(patch_input.shape),
+            patch_input.dtype,
+            patch_input.device,
+            hashlib.blake2b(contents, digest_size=16).digest(),
+        )
+
+    def _calculate_and_store_ablation_cache(
+        self, patch_input: Num[torch.Tensor, "batch pos"], retain_patch_gradient: bool = False
+    ) -> None:
+        """Sets the ablation cache of the masked transformer for 'patch_input', reusing the ablation cache of a
+        previous patch input with the same contents if it's still in memory.
+
+        The caches are not reused if the gradient for the patch input is needed or if there are hooks on the model
+        (which may change the cached values), and they are all dropped when the weights of the model change."""
+        if retain_patch_gradient or self.masked_transformer._model_has_hooks():
+            self.masked_transformer.calculate_and_store_ablation_cache(
+                patch_input, retain_cache_gradients=retain_patch_gradient
+            )
+            return
+
+        weights_versions = tuple(parameter._version for parameter in self.masked_transformer.model.parameters())
+        if weights_versions != self._ablation_caches_weights_versions:
+            self._ablation_caches.clear()
+            self._ablation_caches_weights_versions = weights_versions
+
+        fingerprint = self._fingerprint(patch_input)
+        if fingerprint in self._ablation_caches:
+            self._ablation_caches.move_to_end(fingerprint)
+            self.masked_transformer.ablation_cache = self._ablation_caches[fingerprint][0]
+            self.masked_transformer.invalidate_ablation_cache()
+            self.ablation_cache_hits += 1
+            return
+
+        self.ablation_cache_misses += 1
+        self.masked_transformer.calculate_and_store_ablation_cache(patch_input, retain_cache_gradients=False)
+        cache = self.masked_transformer.ablation_cache
+        num_bytes = sum(value.numel() * value.element_size() for value in cache.cache_dict.values())
+        if num_bytes > self.ablation_cache_max_bytes:
+            return
+        self._ablation_caches[fingerprint] = (cache, num_bytes)
+        while sum(num_bytes for _, num_bytes in self._ablation_caches.values()) > self.ablation_cache_max_bytes:
+            self._ablation_caches.popitem(last=False)
+
+    def _mask_logits_for_circuits(
+        self, edges_to_ablate_per_circuit: Sequence[Collection[Edge]]
+    ) -> Float[torch.Tensor, "circuit n_mask_logits"]:
+        """Creates flat mask logits with a leading 'circuit' dimension, where circuit i has the edges
+        edges_to_ablate_per_circuit[i] ablated (and all other edges present)."""
+        parameters = self.masked_transformer.flat_mask_parameters
+        mask_logits = torch.full(
+            (len(edges_to_ablate_per_circuit), *parameters.shape),
+            float("inf"),
+            device=parameters.device,
+            dtype=parameters.dtype,
+        )
+        for circuit_index, edges_to_ablate in enumerate(edges_to_ablate_per_circuit):
+            mask_logits[circuit_index, self.compile_edges(edges_to_ablate)] = float("-inf")
+        return mask_logits
 
     @cached_property
-    def all_ablatable_edges(self) -> set[Edge]:
-        return {
+    def all_ablatable_edges(self) -> frozenset[Edge]:
+        return frozenset(
             Edge(child=indexed_child, parent=indexed_parent)
             for child, all_indexed_parents in self._indexed_parents_per_child.items()
             for indexed_child in IndexedHookPointName.list_from_hook_point(child, self.masked_transformer.n_heads)
             for indexed_parent in all_indexed_parents
-        }
+        )
 
     @contextmanager
     def with_ablated_edges(
         self,
         patch_input: Num[torch.Tensor, "batch pos"] | None,
-        edges_to_ablate: list[Edge],
+        edges_to_ablate: Collection[Edge],
         retain_patch_gradient: bool = False,
     ) -> Iterator[HookedTransformer]:
         """If 'patch_input' is None, do not recalculate the ablation cache. This is useful if you're running the model
@@ -90,25 +239,23 @@ class MaskedRunner:
 
         If 'patch_input' is None, 'retain_gradient_for_ablated_edges' is ignored.
         If 'patch_input' is not None, 'retain_gradient_for_ablated_edges' determines whether the gradient for the patch
-        input is retained in the ablation cache."""
-        for edge in edges_to_ablate:
-            assert edge in self.all_ablatable_edges  # safety check
-            self._set_mask_for_edge(edge.child, edge.parent, float("-inf"))
+        input is retained in the ablation cache.
+
+        'edges_to_ablate' is compiled into mask indices with 'compile_edges', so that the masks are set (and reset)
+        with a single write."""
+        ablated_mask_indices = self.compile_edges(edges_to_ablate)
+        self.masked_transformer.flat_mask_parameters.data[ablated_mask_indices] = float("-inf")
 
         try:
             if patch_input is not None:
-                self.masked_transformer.calculate_and_store_ablation_cache(
-                    patch_input, retain_cache_gradients=retain_patch_gradient
-                )
+                self._calculate_and_store_ablation_cache(patch_input, retain_patch_gradient=retain_patch_gradient)
 
             with self.masked_transformer.with_fwd_hooks() as hooked_model:
                 yield hooked_model
 
         finally:
-            for edge in edges_to_ablate:
-                self._set_mask_for_edge(
-                    edge.child, edge.parent, float("inf")
-                )  # this class is not intended to keep state
+            # this class is not intended to keep state
+            self.masked_transformer.flat_mask_parameters.data[ablated_mask_indices] = float("inf")
 
     @contextmanager
     def hooks(
@@ -131,7 +278,7 @@ class MaskedRunner:
         self,
         input: Num[torch.Tensor, "batch pos"],
         patch_input: Num[torch.Tensor, "batch pos"] | None,
-        edges_to_ablate: list[Edge],
+        edges_to_ablate: Collection[Edge],
     ) -> Num[torch.Tensor, "batch pos vocab"]:
         """If 'patch_input' is None, do not recalculate the ablation cache.
         Instead, use the ablation cache that has already been calculated.
@@ -140,26 +287,60 @@ class MaskedRunner:
         with self.with_ablated_edges(patch_input=patch_input, edges_to_ablate=edges_to_ablate) as hooked_model:
             return hooked_model(input)
 
+    def run_many(
+        self,
+        input: Num[torch.Tensor, "batch pos"],
+        patch_input: Num[torch.Tensor, "batch pos"] | None,
+        edges_to_ablate_per_circuit: Sequence[Collection[Edge]],
+        max_batch_size: int | None = None,
+    ) -> Num[torch.Tensor, "circuit batch pos vocab"]:
+        """Run every input once for every circuit, where circuit i has the edges edges_to_ablate_per_circuit[i]
+        ablated. Returns the output for circuit i on input j at [i, j].
+
+        The circuits x inputs pairs are packed into batches of at most 'max_batch_size' examples (default: all of them
+        in a single batch), where every example in a batch gets its own mask. The ablation cache is calculated only
+        once, for 'patch_input', and shared by all circuits; if 'patch_input' is None, the ablation cache that has
+        already been calculated is used."""
+        num_circuits, batch_size = len(edges_to_ablate_per_circuit), input.shape[0]
+        circuits_per_forward_pass = (
+            num_circuits if max_batch_size is None else max(1, max_batch_size // batch_size)
+        )  # we never split up a batch of inputs, only the circuits
+
+        if patch_input is not None:
+            self._calculate_and_store_ablation_cache(patch_input)
+
+        outputs = []
+        for start in range(0, num_circuits, circuits_per_forward_pass):
+            circuits = edges_to_ablate_per_circuit[start : start + circuits_per_forward_pass]
+            # circuit-major order: the example for (circuit i, input j) is at index i * batch_size + j
+            # (the ablation cache is shared by all circuits)
+            mask_logits = self._mask_logits_for_circuits(circuits).repeat_interleave(batch_size, dim=0)
+            with self.masked_transformer.with_mask_logits(mask_logits):
+                with self.masked_transformer.with_fwd_hooks() as hooked_model:
+                    output = hooked_model(input.repeat(len(circuits), *([1] * (input.ndim - 1))))
+            outputs.append(output.unflatten(0, (len(circuits), batch_size)))
+
+        return torch.cat(outputs)
+
     def run_with_linear_combination(
         self,
         input_embedded: Float[torch.Tensor, "batch pos d_resid"],
         dummy_input: Integer[torch.Tensor, " pos"],
         coefficients: Num[torch.Tensor, " batch"],
         patch_input: Integer[torch.Tensor, " pos"],
-        edges_to_ablate: list[Edge],
+        edges_to_ablate: Collection[Edge],
+        support: Integer[torch.Tensor, " k"] | None = None,
     ) -> Float[torch.Tensor, "1 pos vocab"]:
         """'input_embedded' should be the input after the embedding layer.
 
-        'dummy_input' and 'patch_input' should be a single input point (pre-embedding, without batch dim)"""
+        'dummy_input' and 'patch_input' should be a single input point (pre-embedding, without batch dim)
+
+        If 'support' is given, only the inputs at those indices are combined (see `convex_combination`)."""
 
         def replace_embedding_with_convex_combination_hook(
             hook_point_out: torch.Tensor, hook: HookPoint, verbose=False
         ) -> Float[torch.Tensor, "1 pos d_resid"]:
-            convex_combination = torch.einsum(
-                "b, b p d -> p d",
-                [torch.nn.functional.softmax(coefficients), input_embedded],
-            ).unsqueeze(dim=0)
-            return convex_combination
+            return convex_combination(coefficients, input_embedded, support).unsqueeze(dim=0)
 
         self.masked_transformer.calculate_and_store_ablation_cache(patch_input, retain_cache_gradients=False)
         with self.hooks(
@@ -176,8 +357,10 @@ class MaskedRunner:
         dummy_input: Integer[torch.Tensor, " pos"],
         coefficients: Num[torch.Tensor, " batch"],
         coefficients_patch: Num[torch.Tensor, " batch"],
-        edges_to_ablate: list[Edge],
+        edges_to_ablate: Collection[Edge],
         retain_patch_gradient: bool = False,
+        support: Integer[torch.Tensor, " k"] | None = None,
+        support_patch: Integer[torch.Tensor, " k"] | None = None,
     ) -> Float[torch.Tensor, "1 pos vocab"]:
         """'input_embedded' should be the input after the embedding layer.
 
@@ -185,26 +368,20 @@ class MaskedRunner:
 
         If 'retain_patch_gradient' is True, make sure to retain the gradient for the patch input by retaining the
         gradient in the ablation cache.
+
+        If 'support' ('support_patch') is given, only the inputs (patch inputs) at those indices are combined
+        (see `convex_combination`).
         """
 
         def replace_embedding_with_convex_combination_hook(
             hook_point_out: torch.Tensor, hook: HookPoint, verbose=False
         ) -> Float[torch.Tensor, "1 pos d_resid"]:
-            convex_combination = torch.einsum(
-                "b, b p d -> p d",
-                [torch.nn.functional.softmax(coefficients), input_embedded],
-            ).unsqueeze(dim=0)
-            return convex_combination
+            return convex_combination(coefficients, input_embedded, support).unsqueeze(dim=0)
 
-        # todo cleanup: this is basically the same as the function above
         def replace_embedding_with_convex_combination_hook_patch(
             hook_point_out: torch.Tensor, hook: HookPoint, verbose=False
         ) -> Float[torch.Tensor, "1 pos d_resid"]:
-            convex_combination = torch.einsum(
-                "b, b p d -> p d",
-                [torch.nn.functional.softmax(coefficients_patch), patch_input_embedded],
-            ).unsqueeze(dim=0)
-            return convex_combination
+            return convex_combination(coefficients_patch, patch_input_embedded, support_patch).unsqueeze(dim=0)
 
         # calculate ablation cache with the convex combination
         with self.hooks(
@@ -221,3 +398,49 @@ class MaskedRunner:
             return runner_with_convex_combination.run(
                 input=dummy_input.unsqueeze(0), patch_input=None, edges_to_ablate=edges_to_ablate
             )
+
+    def run_circuit_and_full_model_with_linear_combination_of_input_and_patch(
+        self,
+        input_embedded: Float[torch.Tensor, "batch pos d_resid"],
+        patch_input_embedded: Float[torch.Tensor, "batch pos d_resid"],
+        dummy_input: Integer[torch.Tensor, " pos"],
+        coefficients: Num[torch.Tensor, "*restart batch"],
+        coefficients_patch: Num[torch.Tensor, "*restart batch"],
+        edges_to_ablate: Collection[Edge],
+        retain_patch_gradient: bool = False,
+        support: Integer[torch.Tensor, "*restart k"] | None = None,
+        support_patch: Integer[torch.Tensor, "*restart k"] | None = None,
+    ) -> tuple[Float[torch.Tensor, "restart pos vocab"], Float[torch.Tensor, "restart pos vocab"]]:
+        """Returns the outputs of 'run_with_linear_combination_of_input_and_patch' for the circuit (with
+        'edges_to_ablate' ablated) and for the full model (without ablations), with less work than calling it twice:
+        the ablation cache and the convex combinations are calculated once, and the circuit and the full model are run
+        in a single forward pass, each with its own mask.
+
+        The coefficients can have a leading 'restart' dimension, to optimize several convex combinations at once:
+        the outputs for restart r are at index r. Without it, the outputs have a 'restart' dimension of size 1.
+
+        If 'support' ('support_patch') is given, only the inputs (patch inputs) at those indices are combined
+        (see `convex_combination`)."""
+
+        # calculate ablation cache with the convex combinations of the patch inputs
+        patch_combination = convex_combination(coefficients_patch, patch_input_embedded, support_patch).reshape(
+            -1, *patch_input_embedded.shape[1:]
+        )
+        num_restarts = patch_combination.shape[0]
+        with self.hooks(fwd_hooks=[("hook_embed", lambda hook_point_out, hook: patch_combination)]):
+            self.masked_transformer.calculate_and_store_ablation_cache(
+                dummy_input.expand(num_restarts, -1), retain_cache_gradients=retain_patch_gradient
+            )
+
+        # the first half of the batch is the circuit, the second half the full model; example r in both halves uses
+        # the ablation cache of restart r
+        input_combination = convex_combination(coefficients, input_embedded, support).reshape(
+            -1, *input_embedded.shape[1:]
+        )
+        input_combination = input_combination.repeat(2, 1, 1)
+        mask_logits = self._mask_logits_for_circuits([edges_to_ablate, []])
+        with self.hooks(fwd_hooks=[("hook_embed", lambda hook_point_out, hook: input_combination)]):
+            with self.masked_transformer.with_mask_logits(mask_logits):
+                with self.masked_transformer.with_fwd_hooks() as hooked_model:
+                    output = hooked_model(dummy_input.expand(2 * num_restarts, -1))
+        return output[:num_restarts], output[num_restarts:]
@@ -0,0 +1,134 @@
+import dataclasses
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import torch
+
+from acdc.nudb.adv_opt.settings import ExperimentArtifacts
+from acdc.nudb.adv_opt.utils import device
+
+# the artifacts that are the same for all runs on a task; they are stored once
+_SHARED_ARTIFACTS = ("base_input", "base_patch_input")
+
+
+@dataclass
+class SweepRun:
+    name: str
+    config: dict  # the resolved config of the run, as hydra would write it to .hydra/config.yaml
+    artifacts: ExperimentArtifacts
+    output_dir: Path | None = None
+
+
+@dataclass
+class ConsolidatedResults:
+    """The results of all runs of a sweep in a single directory, instead of one hydra output directory per run:
+
+    - runs.jsonl: the name, config and output directory of every run, one line per run;
+    - artifacts/<name>.pt: the ExperimentArtifacts of the run <name>, except for the base inputs;
+    - shared/<hash>.pt: the base inputs, which are the same for all runs on a task, so they are only stored once.
+
+    Runs are saved one at a time (see `save_run`), and runs.jsonl is only appended to, so saving a run doesn't rewrite
+    the earlier runs, and a crash while saving only loses the run that was being saved.
+
+    See `analysis/output_parser.py` for reading them like hydra output directories."""
+
+    runs: list[SweepRun] = field(default_factory=list)
+
+    def add(self, run: SweepRun) -> None:
+        assert run.name not in {existing.name for existing in self.runs}, f"Run {run.name} was already added"
+        self.runs.append(run)
+
+    def save(self, directory: Path) -> None:
+        """Saves the runs that are not in 'directory' yet."""
+        saved = {run["name"] for run in self._read_index(directory)}
+        for run in self.runs:
+            if run.name not in saved:
+                self.save_run(directory, run)
+
+    @classmethod
+    def save_run(cls, directory: Path, run: SweepRun) -> None:
+        (directory / "artifacts").mkdir(parents=True, exist_ok=True)
+        (directory / "shared").mkdir(exist_ok=True)
+        artifacts = {}
+        for artifact in dataclasses.fields(ExperimentArtifacts):
+            value = getattr(run.artifacts, artifact.name)
+            if artifact.name in _SHARED_ARTIFACTS and value is not None:
+                value = cls._save_shared(directory / "shared", value)
+            artifacts[artifact.name] = value
+        _atomic_save(artifacts, directory / "artifacts" / f"{run.name}.pt")
+
+        # the index is written last, so that a run is only in it once all its artifacts are
+        line = json.dumps(
+            {
+                "name": run.name,
+                "config": run.config,
+                "output_dir": None if run.output_dir is None else str(run.output_dir),
+            }
+        )
+        index_path = directory / "runs.jsonl"
+        if index_path.exists() and index_path.stat().st_size > 0:
+            with open(index_path, "rb") as index:
+                index.seek(-1, os.SEEK_END)
+                if index.read(1) != b"\n":  # a crash left an incomplete last line
+                    line = "\n" + line
+        with open(index_path, "a") as index:
+            index.write(line + "\n")
+
+    @classmethod
+    def load(cls, directory: Path) -> "ConsolidatedResults":
+        map_location = torch.device("cpu") if device == "cpu" else None
+        runs = []
+        for run in cls._read_index(directory):
+            artifacts = torch.load(directory / "artifacts" / f"{run['name']}.pt", map_location=map_location)
+            for name in _SHARED_ARTIFACTS:
+                if isinstance(artifacts.get(name), str):
+                    artifacts[name] = torch.load(
+                        directory / "shared" / f"{artifacts[name]}.pt", map_location=map_location
+                    )
+            runs.append(
+                SweepRun(
+                    name=run["name"],
+                    config=run["config"],
+                    artifacts=ExperimentArtifacts(**artifacts),
+                    output_dir=None if run["output_dir"] is None else Path(run["output_dir"]),
+                )
+            )
+        return cls(runs=runs)
+
+    @staticmethod
+    def is_consolidated_results_dir(directory: Path) -> bool:
+        return (directory / "runs.jsonl").exists()
+
+    @staticmethod
+    def _read_index(directory: Path) -> list[dict]:
+        if not (directory / "runs.jsonl").exists():
+            return []
+        runs = []
+        for line in (directory / "runs.jsonl").read_text().splitlines():
+            try:
+                runs.append(json.loads(line))
+            except json.JSONDecodeError:
+                # an incomplete line is from a crash while it was written; its run was not saved
+                continue
+        return runs
+
+    @staticmethod
+    def _save_shared(shared_dir: Path, value: torch.Tensor) -> str:
+        """Saves 'value' in 'shared_dir' (if it's not there yet), and returns the name it's stored under."""
+        value = value.detach().cpu().contiguous()
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{value.dtype}:{tuple(value.shape)}".encode())
+        digest.update(value.reshape(-1).view(torch.uint8).numpy().tobytes())
+        name = digest.hexdigest()
+        if not (shared_dir / f"{name}.pt").exists():
+            _atomic_save(value, shared_dir / f"{name}.pt")
+        return name
+
+
+def _atomic_save(obj, path: Path) -> None:
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
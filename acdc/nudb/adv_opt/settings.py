@@ -52,6 +52,15 @@ class ExperimentSettings:
     temperature_schedule: str = "constant"
     noise_schedule: str = "absent"
     coefficient_renormalization: CoefficientRenormalization = CoefficientRenormalization.none
+    # number of random restarts, optimized together in one batched forward pass; the best one is reported
+    num_restarts: int = 1
+    # stop a restart when its loss has not improved for this many epochs (never, if None)
+    early_stopping_patience: int | None = None
+    # if set, only combine the examples with the 'sparse_support_k' largest coefficients, and those with a softmax
+    # weight above 'sparse_support_epsilon'; these are chosen again every 'sparse_support_update_period' epochs
+    sparse_support_k: int | None = None
+    sparse_support_epsilon: float = 0.0
+    sparse_support_update_period: int = 50
 
 
 @dataclass
@@ -62,6 +71,22 @@ class ExperimentArtifacts:
     coefficients_final: Float[torch.Tensor, " batch"] | None = None
     coefficients_init_patch: Float[torch.Tensor, " batch"] | None = None
     coefficients_final_patch: Float[torch.Tensor, " batch"] | None = None
+    # the coefficients above are those of the best restart; these are those of all restarts
+    coefficients_init_all_restarts: Float[torch.Tensor, "restart batch"] | None = None
+    coefficients_final_all_restarts: Float[torch.Tensor, "restart batch"] | None = None
+    coefficients_init_patch_all_restarts: Float[torch.Tensor, "restart batch"] | None = None
+    coefficients_final_patch_all_restarts: Float[torch.Tensor, "restart batch"] | None = None
+    final_losses_all_restarts: Float[torch.Tensor, " restart"] | None = None
+
+    # the fields with the results of all restarts (not a dataclass field, because it's not annotated); the
+    # first dimension of these is the restart
+    RESTART_FIELDS = (
+        "coefficients_init_all_restarts",
+        "coefficients_final_all_restarts",
+        "coefficients_init_patch_all_restarts",
+        "coefficients_final_patch_all_restarts",
+        "final_losses_all_restarts",
+    )
 
     def save(self, output_dir: Path):
         output_dir.mkdir(parents=True, exist_ok=True)
@@ -71,6 +96,8 @@ class ExperimentArtifacts:
         torch.save(self.coefficients_final, output_dir / "coefficients_final.pt")
         torch.save(self.coefficients_init_patch, output_dir / "coefficients_init_patch.pt")
         torch.save(self.coefficients_final_patch, output_dir / "coefficients_final_patch.pt")
+        for name in self.RESTART_FIELDS:
+            torch.save(getattr(self, name), output_dir / f"{name}.pt")
 
     @classmethod
     def load(cls, output_dir: Path) -> "ExperimentArtifacts":
@@ -82,6 +109,12 @@ class ExperimentArtifacts:
             coefficients_final=torch.load(output_dir / "coefficients_final.pt", map_location=map_location),
             coefficients_init_patch=torch.load(output_dir / "coefficients_init_patch.pt", map_location=map_location),
             coefficients_final_patch=torch.load(output_dir / "coefficients_final_patch.pt", map_location=map_location),
+            # runs from before restarts were added don't have these
+            **{
+                name: torch.load(output_dir / f"{name}.pt", map_location=map_location)
+                for name in cls.RESTART_FIELDS
+                if (output_dir / f"{name}.pt").exists()
+            },
         )
 
     def base_input_embedded(self, embedder: torch.nn.Module) -> Float[torch.Tensor, "batch pos vocab"]:
@@ -0,0 +1,107 @@
+import dataclasses
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import torch
+from jaxtyping import Float, Integer
+
+
+@dataclass
+class StreamingMetricSummary:
+    """A summary of the metrics of many (input, patch input) pairs that takes constant memory, however many pairs
+    are added: the 'k' pairs with the highest metric (the most adversarial ones), a histogram with fixed bins, and
+    the count, mean, variance, minimum and maximum.
+
+    If 'spill_dir' is set, the metrics of all pairs are also written to disk, one file per batch
+    (see `load_spilled`)."""
+
+    k: int
+    histogram_range: tuple[float, float]
+    num_bins: int
+    spill_dir: Path | None = None
+
+    top_values: Float[torch.Tensor, " k"] = field(default_factory=lambda: torch.empty(0))
+    top_pair_indices: Integer[torch.Tensor, "k 2"] = field(
+        default_factory=lambda: torch.empty((0, 2), dtype=torch.long)
+    )
+    # histogram_counts[0] and [-1] count the values below and above 'histogram_range'
+    histogram_counts: Integer[torch.Tensor, " num_bins_plus_2"] = field(init=False)
+    count: int = 0
+    mean: float = 0.0
+    sum_of_squared_deviations: float = 0.0  # from the mean; see Chan et al.'s parallel algorithm for the variance
+    min: float = float("inf")
+    max: float = float("-inf")
+    num_spilled_batches: int = 0
+
+    def __post_init__(self):
+        self.histogram_counts = torch.zeros(self.num_bins + 2, dtype=torch.long)
+        if self.spill_dir is not None:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def bin_edges(self) -> Float[torch.Tensor, " num_bins_plus_1"]:
+        return torch.linspace(*self.histogram_range, self.num_bins + 1, dtype=torch.float64)
+
+    @property
+    def variance(self) -> float:
+        return self.sum_of_squared_deviations / (self.count - 1) if self.count > 1 else float("nan")
+
+    def update(self, values: Float[torch.Tensor, " batch"], pair_indices: Integer[torch.Tensor, "batch 2"]) -> None:
+        """Adds the metrics 'values' of the pairs 'pair_indices' (input index, patch index)."""
+        assert values.ndim == 1 and pair_indices.shape == (len(values), 2)
+        if len(values) == 0:
+            return
+        values, pair_indices = values.detach().to("cpu", torch.float64), pair_indices.to("cpu")
+
+        # top k: merge with the current top k
+        candidate_values = torch.cat([self.top_values.to(torch.float64), values])
+        candidate_pair_indices = torch.cat([self.top_pair_indices, pair_indices])
+        top = torch.topk(candidate_values, k=min(self.k, len(candidate_values)), sorted=True)
+        self.top_values = top.values
+        self.top_pair_indices = candidate_pair_indices[top.indices]
+
+        # the bins are closed on the left, except for the last one, like torch.histogram
+        bins = torch.bucketize(values, self.bin_edges, right=True)  # 0 below the range, num_bins + 1 above it
+        bins[values == self.histogram_range[1]] = self.num_bins
+        self.histogram_counts += torch.bincount(bins, minlength=self.num_bins + 2)
+
+        # moments
+        batch_count, batch_mean = len(values), values.mean().item()
+        batch_sum_of_squared_deviations = ((values - batch_mean) ** 2).sum().item()
+        total = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.sum_of_squared_deviations += batch_sum_of_squared_deviations + delta**2 * self.count * batch_count / total
+        self.mean += delta * batch_count / total
+        self.count = total
+        self.min = min(self.min, values.min().item())
+        self.max = max(self.max, values.max().item())
+
+        if self.spill_dir is not None:
+            torch.save(
+                {"values": values.float(), "pair_indices": pair_indices},
+                self.spill_dir / f"batch_{self.num_spilled_batches:06d}.pt",
+            )
+            self.num_spilled_batches += 1
+
+    def load_spilled(self) -> tuple[Float[torch.Tensor, " pair"], Integer[torch.Tensor, "pair 2"]]:
+        """The metrics and pair indices of all pairs, in the order they were added."""
+        assert self.spill_dir is not None, "The metrics of the pairs were not spilled to disk"
+        batches = [torch.load(self.spill_dir / f"batch_{i:06d}.pt") for i in range(self.num_spilled_batches)]
+        return (
+            torch.cat([batch["values"] for batch in batches]),
+            torch.cat([batch["pair_indices"] for batch in batches]),
+        )
+
+    def save(self, path: Path) -> None:
+        state = dataclasses.asdict(self)
+        state["spill_dir"] = None if self.spill_dir is None else str(self.spill_dir)
+        torch.save(state, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "StreamingMetricSummary":
+        state = torch.load(path)
+        histogram_counts = state.pop("histogram_counts")
+        summary = cls(**{key: value for key, value in state.items() if key != "spill_dir"})
+        summary.spill_dir = None if state["spill_dir"] is None else Path(state["spill_dir"])
+        summary.histogram_counts = histogram_counts
+        return summary
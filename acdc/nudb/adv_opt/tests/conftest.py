@@ -0,0 +1,46 @@
+import random
+from functools import partial
+from typing import Callable
+
+import pytest
+import torch
+
+from acdc.docstring.utils import AllDataThings
+from acdc.nudb.adv_opt.data_fetchers import AdvOptExperimentData, AdvOptTaskName
+from acdc.nudb.adv_opt.loss_fn import kl_div_on_output_logits
+from acdc.nudb.adv_opt.masked_runner import MaskedRunner
+from subnetwork_probing.masked_transformer import CircuitStartingPointType
+from tests.subnetwork_probing.conftest import make_tiny_transformer
+
+
+def _make_experiment_data(last_sequence_position_only: bool = True) -> AdvOptExperimentData:
+    """Experiment data of the tiny transformer, with random data and a random circuit; the same on every call."""
+    masked_runner = MaskedRunner(make_tiny_transformer(), starting_point_type=CircuitStartingPointType.POS_EMBED)
+    generator = torch.Generator().manual_seed(0)
+    return AdvOptExperimentData(
+        task_name=AdvOptTaskName.DOCSTRING,
+        task_data=AllDataThings(
+            tl_model=masked_runner.masked_transformer.model,
+            validation_metric=lambda logits: logits.sum(),
+            validation_data=torch.randint(0, 11, (4, 6), generator=generator),
+            validation_labels=torch.randint(0, 11, (4,), generator=generator),
+            validation_mask=None,
+            validation_patch_data=torch.randint(0, 11, (4, 6), generator=generator),
+            test_metrics={},
+            test_data=torch.randint(0, 11, (5, 6), generator=generator),
+            test_labels=torch.randint(0, 11, (5,), generator=generator),
+            test_mask=None,
+            test_patch_data=torch.randint(0, 11, (5, 6), generator=generator),
+        ),
+        circuit_edges=random.Random(0).sample(sorted(masked_runner.all_ablatable_edges, key=str), k=5),
+        masked_runner=masked_runner,
+        loss_fn=partial(kl_div_on_output_logits, last_sequence_position_only=last_sequence_position_only),
+        metric_last_sequence_position_only=last_sequence_position_only,
+    )
+
+
+@pytest.fixture
+def make_experiment_data() -> Callable[..., AdvOptExperimentData]:
+    """Makes the experiment data of a tiny transformer; call it again for a fresh copy (e.g. because a run freezes the
+    weights of the model)."""
+    return _make_experiment_data
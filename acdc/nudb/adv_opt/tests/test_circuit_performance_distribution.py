@@ -0,0 +1,82 @@
+import random
+from typing import Callable
+
+import pytest
+import torch
+import torch.utils.data
+
+from acdc.nudb.adv_opt.data_fetchers import AdvOptExperimentData
+from acdc.nudb.adv_opt.main_circuit_performance_distribution import (
+    CircuitPerformanceDistributionExperiment,
+    InputPatchPairDataset,
+)
+from acdc.nudb.adv_opt.streaming_summary import StreamingMetricSummary
+
+
+@pytest.mark.parametrize("last_sequence_position_only", [False, True])
+def test_all_circuits_at_once_agrees_with_one_circuit_at_a_time(
+    last_sequence_position_only: bool, make_experiment_data: Callable[..., AdvOptExperimentData]
+):
+    experiment = CircuitPerformanceDistributionExperiment(make_experiment_data(last_sequence_position_only))
+    masked_runner = experiment.experiment_data.masked_runner
+    all_edges = sorted(masked_runner.all_ablatable_edges, key=str)
+    random.seed(0)
+    circuits = {"empty": [], "random": random.sample(all_edges, k=len(all_edges) // 2), "full": all_edges}
+    data_loader = torch.utils.data.DataLoader(
+        torch.utils.data.TensorDataset(torch.randint(0, 11, (10, 6)), torch.randint(0, 11, (10, 6))), batch_size=4
+    )
+
+    metrics = experiment.calculate_circuit_performances_for_large_sample(circuits, data_loader)
+
+    for name, circuit in circuits.items():
+        expected = torch.cat(
+            [
+                experiment.experiment_data.loss_fn(
+                    masked_runner.run(input, patch_input, edges_to_ablate=[]),
+                    masked_runner.run(input, patch_input, edges_to_ablate=set(all_edges) - set(circuit)),
+                )
+                for input, patch_input in data_loader
+            ]
+        )
+        assert metrics[name].shape == (10,)
+        assert torch.allclose(metrics[name], expected, atol=1e-5)
+    assert torch.allclose(metrics["full"], torch.zeros(10), atol=1e-6)
+
+
+@pytest.mark.parametrize("cartesian_product", [False, True])
+@pytest.mark.parametrize("batch_size", [2, 3, 7])
+def test_input_patch_pairs_are_generated_in_batches(cartesian_product: bool, batch_size: int):
+    inputs, patch_inputs = torch.arange(5).unsqueeze(-1), 10 + torch.arange(5 if not cartesian_product else 3)
+    dataset = InputPatchPairDataset(inputs, patch_inputs.unsqueeze(-1), cartesian_product=cartesian_product)
+    expected_pairs = (
+        [(i, 10 + j) for j in range(3) for i in range(5)] if cartesian_product else [(i, 10 + i) for i in range(5)]
+    )
+
+    pairs = []
+    for input, patch_input in dataset.data_loader(batch_size):
+        assert len(input) <= batch_size
+        assert len(patch_input) in (1, len(input))
+        if cartesian_product and batch_size < len(inputs):
+            assert len(patch_input) == 1
+        pairs += zip(input.squeeze(-1).tolist(), patch_input.expand(len(input), -1).squeeze(-1).tolist())
+
+    assert len(dataset) == len(expected_pairs)
+    assert pairs == expected_pairs
+    pair_indices = dataset.pair_indices()
+    assert [(i, 10 + j) for i, j in pair_indices.tolist()] == expected_pairs
+
+
+def test_summaries_agree_with_the_metrics_for_all_pairs(make_experiment_data: Callable[..., AdvOptExperimentData]):
+    experiment = CircuitPerformanceDistributionExperiment(make_experiment_data(last_sequence_position_only=True))
+    all_edges = sorted(experiment.experiment_data.masked_runner.all_ablatable_edges, key=str)
+    circuits = {"random": random.Random(0).sample(all_edges, k=len(all_edges) // 2)}
+    dataset = InputPatchPairDataset(torch.randint(0, 11, (4, 6)), torch.randint(0, 11, (3, 6)), cartesian_product=True)
+
+    metrics = experiment.calculate_circuit_performances_for_large_sample(circuits, dataset.data_loader(batch_size=3))
+    summaries = {"random": StreamingMetricSummary(k=5, histogram_range=(0.0, 1.0), num_bins=10)}
+    experiment.summarize_circuit_performances(circuits, dataset, batch_size=3, summaries=summaries)
+
+    top = torch.topk(metrics["random"], k=5)
+    assert torch.allclose(summaries["random"].top_values.float(), top.values)
+    assert torch.equal(summaries["random"].top_pair_indices, dataset.pair_indices()[top.indices])
+    assert summaries["random"].count == len(dataset) == 12
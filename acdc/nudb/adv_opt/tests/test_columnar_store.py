@@ -0,0 +1,95 @@
+from pathlib import Path
+
+import torch
+import yaml
+
+from acdc.nudb.adv_opt.analysis.columnar_store import ColumnarResultsStore
+from acdc.nudb.adv_opt.data_fetchers import AdvOptTaskName
+from acdc.nudb.adv_opt.main_circuit_performance_distribution import CircuitPerformanceDistributionResults
+from acdc.nudb.adv_opt.results_store import ConsolidatedResults, SweepRun
+from acdc.nudb.adv_opt.settings import ExperimentArtifacts
+
+
+def make_artifacts(with_restarts: bool) -> ExperimentArtifacts:
+    return ExperimentArtifacts(
+        base_input=torch.randint(0, 10, (5, 3)),
+        base_patch_input=torch.randint(0, 10, (5, 3)),
+        coefficients_init=torch.rand(5),
+        coefficients_final=torch.rand(5),
+        coefficients_init_patch=torch.rand(5),
+        coefficients_final_patch=torch.rand(5),
+        coefficients_final_all_restarts=torch.rand(2, 5) if with_restarts else None,
+        final_losses_all_restarts=torch.rand(2) if with_restarts else None,
+    )
+
+
+def write_hydra_output_dir(path: Path, config: dict) -> None:
+    (path / ".hydra").mkdir(parents=True)
+    (path / ".hydra" / "config.yaml").write_text(yaml.safe_dump(config))
+
+
+def assert_artifacts_equal(loaded: ExperimentArtifacts, expected: ExperimentArtifacts) -> None:
+    for name, value in vars(expected).items():
+        assert (value is None and getattr(loaded, name) is None) or torch.equal(getattr(loaded, name), value), name
+
+
+def test_ingest_then_query(tmp_path: Path):
+    outputs = tmp_path / "outputs"
+    artifacts = {}
+    for seed, task in enumerate(["IOI", "IOI", "DOCSTRING"]):
+        write_hydra_output_dir(outputs / f"run_{seed}", {"task": {"task_name": task}, "random_seed": seed})
+        artifacts[seed] = make_artifacts(with_restarts=seed > 0)
+        artifacts[seed].save(outputs / f"run_{seed}" / "artifacts")
+
+    write_hydra_output_dir(outputs / "bruteforce", {"task": {"task_name": "IOI"}, "circuits": ["canonical"]})
+    brute_force_results = CircuitPerformanceDistributionResults(
+        experiment_name=AdvOptTaskName.IOI,
+        metrics={"canonical": torch.rand(6), "random": torch.rand(6)},
+        test_data=torch.randint(0, 10, (3, 4)),
+        test_patch_data=torch.randint(0, 10, (2, 4)),
+        random_circuit=[],
+        pair_indices=torch.cartesian_prod(torch.arange(3), torch.arange(2)),
+    )
+    brute_force_results.save(outputs / "bruteforce" / "artifacts")
+
+    store = ColumnarResultsStore(tmp_path / "store")
+    assert len(store.ingest([outputs])) == 4
+    assert store.ingest([outputs, outputs / "run_0"]) == []  # every run is only added once
+
+    runs = store.runs()
+    assert sorted(runs["kind"]) == ["adv_opt"] * 3 + ["brute_force"]
+    ioi_runs = store.runs(where={"config.task.task_name": "IOI", "kind": "adv_opt"})
+    assert sorted(ioi_runs["config.random_seed"]) == [0, 1]
+
+    examples = store.adv_opt_examples(["coefficients_final"], where={"config.random_seed": [1, 2]})
+    assert list(examples.columns) == ["run_id", "example", "coefficients_final"]
+    assert len(examples) == 10
+    for seed in range(3):
+        (run_id,) = store.runs(where={"config.random_seed": seed})["run_id"]
+        assert_artifacts_equal(store.adv_opt_artifacts(run_id), artifacts[seed])
+
+    pairs = store.brute_force_pairs(["metric_canonical"])
+    assert torch.equal(torch.tensor(pairs["metric_canonical"].to_numpy()), brute_force_results.metrics["canonical"])
+    assert pairs[["input_index", "patch_input_index"]].values.tolist() == brute_force_results.pair_indices.tolist()
+    inputs = store.brute_force_inputs()
+    assert inputs["input"].map(list).tolist() == brute_force_results.test_data.tolist()
+    assert inputs["patch_input"].isna().tolist() == [False, False, True]
+
+
+def test_ingest_consolidated_results(tmp_path: Path):
+    results = ConsolidatedResults()
+    for seed in range(2):
+        results.add(
+            SweepRun(
+                name=str(seed),
+                config={"task": {"task_name": "TRACR_REVERSE"}, "random_seed": seed},
+                artifacts=make_artifacts(with_restarts=True),
+                output_dir=tmp_path / "sweep" / str(seed),
+            )
+        )
+    results.save(tmp_path / "sweep" / "consolidated")
+
+    store = ColumnarResultsStore(tmp_path / "store")
+    assert len(store.ingest([tmp_path / "sweep" / "consolidated"])) == 2
+    (run_id,) = store.runs(where={"config.random_seed": 1})["run_id"]
+    assert_artifacts_equal(store.adv_opt_artifacts(run_id), results.runs[1].artifacts)
@@ -0,0 +1,89 @@
+import json
+from pathlib import Path
+from typing import Callable
+
+import pytest
+import torch
+
+from acdc.nudb.adv_opt import experiment_data_cache
+from acdc.nudb.adv_opt.data_fetchers import AdvOptExperimentData, AdvOptTaskName
+from acdc.nudb.adv_opt.experiment_data_cache import (
+    ExperimentDataCacheMiss,
+    MetricsNotCached,
+    get_experiment_data_cached,
+    load_experiment_data,
+    save_experiment_data,
+)
+
+
+def test_save_then_load(tmp_path: Path, make_experiment_data: Callable[..., AdvOptExperimentData]):
+    experiment_data = make_experiment_data()
+    parameters = {"num_examples": 5, "metric_name": "kl_div"}
+    save_experiment_data(tmp_path, experiment_data, parameters)
+    loaded = load_experiment_data(tmp_path, AdvOptTaskName.DOCSTRING, parameters)
+
+    for name in experiment_data_cache.TASK_TENSOR_NAMES:
+        original, cached = getattr(experiment_data.task_data, name), getattr(loaded.task_data, name)
+        assert (original is None and cached is None) or torch.equal(original, cached)
+    assert loaded.circuit_edges == experiment_data.circuit_edges
+    assert loaded.ablated_edges == experiment_data.ablated_edges
+    assert loaded.metric_last_sequence_position_only
+    data = experiment_data.task_data.test_data
+    assert torch.equal(loaded.masked_runner.masked_transformer.model(data), experiment_data.task_data.tl_model(data))
+
+    with pytest.raises(MetricsNotCached):
+        loaded.task_data.validation_metric(data)
+
+    with pytest.raises(ExperimentDataCacheMiss):
+        load_experiment_data(tmp_path, AdvOptTaskName.DOCSTRING, parameters | {"num_examples": 6})
+    metadata_path = tmp_path / "docstring" / "metadata.json"
+    metadata_path.write_text(json.dumps(json.loads(metadata_path.read_text()) | {"version": -1}))
+    with pytest.raises(ExperimentDataCacheMiss):
+        load_experiment_data(tmp_path, AdvOptTaskName.DOCSTRING, parameters)
+
+
+def test_get_experiment_data_cached_only_creates_the_data_once(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, make_experiment_data: Callable[..., AdvOptExperimentData]
+):
+    calls = []
+
+    def get_standard_experiment_data(task_name: AdvOptTaskName) -> AdvOptExperimentData:
+        calls.append(task_name)
+        return make_experiment_data()
+
+    monkeypatch.setattr(experiment_data_cache, "get_standard_experiment_data", get_standard_experiment_data)
+    first = get_experiment_data_cached(AdvOptTaskName.DOCSTRING, cache_dir=tmp_path)
+    second = get_experiment_data_cached(AdvOptTaskName.DOCSTRING, cache_dir=tmp_path)
+    assert calls == [AdvOptTaskName.DOCSTRING]
+    assert torch.equal(first.task_data.test_data, second.task_data.test_data)
+    assert len(list((tmp_path / "weights").iterdir())) == 1
+
+
+def test_save_keeps_an_entry_that_is_still_valid(
+    tmp_path: Path, make_experiment_data: Callable[..., AdvOptExperimentData]
+):
+    experiment_data = make_experiment_data()
+    parameters = {"num_examples": 5}
+    save_experiment_data(tmp_path, experiment_data, parameters)
+    test_data_path = tmp_path / "docstring" / "test_data.pt"
+    inode = test_data_path.stat().st_ino
+
+    # e.g. another process that missed the cache at the same time stores the same data
+    save_experiment_data(tmp_path, experiment_data, parameters)
+    assert test_data_path.stat().st_ino == inode
+    assert [path.name for path in tmp_path.iterdir() if path.name.startswith(".")] == []
+
+    # a stale entry is replaced
+    save_experiment_data(tmp_path, experiment_data, parameters | {"num_examples": 6})
+    load_experiment_data(tmp_path, AdvOptTaskName.DOCSTRING, parameters | {"num_examples": 6})
+
+
+def test_load_of_an_entry_that_is_being_replaced_is_a_cache_miss(
+    tmp_path: Path, make_experiment_data: Callable[..., AdvOptExperimentData]
+):
+    parameters = {"num_examples": 5}
+    save_experiment_data(tmp_path, make_experiment_data(), parameters)
+    (tmp_path / "docstring" / "test_labels.pt").unlink()
+
+    with pytest.raises(ExperimentDataCacheMiss, match="test_labels.pt"):
+        load_experiment_data(tmp_path, AdvOptTaskName.DOCSTRING, parameters)
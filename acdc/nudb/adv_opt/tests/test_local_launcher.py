@@ -0,0 +1,26 @@
+from pathlib import Path
+
+from acdc.nudb.adv_opt.data_fetchers import AdvOptTaskName
+from acdc.nudb.adv_opt.experiments.core.local_launcher import compose_runs, expand_sweep
+
+
+def test_expand_sweep():
+    assert expand_sweep(["task=ioi,greaterthan", "random_seed=range(1,3)", "num_epochs=3"]) == [
+        ["task=ioi", "random_seed=1", "num_epochs=3"],
+        ["task=ioi", "random_seed=2", "num_epochs=3"],
+        ["task=greaterthan", "random_seed=1", "num_epochs=3"],
+        ["task=greaterthan", "random_seed=2", "num_epochs=3"],
+    ]
+
+
+def test_compose_runs_includes_the_sweeper_params_of_the_config(tmp_path: Path):
+    # the experiment sweeps over task (overridden here) and 10 random seeds
+    runs = compose_runs(["+experiment=sweep_w09_3_many_seeds", "task=tracr_reverse,docstring"], tmp_path)
+
+    assert len(runs) == 20
+    assert [run.settings.task.task_name for run in runs] == [AdvOptTaskName.DOCSTRING] * 10 + [
+        AdvOptTaskName.TRACR_REVERSE
+    ] * 10
+    assert {run.settings.random_seed for run in runs} == set(range(4321, 4331))
+    assert runs[0].settings.num_epochs == 400
+    assert len({run.output_dir for run in runs}) == 20
@@ -0,0 +1,59 @@
+from pathlib import Path
+from typing import Callable
+
+import omegaconf
+import pytest
+import torch
+
+from acdc.nudb.adv_opt import main
+from acdc.nudb.adv_opt.data_fetchers import AdvOptExperimentData, AdvOptTaskName
+from acdc.nudb.adv_opt.settings import CoefficientRenormalization, ExperimentSettings, TaskSpecificSettings
+
+
+def run_with_initial_coefficients(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    experiment_data: AdvOptExperimentData,
+    coefficients: torch.Tensor,
+    coefficients_patch: torch.Tensor,
+):
+    initial_coefficients = iter([coefficients, coefficients_patch])
+    monkeypatch.setattr(main.torch, "rand", lambda *shape, device=None: next(initial_coefficients).clone())
+    settings = omegaconf.OmegaConf.structured(
+        ExperimentSettings(
+            task=TaskSpecificSettings(task_name=AdvOptTaskName.DOCSTRING),
+            num_epochs=25,
+            # small enough that the gradient-based learning rate is below its ceiling, so it depends on the gradient
+            adam_lr=1e-4,
+            random_seed=0,
+            adam_lr_schedule="gradient_based",
+            coefficient_renormalization=CoefficientRenormalization.gradual,
+            num_restarts=coefficients.shape[0],
+        )
+    )
+    return main.run_experiment(settings, tmp_path, experiment_data=experiment_data)  # pyright: ignore
+
+
+def test_restarts_are_optimized_as_if_they_ran_alone(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, make_experiment_data: Callable[..., AdvOptExperimentData]
+):
+    monkeypatch.setenv("WANDB_MODE", "disabled")
+    torch.manual_seed(1)
+    coefficients, coefficients_patch = torch.rand(2, 9), torch.rand(2, 9)
+    # the restarts start far apart, so their gradients (and with them, their learning rates) differ
+    coefficients[0] *= 100
+
+    together = run_with_initial_coefficients(
+        tmp_path / "together", monkeypatch, make_experiment_data(), coefficients, coefficients_patch
+    )
+    alone = run_with_initial_coefficients(
+        tmp_path / "alone", monkeypatch, make_experiment_data(), coefficients[1:], coefficients_patch[1:]
+    )
+
+    assert together.coefficients_final_all_restarts is not None and alone.coefficients_final_all_restarts is not None
+    assert not torch.allclose(together.coefficients_final_all_restarts[1], coefficients[1])
+    torch.testing.assert_close(together.coefficients_final_all_restarts[1], alone.coefficients_final_all_restarts[0])
+    torch.testing.assert_close(
+        together.coefficients_final_patch_all_restarts[1],  # pyright: ignore
+        alone.coefficients_final_patch_all_restarts[0],  # pyright: ignore
+    )
@@ -0,0 +1,56 @@
+from pathlib import Path
+
+import torch
+
+from acdc.nudb.adv_opt.results_store import ConsolidatedResults, SweepRun
+from acdc.nudb.adv_opt.settings import ExperimentArtifacts
+
+
+def test_save_then_load(tmp_path: Path):
+    base_input = torch.randint(0, 10, (5, 3))
+    results = ConsolidatedResults()
+    for seed in range(3):
+        results.add(
+            SweepRun(
+                name=str(seed),
+                config={"task": {"task_name": "TRACR_REVERSE"}, "random_seed": seed},
+                artifacts=ExperimentArtifacts(
+                    base_input=base_input.clone(),
+                    base_patch_input=base_input.flip(0),
+                    coefficients_final=torch.rand(5),
+                    final_losses_all_restarts=torch.rand(2),
+                ),
+                output_dir=tmp_path / str(seed),
+            )
+        )
+    results.save(tmp_path / "consolidated")
+    loaded = ConsolidatedResults.load(tmp_path / "consolidated")
+
+    assert len(list((tmp_path / "consolidated" / "shared").iterdir())) == 2
+    for run, loaded_run in zip(results.runs, loaded.runs):
+        assert (loaded_run.name, loaded_run.config, loaded_run.output_dir) == (run.name, run.config, run.output_dir)
+        for name in ["base_input", "base_patch_input", "coefficients_final", "final_losses_all_restarts"]:
+            assert torch.equal(getattr(loaded_run.artifacts, name), getattr(run.artifacts, name))
+        assert loaded_run.artifacts.coefficients_init is None
+
+
+def test_save_run_only_appends(tmp_path: Path):
+    results = ConsolidatedResults()
+    for name in ["a", "b"]:
+        run = SweepRun(
+            name=name, config={"random_seed": name}, artifacts=ExperimentArtifacts(base_input=torch.ones(2, 3))
+        )
+        results.add(run)
+        ConsolidatedResults.save_run(tmp_path, run)
+    first_artifacts_mtime = (tmp_path / "artifacts" / "a.pt").stat().st_mtime_ns
+    results.save(tmp_path)  # both runs are already saved
+
+    # a crash while writing the index leaves an incomplete last line, whose run is ignored
+    with open(tmp_path / "runs.jsonl", "a") as index:
+        index.write('{"name": "c", "con')
+    assert [run.name for run in ConsolidatedResults.load(tmp_path).runs] == ["a", "b"]
+    run = SweepRun(name="d", config={}, artifacts=ExperimentArtifacts(base_input=torch.ones(2, 3)))
+    ConsolidatedResults.save_run(tmp_path, run)
+    assert [run.name for run in ConsolidatedResults.load(tmp_path).runs] == ["a", "b", "d"]
+    assert (tmp_path / "artifacts" / "a.pt").stat().st_mtime_ns == first_artifacts_mtime
+    assert len(list((tmp_path / "shared").iterdir())) == 1
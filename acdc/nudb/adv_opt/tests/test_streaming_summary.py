@@ -0,0 +1,39 @@
+import torch
+
+from acdc.nudb.adv_opt.streaming_summary import StreamingMetricSummary
+
+
+def test_summary_in_batches_agrees_with_all_metrics_at_once(tmp_path):
+    generator = torch.Generator().manual_seed(0)
+    values = torch.rand(1000, generator=generator) * 12 - 1  # partly outside the histogram range
+    values[3] = 10.0  # the end of the histogram range is included in the last bin
+    pair_indices = torch.stack([torch.arange(1000) % 10, torch.arange(1000) // 10], dim=-1)
+
+    summary = StreamingMetricSummary(k=7, histogram_range=(0.0, 10.0), num_bins=20, spill_dir=tmp_path / "spilled")
+    for start in range(0, 1000, 64):
+        summary.update(values[start : start + 64], pair_indices[start : start + 64])
+
+    top = torch.topk(values, k=7)
+    assert torch.allclose(summary.top_values, top.values.double())
+    assert torch.equal(summary.top_pair_indices, pair_indices[top.indices])
+
+    in_range = values[(values >= 0) & (values <= 10)]
+    assert torch.equal(
+        summary.histogram_counts[1:-1], torch.histogram(in_range, bins=20, range=(0.0, 10.0)).hist.long()
+    )
+    assert summary.histogram_counts[0] == (values < 0).sum()
+    assert summary.histogram_counts[-1] == (values > 10).sum()
+
+    assert summary.count == 1000
+    assert abs(summary.mean - values.double().mean().item()) < 1e-9
+    assert abs(summary.variance - values.double().var().item()) < 1e-9
+    assert (summary.min, summary.max) == (values.min().item(), values.max().item())
+
+    spilled_values, spilled_pair_indices = summary.load_spilled()
+    assert torch.equal(spilled_values, values)
+    assert torch.equal(spilled_pair_indices, pair_indices)
+
+    summary.save(tmp_path / "summary.pt")
+    loaded = StreamingMetricSummary.load(tmp_path / "summary.pt")
+    assert torch.equal(loaded.histogram_counts, summary.histogram_counts)
+    assert (loaded.count, loaded.mean, loaded.spill_dir) == (summary.count, summary.mean, summary.spill_dir)
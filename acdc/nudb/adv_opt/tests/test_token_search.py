@@ -0,0 +1,66 @@
+import dataclasses
+from typing import Callable
+
+import torch
+
+from acdc.nudb.adv_opt.data_fetchers import AdvOptExperimentData
+from acdc.nudb.adv_opt.main_token_search import TokenConstraints, TokenSearchExperiment
+
+
+def make_experiment(experiment_data: AdvOptExperimentData) -> tuple[TokenSearchExperiment, torch.Tensor, torch.Tensor]:
+    all_edges = sorted(experiment_data.masked_runner.all_ablatable_edges, key=str)
+    experiment_data = dataclasses.replace(experiment_data, circuit_edges=all_edges[::2])
+    torch.manual_seed(0)
+    inputs, patch_inputs = torch.randint(0, 11, (8, 6)), torch.randint(0, 11, (8, 6))
+    inputs[:, 0] = 0  # a fixed token, like a BOS token
+    # don't allow token 10 anywhere, nor token 3 at position 2
+    constraints = TokenConstraints.from_examples(inputs, 11, is_valid=lambda sequences: (sequences != 10).all(dim=-1))
+    constraints.allowed_tokens[2, 3] = False
+    return TokenSearchExperiment(experiment_data, constraints, batch_size=5), inputs, patch_inputs
+
+
+def test_candidates_change_one_allowed_token(make_experiment_data: Callable[..., AdvOptExperimentData]):
+    experiment, inputs, patch_inputs = make_experiment(make_experiment_data())
+    gradients = experiment.token_gradients(inputs, patch_inputs)
+    assert gradients.shape == (8, 6, 11)
+
+    candidates, parents = experiment.candidates(
+        inputs, gradients, num_candidates=100, top_k_tokens=4, generator=torch.Generator().manual_seed(0)
+    )
+    assert len(candidates) > 0
+    assert ((candidates != inputs[parents]).sum(dim=-1) == 1).all()
+    assert experiment.constraints.filter(candidates).all()
+    assert (candidates[:, 0] == 0).all()
+
+
+def test_search_only_improves_the_beam(make_experiment_data: Callable[..., AdvOptExperimentData]):
+    experiment, inputs, patch_inputs = make_experiment(make_experiment_data())
+    results = experiment.search(
+        inputs,
+        patch_inputs,
+        num_rounds=5,
+        beam_width=3,
+        num_candidates=20,
+        top_k_tokens=4,
+        generator=torch.Generator().manual_seed(0),
+    )
+
+    assert results.inputs.shape == (3, 6)
+    assert len(results.loss_history) == 6
+    assert (results.loss_history.diff() >= 0).all()
+    assert results.loss_history[0] == experiment.losses(inputs, patch_inputs).max()
+    assert torch.allclose(results.losses, experiment.losses(results.inputs, results.patch_inputs), atol=1e-5)
+    assert experiment.constraints.filter(results.inputs).all()
+    assert len({tuple(row) for row in results.inputs.tolist()}) == 3
+
+
+def test_token_gradients_reuse_the_ablation_cache(make_experiment_data: Callable[..., AdvOptExperimentData]):
+    experiment, inputs, patch_inputs = make_experiment(make_experiment_data())
+    masked_runner = experiment.experiment_data.masked_runner
+    gradients = experiment.token_gradients(inputs, patch_inputs)
+    misses = masked_runner.ablation_cache_misses
+
+    # like the next round of the search, which keeps the patch inputs of the beam
+    assert torch.equal(experiment.token_gradients(inputs, patch_inputs.clone()), gradients)
+    assert masked_runner.ablation_cache_misses == misses
+    assert masked_runner.ablation_cache_hits > 0
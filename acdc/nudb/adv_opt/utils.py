@@ -5,7 +5,6 @@ from pathlib import Path
 from typing import Any, Callable, Iterable, TypeVar
 
 import torch
-from joblib import Memory
 
 num_examples = 5
 metric = "kl_div"
@@ -22,7 +21,6 @@ def tensor_fingerprint(tensor: torch.Tensor) -> str:
     return md5(json.dumps((tensor * 1000).int().tolist()).encode("utf8")).hexdigest()[0:8]
 
 
-joblib_memory = Memory(CIRCUITBENCHMARKS_DATA_DIR / "joblib", verbose=0)
 TIn = TypeVar("TIn")
 
 
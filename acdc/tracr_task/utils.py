@@ -1,8 +1,15 @@
 from acdc.docstring.utils import AllDataThings
 from acdc.types import EdgeAsTuple
 
+import importlib.metadata
+import json
+import os
+import shutil
+import tempfile
 from collections import OrderedDict
+from dataclasses import dataclass
 from functools import partial
+from pathlib import Path
 from typing import (
     Literal,
 )
@@ -11,19 +18,109 @@ import einops
 import numpy as np
 import torch
 import torch.nn.functional as F
-from tracr.compiler import compiling
-from tracr.rasp import rasp
 from transformer_lens import HookedTransformer, HookedTransformerConfig
 
 from acdc.acdc_utils import kl_divergence
 
 bos = "BOS"
 
+TRACR_MODEL_CACHE_DIR = Path(os.environ.get("ACDC_TRACR_CACHE_DIR", Path.home() / ".cache" / "acdc" / "tracr_models"))
+# Increase this when the conversion of the tracr models or the format of the cache changes: caches with another
+# version are not used.
+TRACR_MODEL_CACHE_VERSION = 1
 
-def get_tracr_model_input_and_tl_model(task: Literal["reverse", "proportion"], device, return_im=False):
+
+def get_tracr_model_input_and_tl_model(
+    task: Literal["reverse", "proportion"], device, return_im=False, cache_dir: Path | None = TRACR_MODEL_CACHE_DIR
+):
     """
     This function adapts Neel's TransformerLens porting of tracr
+
+    The converted model is cached in 'cache_dir', by task and tracr version, so that later calls build the
+    HookedTransformer from the cache without importing JAX or compiling the RASP program. If 'cache_dir' is None, the
+    model is always compiled.
     """
+    if task not in ("reverse", "proportion"):
+        raise ValueError(f"Unknown task {task}")
+
+    model_dir = _tracr_model_cache_dir(cache_dir, task) if cache_dir is not None else None
+    tl_model = None
+    cached_model_is_stale = False
+    if model_dir is not None and (parts := _load_tracr_model_parts(model_dir)) is not None:
+        try:
+            tl_model = _tl_model_from_parts(parts, device, strict=True)
+        except RuntimeError as e:  # e.g. the parameters of the HookedTransformer changed since the cache was made
+            print(f"Cached tracr model in {model_dir} doesn't fit the HookedTransformer; compiling it again: {e}")
+            cached_model_is_stale = True
+    if tl_model is None:
+        parts = _compile_tracr_model_parts(task)
+        if model_dir is not None:
+            _save_tracr_model_parts(model_dir, parts, replace=cached_model_is_stale)
+        tl_model = _tl_model_from_parts(parts, device)
+
+    # Create helper functions to do the tokenization and de-tokenization
+
+    INPUT_ENCODER = _CategoricalEncoder(parts.input_encoding_map)
+
+    def create_model_input(input, input_encoder=INPUT_ENCODER, device=device):
+        encoding = input_encoder.encode(input)
+        return torch.tensor(encoding).unsqueeze(dim=0).to(device)
+
+    # Look how pretty and ordered the final residual stream is!
+    #
+    # (The logits are the first 3 dimensions of the residual stream, and we can see that they're flipped!)
+
+    if return_im:
+        input = [bos, 1, 2, 3] if task == "reverse" else [bos, "x", "w", "w", "x"]
+        _, cache = tl_model.run_with_cache(create_model_input(input))
+        im = cache["resid_post", -1].detach().cpu().numpy()[0]
+        # px.imshow(im, color_continuous_scale="Blues", labels={"x":"Residual Stream", "y":"Position"}, y=[str(i) for i in input]).show()
+        return im
+
+    else:
+        return create_model_input, tl_model
+
+
+@dataclass
+class _TracrModelParts:
+    """What is needed to build the HookedTransformer of a compiled tracr model, without tracr."""
+
+    cfg_kwargs: dict
+    state_dict: dict[str, torch.Tensor]
+    # (token, encoding) pairs, because the tokens can be ints or strings
+    input_encoding_map: list[tuple[int | str, int]]
+    output_encoding_map: list[tuple[int | str, int]] | None  # None for numerical outputs
+
+
+class _CategoricalEncoder:
+    """Like tracr's CategoricalEncoder, so that the cached models don't need tracr."""
+
+    def __init__(self, encoding_map: list[tuple[int | str, int]]):
+        self.encoding_map = dict(encoding_map)
+        self.decoding_map = {encoding: token for token, encoding in encoding_map}
+        self.bos_token = bos
+
+    def encode(self, inputs: list) -> list[int]:
+        return [self.encoding_map[token] for token in inputs]
+
+    def decode(self, encodings: list[int]) -> list:
+        return [self.decoding_map[encoding] for encoding in encodings]
+
+
+def _tl_model_from_parts(parts: _TracrModelParts, device, strict: bool = False) -> HookedTransformer:
+    """With strict=False, the weights that are not in 'parts' (the buffers, for a model that was just compiled) keep
+    their initial values."""
+    tl_model = HookedTransformer(HookedTransformerConfig(**parts.cfg_kwargs, device=device))
+    if "use_hook_mlp_in" in tl_model.cfg.to_dict():  # both tracr models include MLPs
+        tl_model.set_use_hook_mlp_in(True)
+    tl_model.load_state_dict(parts.state_dict, strict=strict)
+    return tl_model
+
+
+def _compile_tracr_model_parts(task: Literal["reverse", "proportion"]) -> _TracrModelParts:
+    # tracr imports JAX, which takes longer than everything else here, so only import it when compiling
+    from tracr.compiler import compiling
+    from tracr.rasp import rasp
 
     # Loads an example RASP program model. This program reverses lists. The model takes as input a list of pre-tokenization elements (here `["BOS", 1, 2, 3]`), these are tokenized (`[3, 0, 1, 2]`), the transformer is applied, and then an argmax is taken over the output and it is detokenized - this can be seen on the `out.decoded` attribute of the output
 
@@ -78,7 +175,7 @@ def get_tracr_model_input_and_tl_model(task: Literal["reverse", "proportion"], d
     # Equivalent to length of vocab, WITHOUT BOS and PAD at the end because we never care about these outputs
     d_vocab_out = model.params["token_embed"]["embeddings"].shape[0] - 2
 
-    cfg = HookedTransformerConfig(
+    cfg_kwargs = dict(
         n_layers=n_layers,
         d_model=d_model,
         d_head=d_head,
@@ -92,12 +189,7 @@ def get_tracr_model_input_and_tl_model(task: Literal["reverse", "proportion"], d
         normalization_type=normalization_type,
         use_attn_result=True,
         use_split_qkv_input=True,
-        device=device,
     )
-    tl_model = HookedTransformer(cfg)
-    if "use_hook_mlp_in" in tl_model.cfg.to_dict():  # both tracr models include MLPs
-        tl_model.set_use_hook_mlp_in(True)
-
     # Extract the state dict, and do some reshaping so that everything has a n_heads dimension
     sd = {}
     sd["pos_embed.W_pos"] = model.params["pos_embed"]["embeddings"]
@@ -165,16 +257,28 @@ def get_tracr_model_input_and_tl_model(task: Literal["reverse", "proportion"], d
         # I cannot figure out a neater way to go from a Jax array to a numpy array lol
         sd[k] = torch.tensor(np.array(v))
 
-    tl_model.load_state_dict(sd, strict=False)
+    parts = _TracrModelParts(
+        cfg_kwargs=cfg_kwargs,
+        state_dict=sd,
+        input_encoding_map=sorted(model.input_encoder.encoding_map.items(), key=lambda item: item[1]),
+        output_encoding_map=(
+            sorted(model.output_encoder.encoding_map.items(), key=lambda item: item[1])
+            if hasattr(model.output_encoder, "encoding_map")
+            else None
+        ),
+    )
+    tl_model = _tl_model_from_parts(parts, device="cpu")
+    # cache the state dict of the HookedTransformer, which has all weights (and the dtypes of the model)
+    parts.state_dict = tl_model.state_dict()
 
     # Create helper functions to do the tokenization and de-tokenization
 
     INPUT_ENCODER = model.input_encoder
     OUTPUT_ENCODER = model.output_encoder
 
-    def create_model_input(input, input_encoder=INPUT_ENCODER, device=device):
+    def create_model_input(input, input_encoder=INPUT_ENCODER):
         encoding = input_encoder.encode(input)
-        return torch.tensor(encoding).unsqueeze(dim=0).to(device)
+        return torch.tensor(encoding).unsqueeze(dim=0)
 
     if task == "reverse":  # this doesn't make sense for proportion
 
@@ -228,18 +332,67 @@ def get_tracr_model_input_and_tl_model(task: Literal["reverse", "proportion"], d
             ).all(),
         )
 
-    # Look how pretty and ordered the final residual stream is!
-    #
-    # (The logits are the first 3 dimensions of the residual stream, and we can see that they're flipped!)
-
-    im = cache["resid_post", -1].detach().cpu().numpy()[0]
-    # px.imshow(im, color_continuous_scale="Blues", labels={"x":"Residual Stream", "y":"Position"}, y=[str(i) for i in input]).show()
+    return parts
+
+
+def _package_version(name: str) -> str:
+    """The version of the installed package 'name', without importing it (tracr imports JAX)."""
+    distribution = importlib.metadata.distribution(name)
+    # tracr is installed from git, so the version alone doesn't say which commit it is
+    direct_url = json.loads(distribution.read_text("direct_url.json") or "{}")
+    commit = direct_url.get("vcs_info", {}).get("commit_id")
+    return distribution.version if commit is None else f"{distribution.version}+{commit[:12]}"
+
+
+def _tracr_model_cache_dir(cache_dir: Path, task: str) -> Path | None:
+    """None if the tracr version is not known (e.g. tracr is not installed as a package); the model isn't cached
+    then."""
+    try:
+        tracr_version = _package_version("tracr")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+    # the state dict is that of a HookedTransformer, so it depends on the version of transformer_lens too
+    transformer_lens_version = _package_version("transformer_lens")
+    return cache_dir / (
+        f"{task}-tracr_{tracr_version}-transformer_lens_{transformer_lens_version}-v{TRACR_MODEL_CACHE_VERSION}"
+    )
 
-    if return_im:
-        return im
 
-    else:
-        return create_model_input, tl_model
+def _save_tracr_model_parts(model_dir: Path, parts: _TracrModelParts, replace: bool = False) -> None:
+    """Stores 'parts' in 'model_dir', unless another process stored them there first. An existing entry is only
+    removed if 'replace' is set (it didn't fit the HookedTransformer); other processes may be loading it."""
+    model_dir.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary directory first, so that other processes never see a half-written cache
+    tmp_dir = Path(tempfile.mkdtemp(dir=model_dir.parent, prefix=f".{model_dir.name}_"))
+    torch.save({name: tensor.cpu() for name, tensor in parts.state_dict.items()}, tmp_dir / "state_dict.pt")
+    metadata = {
+        "cfg_kwargs": parts.cfg_kwargs,
+        "input_encoding_map": parts.input_encoding_map,
+        "output_encoding_map": parts.output_encoding_map,
+    }
+    (tmp_dir / "metadata.json").write_text(json.dumps(metadata, indent=2))
+    if replace:
+        shutil.rmtree(model_dir, ignore_errors=True)
+    try:
+        tmp_dir.rename(model_dir)
+    except OSError:  # another process stored it first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _load_tracr_model_parts(model_dir: Path) -> _TracrModelParts | None:
+    """None if there is no entry in 'model_dir' (or another process removed it while it was loaded)."""
+    try:
+        metadata = json.loads((model_dir / "metadata.json").read_text())
+        state_dict = torch.load(model_dir / "state_dict.pt", map_location="cpu", weights_only=True)
+    except FileNotFoundError:
+        return None
+    output_encoding_map = metadata["output_encoding_map"]
+    return _TracrModelParts(
+        cfg_kwargs=metadata["cfg_kwargs"],
+        state_dict=state_dict,
+        input_encoding_map=[tuple(item) for item in metadata["input_encoding_map"]],
+        output_encoding_map=None if output_encoding_map is None else [tuple(item) for item in output_encoding_map],
+    )
 
 
 # get some random permutation with no fixed points
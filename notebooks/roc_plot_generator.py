@@ -94,7 +94,11 @@ from acdc.tracr_task.utils import (
     get_tracr_reverse_edges,
 )
 from notebooks.emacs_plotly_render import set_plotly_renderer
-from subnetwork_probing.train import iterative_correspondence_from_mask
+from subnetwork_probing.train import (
+    CorrespondenceSnapshot,
+    CorrespondenceSnapshots,
+    iterative_correspondence_from_mask,
+)
 
 set_plotly_renderer("emacs")
 
@@ -822,7 +826,7 @@ def get_sp_corrs(
         score_d = {k: v for k, v in run.summary.items() if k.startswith("test")}
         score_d["steps"] = run.summary["_step"]
         score_d["score"] = run.config["lambda_reg"]
-        corrs.append((deepcopy(corr), score_d))
+        corrs.append((corr, score_d))  # a new correspondence for every run
 
     return corrs
 
@@ -855,7 +859,6 @@ def get_sixteen_heads_corrs(
 
     nodes_names_indices = run.summary["nodes_names_indices"]
 
-    nodes_to_mask = []
     cum_score = 0.0
     test_keys = [k for k in run.summary.keys() if k.startswith("test")]
     score_d_list = list(run.scan_history(keys=test_keys, page_size=100000))
@@ -864,24 +867,28 @@ def get_sixteen_heads_corrs(
     corr, head_parents = iterative_correspondence_from_mask(
         model=model, nodes_to_mask=[], use_pos_embed=exp.use_pos_embed
     )
-    corrs = [(corr, {"score": 0.0, **score_d_list[0]})]
+    # Instead of a copy of the correspondence for every step, we only record which edges are removed in every step
+    # (see `get_points` for how the circuits are read back)
+    snapshots = CorrespondenceSnapshots(corr)
+    corrs = [(snapshots.record(), {"score": 0.0, **score_d_list[0]})]
     for (nodes, hook_name, idx, score), score_d in tqdm(zip(nodes_names_indices, score_d_list[1:])):
         if score == "NaN":
             score = 0.0
         if things is None:
-            corr = None
+            snapshot = None
         else:
-            nodes_to_mask += list(map(parse_interpnode, nodes))
+            # the nodes of the previous steps have already been masked in `corr`
             corr, head_parents = iterative_correspondence_from_mask(
                 model=model,
-                nodes_to_mask=nodes_to_mask,
+                nodes_to_mask=list(map(parse_interpnode, nodes)),
                 use_pos_embed=exp.use_pos_embed,
                 corr=corr,
                 head_parents=head_parents,
             )
+            snapshot = snapshots.record()
         cum_score += score
         score_d = {"score": cum_score, **score_d}
-        corrs.append((deepcopy(corr), score_d))
+        corrs.append((snapshot, score_d))
     return corrs
 
 
@@ -948,6 +955,8 @@ def get_points(corrs_and_scores, decreasing=True):
             a = init_point.copy()
             a.update(score)
             score = a
+        if isinstance(corr, CorrespondenceSnapshot):
+            corr = corr.correspondence()
 
         n_edges = corr.count_num_edges()
         n_nodes = len(filter_nodes(get_present_nodes(corr)[0]))
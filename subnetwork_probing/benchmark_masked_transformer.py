@@ -0,0 +1,81 @@
+"""Microbenchmark for the forward (and backward) pass of EdgeLevelMaskedTransformer.
+
+Uses a small randomly initialised model, so that it doesn't need to download any weights. Example:
+
+    python subnetwork_probing/benchmark_masked_transformer.py --n-layers 4 --n-heads 8 --num-forwards 200
+"""
+
+import argparse
+import time
+
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from subnetwork_probing.masked_transformer import EdgeLevelMaskedTransformer
+
+
+def make_model(args) -> HookedTransformer:
+    cfg = HookedTransformerConfig(
+        n_layers=args.n_layers,
+        d_model=args.d_model,
+        n_heads=args.n_heads,
+        d_head=args.d_model // args.n_heads,
+        d_mlp=4 * args.d_model,
+        act_fn="gelu",
+        d_vocab=args.d_vocab,
+        n_ctx=args.seq_len,
+        use_attn_result=True,
+        use_split_qkv_input=True,
+        use_hook_mlp_in=True,
+        device=args.device,
+    )
+    return HookedTransformer(cfg)
+
+
+def benchmark(args) -> float:
+    """Returns the average time per forward pass (including backward pass if args.backward), in seconds."""
+    torch.manual_seed(args.seed)
+    masked_model = EdgeLevelMaskedTransformer(make_model(args))
+    masked_model.freeze_weights()
+
+    data = torch.randint(0, args.d_vocab, (args.batch_size, args.seq_len), device=args.device)
+    patch_data = torch.randint(0, args.d_vocab, (args.batch_size, args.seq_len), device=args.device)
+    masked_model.calculate_and_store_ablation_cache(patch_data, retain_cache_gradients=False)
+
+    def step():
+        with masked_model.with_fwd_hooks() as hooked_model:
+            loss = hooked_model(data).logsumexp(dim=-1).mean()
+        if args.backward:
+            loss.backward()
+
+    for _ in range(args.num_warmup):
+        step()
+
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    with torch.set_grad_enabled(bool(args.backward)):
+        for _ in range(args.num_forwards):
+            step()
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.num_forwards
+
+
+parser = argparse.ArgumentParser("python benchmark_masked_transformer.py")
+parser.add_argument("--n-layers", type=int, default=2)
+parser.add_argument("--n-heads", type=int, default=4)
+parser.add_argument("--d-model", type=int, default=32)
+parser.add_argument("--d-vocab", type=int, default=50)
+parser.add_argument("--seq-len", type=int, default=8)
+parser.add_argument("--batch-size", type=int, default=4)
+parser.add_argument("--num-forwards", type=int, default=200)
+parser.add_argument("--num-warmup", type=int, default=10)
+parser.add_argument("--backward", type=int, default=0, help="Also time the backward pass (0/1)")
+parser.add_argument("--device", type=str, default="cpu")
+parser.add_argument("--seed", type=int, default=0)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    seconds_per_forward = benchmark(args)
+    print(f"{seconds_per_forward * 1000:.3f} ms per forward pass{' (+ backward)' if args.backward else ''}")
@@ -21,9 +21,13 @@ def make_yamls(
     reset_networks: bool,
     template_filename: str,
     container: str,
+    lambdas_per_job: int = 1,
 ) -> list[str]:
     """
     Takes a yaml file template and creates many yaml files to pass to kubectl.
+
+    With lambdas_per_job > 1, every job trains the masks for several regularization coefficients at the same time
+    (see --lambda-regs in train_edge_sp.py), instead of starting one job per regularization coefficient.
     """
     NUM_SPACINGS = 5 if reset_networks else 21
     expensive_base_regularization_params = np.concatenate(
@@ -108,7 +112,9 @@ def make_yamls(
                     else:
                         raise ValueError("Unknown task")
 
-                    for lambda_reg in [0.01] if testing else regularization_params:
+                    all_lambda_regs = [0.01] if testing else list(regularization_params)
+                    for job_start in range(0, len(all_lambda_regs), lambdas_per_job):
+                        lambda_regs = all_lambda_regs[job_start : job_start + lambdas_per_job]
                         # should do this simpler way
                         wandb_project = "subnetwork-probing"
                         wandb_entity = "tkwa-team"
@@ -121,7 +127,11 @@ def make_yamls(
                             "python",
                             "subnetwork_probing/train_edge_sp.py",
                             f"--task={task}",
-                            f"--lambda-reg={lambda_reg:.3f}",
+                            *(
+                                [f"--lambda-reg={lambda_regs[0]:.3f}"]
+                                if len(lambda_regs) == 1
+                                else ["--lambda-regs", *(f"{lambda_reg:.3f}" for lambda_reg in lambda_regs)]
+                            ),
                             f"--wandb-name={wandb_name}",
                             f"--wandb-project={wandb_project}",
                             f"--wandb-entity={wandb_entity}",
@@ -1,12 +1,14 @@
 import logging
 import math
 from contextlib import contextmanager
+from dataclasses import dataclass
 from enum import Enum
 from typing import (
     Callable,
     ContextManager,
     Iterable,
     Iterator,
+    Mapping,
     Sequence,
     TypeAlias,
     Union,
@@ -14,14 +16,21 @@ from typing import (
 )
 
 import torch
+import torch.utils.checkpoint
 from einops import rearrange
-from jaxtyping import Float, Num
+from jaxtyping import Bool, Float, Int, Num
 from transformer_lens import ActivationCache, HookedTransformer
 from transformer_lens.hook_points import HookPoint, NamesFilter
 from transformer_lens.HookedTransformer import Loss
 
 from acdc.TLACDCCorrespondence import TLACDCCorrespondence
-from acdc.TLACDCEdge import HookPointName, TorchIndex, EdgeType
+from acdc.TLACDCEdge import (
+    EdgeInfo,
+    HookPointName,
+    IndexedHookPointName,
+    TorchIndex,
+    EdgeType,
+)
 from acdc.acdc_utils import get_present_nodes
 
 logger = logging.getLogger(__name__)
@@ -43,6 +52,22 @@ class CircuitStartingPointType(str, Enum):
     RESID_PRE = "resid_pre"  # uses blocks.0.hook_resid_pre as starting point
 
 
+@dataclass(frozen=True)
+class MaskLogitsSegment:
+    """Where the mask logits of a masked hook point are stored in the flat mask logits tensor."""
+
+    start: int
+    end: int
+    # parentindex, child (number of parent rows, number of instances of the hook point)
+    shape: tuple[int, int]
+
+    def view(
+        self, flat: Float[torch.Tensor, "... n_mask_logits"]
+    ) -> Float[torch.Tensor, "... parent child"]:
+        """The segment of `flat` (which can have leading dimensions) that belongs to this hook point."""
+        return flat[..., self.start : self.end].unflatten(-1, self.shape)
+
+
 def create_mask_parameters_and_forward_cache_hook_points(
     circuit_start_type: CircuitStartingPointType,
     num_heads: int,
@@ -50,15 +75,16 @@ def create_mask_parameters_and_forward_cache_hook_points(
     device: str | torch.device,
     mask_init_constant: float,
     attn_only: bool,
+    num_mask_sets: int | None = None,
 ):
     """
-    Given the relevant configuration for a transformer, this function produces two things:
-
-    1. The parameters for the masks, in a dict that maps a hook point name to its mask parameter
-    2. The hook points that need to be cached on a forward pass.
+    Given the relevant configuration for a transformer, this function produces four things:
 
-    TODO: why don't we keep a friggin dict or something to keep track of how each IndexedHookPoint maps to an index?
-    basically dict[IndexedHookPoint, int] or something like that
+    1. The hook points that need to be cached on a forward pass.
+    2. The parents of every masked hook point.
+    3. The mask logits of all masked hook points, as one flat parameter
+       (with a leading dimension of size `num_mask_sets`, if it is given).
+    4. The segment of the flat parameter that belongs to each masked hook point.
     """
 
     ordered_forward_cache_hook_points: list[HookPointName] = []
@@ -68,8 +94,8 @@ def create_mask_parameters_and_forward_cache_hook_points(
     num_output_units_so_far = 0
 
     hook_point_to_parents: dict[HookPointName, list[HookPointName]] = {}
-    mask_parameter_list = torch.nn.ParameterList()
-    mask_parameter_dict: dict[HookPointName, torch.nn.Parameter] = {}
+    mask_logits_segments: dict[HookPointName, MaskLogitsSegment] = {}
+    num_mask_logits_so_far = 0
 
     # Implementation details:
     #
@@ -91,22 +117,18 @@ def create_mask_parameters_and_forward_cache_hook_points(
 
         We need to add a parameter to mask the input to these units
         """
-        nonlocal num_output_units_so_far
+        nonlocal num_output_units_so_far, num_mask_logits_so_far
         hook_point_to_parents[mask_name] = ordered_forward_cache_hook_points[
             :
         ]  # everything that has come before
 
-        new_mask_parameter = torch.nn.Parameter(
-            torch.full(
-                (num_output_units_so_far, num_instances),
-                mask_init_constant,
-                device=device,
-            )
-        )
-        mask_parameter_list.append(new_mask_parameter)
-        mask_parameter_dict[mask_name] = (
-            new_mask_parameter  # pyright: ignore reportArgumentType  # seems to be an issue with pyright or with torch.nn.Parameter?
+        num_mask_logits = num_output_units_so_far * num_instances
+        mask_logits_segments[mask_name] = MaskLogitsSegment(
+            start=num_mask_logits_so_far,
+            end=num_mask_logits_so_far + num_mask_logits,
+            shape=(num_output_units_so_far, num_instances),
         )
+        num_mask_logits_so_far += num_mask_logits
 
     match circuit_start_type:
         case CircuitStartingPointType.POS_EMBED:
@@ -141,14 +163,198 @@ def create_mask_parameters_and_forward_cache_hook_points(
         mask_name=f"blocks.{num_layers - 1}.hook_resid_post", num_instances=1
     )
 
+    mask_logits = torch.nn.Parameter(
+        torch.full(
+            (
+                (num_mask_logits_so_far,)
+                if num_mask_sets is None
+                else (num_mask_sets, num_mask_logits_so_far)
+            ),
+            mask_init_constant,
+            device=device,
+        )
+    )
+
     return (
         ordered_forward_cache_hook_points,
         hook_point_to_parents,
-        mask_parameter_list,
-        mask_parameter_dict,
+        mask_logits,
+        mask_logits_segments,
     )
 
 
+@dataclass(frozen=True)
+class MaskedHookPointInfo:
+    """Everything `activation_mask_hook` needs to know about a masked hook point, apart from the masks.
+    This is calculated once when the hooks are set up, rather than on every call of the hook.
+    """
+
+    layer_index: int
+    is_attn: bool  # the input to the attention heads (q/k/v input), as opposed to mlp_in or resid_post
+    cumulative_attention_bias: (
+        Float[torch.Tensor, " d_model"] | None
+    )  # the sum of b_O of all attention layers before this hook point; None if there are none
+
+
+@dataclass(frozen=True)
+class MaskSampleMetrics:
+    """The values of a metric for several samples of the masks; see
+    `EdgeLevelMaskedTransformer.evaluate_mask_samples`."""
+
+    # one value per sample (and per mask set, if there are several)
+    values: Float[torch.Tensor, " sample"] | Float[torch.Tensor, "sample mask_set"]
+
+    @property
+    def mean(self) -> Float[torch.Tensor, ""] | Float[torch.Tensor, " mask_set"]:
+        return self.values.mean(dim=0)
+
+    @property
+    def variance(self) -> Float[torch.Tensor, ""] | Float[torch.Tensor, " mask_set"]:
+        """The (unbiased) sample variance; NaN if there is a single sample."""
+        if len(self.values) < 2:
+            return torch.full_like(self.mean, float("nan"))
+        return self.values.var(dim=0)
+
+
+@dataclass(frozen=True)
+class CorrespondenceTable:
+    """A look-up table from the flat mask logits to the edges of a `TLACDCCorrespondence` that was set up from
+    the model, so that a circuit can be extracted from a sample of the masks without looping over the masks.
+
+    The edges are numbered in the order of `corr.edge_dict()` (which is the same for every correspondence that is
+    set up from the same model). The nodes are numbered such that every node comes after all of its children.
+    """
+
+    edges: list[tuple[HookPointName, TorchIndex, HookPointName, TorchIndex]]
+    mask_edge_ids: Int[
+        torch.Tensor, " n_mask_logits"
+    ]  # the edge that belongs to every mask logit
+    default_present: Bool[
+        torch.Tensor, " n_edges"
+    ]  # whether every edge is present before the masks are applied
+    num_nodes: int
+    child_node_ids: Int[torch.Tensor, " n_edges"]
+    output_node_id: int
+    # the edges, sorted by their child node; the edges of child node i are edge_order[start:end]
+    # for (i, start, end) in child_slices
+    edge_order: Int[torch.Tensor, " n_edges"]
+    sorted_parent_node_ids: Int[torch.Tensor, " n_edges"]
+    child_slices: list[tuple[int, int, int]]
+
+    def prune(
+        self, present: Bool[torch.Tensor, "... n_edges"]
+    ) -> Bool[torch.Tensor, "... n_edges"]:
+        """Removes the edges whose child is not connected to the output by present edges.
+
+        This is a single pass over the nodes, from the output to the inputs: a node is kept if it is the output,
+        or if it is the parent of a present edge whose child is kept."""
+        keep_node = torch.zeros((*present.shape[:-1], self.num_nodes), dtype=torch.bool)
+        keep_node[..., self.output_node_id] = True
+        present_sorted = present[..., self.edge_order]
+        for node_id, start, end in self.child_slices:
+            # the parents of a node are all different, so there are no duplicate indices in this assignment
+            keep_node[..., self.sorted_parent_node_ids[start:end]] |= (
+                present_sorted[..., start:end] & keep_node[..., node_id, None]
+            )
+        return present & keep_node[..., self.child_node_ids]
+
+
+def _edge_infos(corr: TLACDCCorrespondence) -> list[EdgeInfo]:
+    """The edges of `corr`, in the order of `corr.edge_dict()`."""
+    return [
+        edge_info
+        for by_child_index in corr.edges.values()
+        for by_parent_name in by_child_index.values()
+        for by_parent_index in by_parent_name.values()
+        for edge_info in by_parent_index.values()
+    ]
+
+
+class _WeightedSumOfForwardBuffer(torch.autograd.Function):
+    """Computes `einsum(equation, buffer_prefix, mask)`, where `buffer_prefix` is a view of
+    `EdgeLevelMaskedTransformer._forward_buffer` that holds the (detached) outputs of `parents`.
+
+    The buffer is written to in-place during the forward pass, after the prefix has been read, so
+    autograd is not allowed to save it. Instead, we keep a reference to the prefix ourselves (the prefix
+    itself is never overwritten, because every forward pass gets a new buffer) and route the gradient
+    of the buffer back to the parent tensors that it was copied from.
+    """
+
+    @staticmethod
+    def forward(ctx, equation: str, mask, buffer_prefix, *parents):
+        ctx.equation = equation
+        ctx.buffer_prefix = buffer_prefix
+        ctx.parent_shapes = [parent.shape for parent in parents]
+        ctx.save_for_backward(mask)
+        return torch.einsum(equation, buffer_prefix, mask)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        (mask,) = ctx.saved_tensors
+        buffer_equation, mask_equation = ctx.equation.split(" -> ")[0].split(", ")
+        out_equation = ctx.equation.split(" -> ")[1]
+
+        grad_mask = None
+        if ctx.needs_input_grad[1]:
+            grad_mask = torch.einsum(
+                f"{out_equation}, {buffer_equation} -> {mask_equation}",
+                grad_output,
+                ctx.buffer_prefix,
+            )
+
+        grad_buffer = torch.einsum(
+            f"{out_equation}, {mask_equation} -> {buffer_equation}", grad_output, mask
+        )
+        grad_parents = []
+        start = 0
+        for shape in ctx.parent_shapes:
+            # attention outputs are "b s n_heads d", the others are "b s d"
+            n_rows = shape[2] if len(shape) == 4 else 1
+            grad_parent = grad_buffer[:, :, start : start + n_rows]
+            if len(shape) == 3:
+                grad_parent = grad_parent.squeeze(2)
+            grad_parents.append(grad_parent.sum_to_size(shape))
+            start += n_rows
+
+        return None, grad_mask, None, *grad_parents
+
+
+def _weighted_sum_of_values(
+    mask: (
+        Float[torch.Tensor, "parentindex child"]
+        | Float[torch.Tensor, "batch parentindex child"]
+    ),
+    ablation_values: Num[torch.Tensor, "batch pos parentindex d"],
+    forward_values: Num[torch.Tensor, "batch pos parentindex d"],
+    *parents: torch.Tensor,
+) -> Float[torch.Tensor, "batch pos child d"]:
+    """The input of a masked hook point: `mask` * `forward_values` + (1 - `mask`) * `ablation_values`, summed over
+    the parents. `forward_values` is the prefix of the forward buffer that holds the outputs of `parents`
+    (see `_WeightedSumOfForwardBuffer`).
+
+    This only depends on its arguments, so that it can be recomputed in the backward pass (see
+    `EdgeLevelMaskedTransformer.checkpoint_activations`)."""
+    # per-example masks have a leading batch dimension
+    equation = (
+        "b s i d, i o -> b s o d" if mask.ndim == 2 else "b s i d, b i o -> b s o d"
+    )
+    if mask.ndim == 3 and mask.shape[0] != ablation_values.shape[0]:
+        # Several masks (mask sets, or circuits in MaskedRunner.run_many) share an ablation cache for a smaller
+        # batch, which is repeated in the input: example j for mask m is at m * ablation_batch + j.
+        weighted_ablation_values = torch.einsum(
+            "b s i d, m b i o -> m b s o d",
+            ablation_values,
+            1 - mask.unflatten(0, (-1, ablation_values.shape[0])),
+        ).flatten(0, 1)
+    else:
+        weighted_ablation_values = torch.einsum(equation, ablation_values, 1 - mask)
+    weighted_forward_values = _WeightedSumOfForwardBuffer.apply(
+        equation, mask, forward_values, *parents
+    )
+    return weighted_ablation_values + weighted_forward_values
+
+
 class EdgeLevelMaskedTransformer(torch.nn.Module):
     """
     A wrapper around HookedTransformer that allows edge-level subnetwork probing.
@@ -159,6 +365,22 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
       and non-ablated edges from `forward_cache`, then the sum is taken.
     - `caching_hook`s save the output of a node to `forward_cache` for use in later layers.
 
+    Every hook point in `forward_cache_hook_points` has a fixed range of rows in the
+    "parentindex" dimension (`_parent_row_offsets`), and the parents of every masked hook point
+    are a prefix of `forward_cache_hook_points`. So rather than concatenating all parent outputs
+    for every masked hook point (which takes O(n_layers^2) memory), the caching hooks write their
+    outputs into one contiguous `_forward_buffer` and the masked hook points use a view of its prefix.
+    The ablation cache is stacked into a contiguous tensor once, in the same layout.
+
+    Similarly, the mask logits of all masked hook points are stored in one flat parameter; every masked hook
+    point has a segment of it (`_mask_logits_segments`). The masks for all hook points are sampled at once,
+    at the start of every forward pass, and the statistics of the masks are single reductions over the flat tensor.
+
+    With `num_mask_sets`, there are several independent sets of mask parameters (stacked in the first dimension
+    of the flat parameter) that are trained together, e.g. with different regularization coefficients. The input
+    then has to contain the batch once for every mask set (see `replicate_for_mask_sets`); the model weights and
+    the ablation cache are shared by all mask sets.
+
     Qs:
 
     - what are the names of the mask parameters in the mask parameter dict? We just use the names of the hook point
@@ -174,13 +396,50 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
     ]  # the parents of each hook point
     mask_parameter_list: (
         torch.nn.ParameterList
-    )  # the parameters that we use to mask the input to each node
-    _mask_parameter_dict: dict[
-        str, torch.nn.Parameter
-    ]  # same parameters, but indexed by the hook point that they are applied to
+    )  # a single parameter: the flat mask logits that we use to mask the input to each node
+    num_mask_sets: int | None  # None if there is a single set of mask parameters
+    checkpoint_activations: bool  # see `__init__`
+    _mask_logits_segments: dict[
+        HookPointName, MaskLogitsSegment
+    ]  # the segment of the flat mask logits that belongs to each masked hook point
+    _regularization_weights: Float[
+        torch.Tensor, " n_mask_logits"
+    ]  # 1 / (number of masked hook points * size of the segment) for every mask logit
     forward_cache_hook_points: list[
         HookPointName
     ]  # the hook points where we need to cache the output on a forward pass
+    _mask_logits_override: (
+        Float[torch.Tensor, "batch n_mask_logits"] | None
+    )  # if set, used instead of the mask parameters; see `with_mask_logits`
+    _current_mask: (
+        Float[torch.Tensor, " n_mask_logits"]
+        | Float[torch.Tensor, "batch n_mask_logits"]
+        | None
+    )  # the masks that were sampled at the start of the current forward pass
+    _fixed_mask_noise: (
+        Float[torch.Tensor, " n_mask_logits"]
+        | Float[torch.Tensor, "batch n_mask_logits"]
+        | None
+    )  # if set, the uniform noise for every mask sample; see `with_fixed_mask_noise`
+    _parent_row_offsets: dict[
+        HookPointName, tuple[int, int]
+    ]  # (start, end) of the rows of a forward cache hook point in the parentindex dimension
+    _forward_buffer: (
+        Num[torch.Tensor, "batch pos parentindex d"] | None
+    )  # the outputs of the forward cache hook points of the current forward pass
+    _stacked_ablation_values: (
+        Num[torch.Tensor, "batch pos parentindex d"] | None
+    )  # the values in `ablation_cache`, in the same layout as `_forward_buffer`
+    _stacked_ablation_sources: list[torch.Tensor]
+    _masked_hook_point_info: dict[
+        HookPointName, MaskedHookPointInfo
+    ]  # set up by `set_up_masked_hook_points`
+    _correspondence_tables: dict[
+        bool, CorrespondenceTable
+    ]  # by use_pos_embed; see `correspondence_table`
+    _ablation_cache_fingerprint: (
+        tuple[ActivationCache, list[tuple[torch.Tensor | None, int]]] | None
+    )  # `ablation_cache` and the tensors it was calculated from; see `calculate_and_store_ablation_cache`
 
     def __init__(
         self,
@@ -192,10 +451,18 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
         starting_point_type: CircuitStartingPointType = CircuitStartingPointType.POS_EMBED,
         no_ablate=False,
         verbose=False,
+        profile_memory=False,
+        num_mask_sets: int | None = None,
+        checkpoint_activations=False,
     ):
         """
         - 'use_pos_embed': if set to True, create masks for edges from 'hook_embed' and 'hook_pos_embed'; othererwise,
             create masks for edges from 'blocks.0.hook_resid_pre'.
+        - 'profile_memory': if set to True, print the CUDA memory usage in every masked hook (this is slow).
+        - 'num_mask_sets': if set, train this many independent sets of masks at the same time.
+        - 'checkpoint_activations': if set to True, recompute the weighted sums of the parents of every masked hook
+            point in the backward pass instead of keeping the intermediate values for it. This uses less memory
+            during training, at the cost of some compute.
         """
         super().__init__()
 
@@ -208,9 +475,14 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
         self.device = self.model.parameters().__next__().device
         self.starting_point_type = starting_point_type
         self.verbose = verbose
+        self.profile_memory = profile_memory
+        self.num_mask_sets = num_mask_sets
+        self.checkpoint_activations = checkpoint_activations
 
         self.ablation_cache = ActivationCache({}, self.model)
+        self._ablation_cache_fingerprint = None
         self.forward_cache = ActivationCache({}, self.model)
+        self._mask_logits_override = None
         # Hyperparameters
         self.beta = beta
         self.gamma = gamma
@@ -227,8 +499,8 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
         (
             self.forward_cache_hook_points,
             self.hook_point_to_parents,
-            self.mask_parameter_list,
-            self._mask_parameter_dict,
+            mask_logits,
+            self._mask_logits_segments,
         ) = create_mask_parameters_and_forward_cache_hook_points(
             circuit_start_type=self.starting_point_type,
             num_heads=self.n_heads,
@@ -236,22 +508,130 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
             device=self.device,
             mask_init_constant=math.log(p / (1 - p)),
             attn_only=model.cfg.attn_only,
+            num_mask_sets=num_mask_sets,
         )
+        self.mask_parameter_list = torch.nn.ParameterList([mask_logits])
+        self._current_mask = None
+        self._fixed_mask_noise = None
+
+        # the regularization loss is the mean over the hook points of the mean over their mask logits
+        regularization_weights = torch.empty(
+            mask_logits.shape[-1], device=mask_logits.device
+        )
+        for segment in self._mask_logits_segments.values():
+            regularization_weights[segment.start : segment.end] = 1 / (
+                len(self._mask_logits_segments) * (segment.end - segment.start)
+            )
+        self.register_buffer(
+            "_regularization_weights", regularization_weights, persistent=False
+        )
+
+        self._parent_row_offsets = {}
+        num_rows_so_far = 0
+        for name in self.forward_cache_hook_points:
+            num_rows = len(
+                IndexedHookPointName.list_from_hook_point(name, self.n_heads)
+            )
+            self._parent_row_offsets[name] = (
+                num_rows_so_far,
+                num_rows_so_far + num_rows,
+            )
+            num_rows_so_far += num_rows
+        self._forward_buffer = None
+        self._stacked_ablation_values = None
+        self._stacked_ablation_sources = []
+        self._masked_hook_point_info = {}
+        self._correspondence_tables = {}
 
     @property
     def mask_parameter_names(self) -> Iterable[str]:
-        return self._mask_parameter_dict.keys()
+        return self._mask_logits_segments.keys()
 
-    def sample_mask(self, mask_name: str) -> torch.Tensor:
-        """Samples a binary-ish mask from the mask_scores for the particular `mask_name` activation"""
-        mask_parameters = self._mask_parameter_dict[mask_name]
-        uniform_sample = (
-            torch.zeros_like(mask_parameters, requires_grad=False)
+    @property
+    def flat_mask_parameters(self) -> torch.nn.Parameter:
+        """The mask logits of all masked hook points, in one flat parameter."""
+        return self.mask_parameter_list[0]
+
+    def flat_mask_index(self, mask_name: str, parent_row: int, child_col: int) -> int:
+        """The index in the flat mask logits of the mask logit for `mask_logits(mask_name)[parent_row, child_col]`."""
+        segment = self._mask_logits_segments[mask_name]
+        return segment.start + parent_row * segment.shape[1] + child_col
+
+    def flat_mask_logits(
+        self,
+    ) -> (
+        Float[torch.Tensor, " n_mask_logits"]
+        | Float[torch.Tensor, "batch n_mask_logits"]
+    ):
+        """The mask logits that are currently in use: the mask parameters, unless they are
+        overridden by `with_mask_logits`."""
+        if self._mask_logits_override is not None:
+            return self._mask_logits_override
+        return self.flat_mask_parameters
+
+    def mask_logits(
+        self, mask_name: str
+    ) -> (
+        Float[torch.Tensor, "parent child"] | Float[torch.Tensor, "batch parent child"]
+    ):
+        """The mask logits that are currently in use for `mask_name` (a view of `flat_mask_logits`)."""
+        return self._mask_logits_segments[mask_name].view(self.flat_mask_logits())
+
+    @contextmanager
+    def with_mask_logits(
+        self,
+        mask_logits: Float[torch.Tensor, "batch n_mask_logits"],
+    ) -> Iterator["EdgeLevelMaskedTransformer"]:
+        """Temporarily use the flat `mask_logits` instead of the mask parameters.
+
+        The mask logits can have a leading batch dimension; in that case, example `i` in the batch is run with
+        mask `mask_logits[i]`, so that a single forward pass can evaluate a different set of edges for every
+        example. The batch dimension has to match the batch dimension of the input, or divide it: then every
+        mask is used for a contiguous group of examples (as for mask sets, see `replicate_for_mask_sets`).
+        """
+        assert mask_logits.shape[-1] == self.flat_mask_parameters.shape[-1]
+        previous_override = self._mask_logits_override
+        self._mask_logits_override = mask_logits
+        try:
+            yield self
+        finally:
+            self._mask_logits_override = previous_override
+
+    @contextmanager
+    def with_fixed_mask_noise(self) -> Iterator["EdgeLevelMaskedTransformer"]:
+        """Samples the noise of the hard concrete distribution once, and uses it for every forward pass in the
+        context. The masks are still differentiable functions of the mask logits.
+
+        This makes several forward passes on parts of a batch (e.g. micro-batches for gradient accumulation) use
+        the same masks as a single forward pass on the whole batch would. The noise has the shape of
+        `flat_mask_logits` when the context is entered. In a nested context, the noise of the enclosing
+        context is kept.
+        """
+        previous_noise = self._fixed_mask_noise
+        if previous_noise is None:
+            self._fixed_mask_noise = self._sample_uniform_noise(self.flat_mask_logits())
+        try:
+            yield self
+        finally:
+            self._fixed_mask_noise = previous_noise
+
+    @staticmethod
+    def _sample_uniform_noise(mask_logits: torch.Tensor) -> torch.Tensor:
+        return (
+            torch.zeros_like(mask_logits, requires_grad=False)
             .uniform_()
             .clamp_(0.0001, 0.9999)
         )
+
+    def _sample_hard_concrete(
+        self, mask_logits: torch.Tensor, uniform_sample: torch.Tensor | None = None
+    ) -> torch.Tensor:
+        """Samples a binary-ish mask of the same shape as `mask_logits` (using `uniform_sample` as the noise,
+        if given)."""
+        if uniform_sample is None:
+            uniform_sample = self._sample_uniform_noise(mask_logits)
         s = torch.sigmoid(
-            (uniform_sample.log() - (1 - uniform_sample).log() + mask_parameters)
+            (uniform_sample.log() - (1 - uniform_sample).log() + mask_logits)
             / self.beta
         )
         s_bar = s * (self.zeta - self.gamma) + self.gamma
@@ -259,12 +639,50 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
 
         return mask
 
+    def sample_mask(self, mask_name: str) -> torch.Tensor:
+        """Samples a binary-ish mask from the mask_scores for the particular `mask_name` activation.
+
+        The mask has shape "parent child", or "batch parent child" if per-example mask logits are in use
+        (see `with_mask_logits`)."""
+        return self._sample_hard_concrete(self.mask_logits(mask_name))
+
+    def sample_all_masks(
+        self,
+    ) -> (
+        Float[torch.Tensor, " n_mask_logits"]
+        | Float[torch.Tensor, "batch n_mask_logits"]
+    ):
+        """Samples the masks of all masked hook points at once, in the layout of `flat_mask_logits`."""
+        return self._sample_hard_concrete(
+            self.flat_mask_logits(), uniform_sample=self._fixed_mask_noise
+        )
+
+    def replicate_for_mask_sets(
+        self, data: Num[torch.Tensor, "batch ..."]
+    ) -> Num[torch.Tensor, "mask_set_and_batch ..."]:
+        """Repeats the batch once for every mask set, so that the examples of mask set `m` are at
+        `m * batch + j`. If there is a single set of masks, `data` is returned as is."""
+        if self.num_mask_sets is None:
+            return data
+        return data.repeat(self.num_mask_sets, *([1] * (data.ndim - 1)))
+
+    def _mask_parameters_of_set(
+        self, mask_set: int | None
+    ) -> Float[torch.Tensor, " n_mask_logits"]:
+        if self.num_mask_sets is None:
+            assert mask_set is None, "There is only a single set of masks"
+            return self.flat_mask_parameters
+        assert mask_set is not None, "Specify which mask set to use"
+        return self.flat_mask_parameters[mask_set]
+
     def regularization_loss(self) -> torch.Tensor:
+        """The regularization loss, or one regularization loss for every mask set."""
         center = self.beta * math.log(-self.gamma / self.zeta)
-        per_parameter_loss = [
-            torch.sigmoid(scores - center).mean() for scores in self.mask_parameter_list
-        ]
-        return torch.mean(torch.stack(per_parameter_loss))
+        # the mean over the hook points of the mean over their mask logits
+        return (
+            torch.sigmoid(self.flat_mask_parameters - center)
+            * self._regularization_weights
+        ).sum(dim=-1)
 
     def _calculate_and_store_zero_ablation_cache(self) -> None:
         """Caches zero for every possible mask point."""
@@ -357,7 +775,17 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
         """Use None for the patch data for zero ablation.
 
         If you want to calculate gradients on the patch data/the cache, set retain_cache_gradients=True.
-        Otherwise set to False for performance."""
+        Otherwise set to False for performance.
+
+        If retain_cache_gradients=False, the ablation cache is only recalculated if the patch data or the model
+        weights have changed since the last time it was calculated (see `invalidate_ablation_cache`).
+        It is always recalculated if there are hooks on the model, because they may change the cached values.
+        """
+        sources = self._ablation_cache_sources(patch_data)
+        can_reuse = not retain_cache_gradients and not self._model_has_hooks()
+        if can_reuse and self._ablation_cache_is_calculated_from(sources):
+            return
+
         if patch_data is None:
             self._calculate_and_store_zero_ablation_cache()
         else:
@@ -365,6 +793,49 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
             self._calculate_and_store_resampling_ablation_cache(
                 patch_data, retain_cache_gradients=retain_cache_gradients
             )
+        self._ablation_cache_fingerprint = (
+            (self.ablation_cache, sources) if can_reuse else None
+        )
+
+    def invalidate_ablation_cache(self) -> None:
+        """Makes sure that the ablation cache is recalculated on the next call of `calculate_and_store_ablation_cache`.
+
+        This is only needed if the patch data or the model weights are changed in a way that does not
+        increment their version counter, e.g. through `tensor.data`."""
+        self._ablation_cache_fingerprint = None
+
+    def _ablation_cache_sources(
+        self, patch_data: PatchData
+    ) -> list[tuple[torch.Tensor | None, int]]:
+        """The tensors that the ablation cache is calculated from, with their version counters
+        (which are incremented by every in-place operation on the tensor)."""
+        return [(patch_data, 0 if patch_data is None else patch_data._version)] + [
+            (parameter, parameter._version) for parameter in self.model.parameters()
+        ]
+
+    def _ablation_cache_is_calculated_from(
+        self, sources: list[tuple[torch.Tensor | None, int]]
+    ) -> bool:
+        if self._ablation_cache_fingerprint is None:
+            return False
+        cache, cached_sources = self._ablation_cache_fingerprint
+        # we keep a reference to the source tensors, so they can't be replaced by new tensors with the same id
+        return (
+            cache is self.ablation_cache
+            and len(cached_sources) == len(sources)
+            and all(
+                cached_tensor is tensor and cached_version == version
+                for (cached_tensor, cached_version), (tensor, version) in zip(
+                    cached_sources, sources
+                )
+            )
+        )
+
+    def _model_has_hooks(self) -> bool:
+        return any(
+            hook_point.fwd_hooks or hook_point.bwd_hooks
+            for hook_point in self.model.hook_dict.values()
+        )
 
     def get_activation_values(
         self, parent_names: list[str], cache: ActivationCache
@@ -385,29 +856,94 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
             result.append(value)
         return torch.cat(result, dim=2)
 
+    def _get_stacked_ablation_values(
+        self,
+    ) -> Num[torch.Tensor, "batch seq parentindex d"]:
+        """The values of `ablation_cache` for all forward cache hook points, concatenated once in the
+        parentindex dimension. This is recalculated whenever the ablation cache has changed.
+        """
+        sources = [
+            self.ablation_cache.cache_dict[name]
+            for name in self.forward_cache_hook_points
+        ]
+        if self._stacked_ablation_values is None or any(
+            old is not new for old, new in zip(self._stacked_ablation_sources, sources)
+        ):
+            self._stacked_ablation_values = self.get_activation_values(
+                self.forward_cache_hook_points, self.ablation_cache
+            )
+            self._stacked_ablation_sources = sources
+        return self._stacked_ablation_values
+
     def compute_weighted_values(
         self, hook: HookPoint
     ) -> Float[torch.Tensor, "batch pos head_index d_resid"]:
         parent_names = self.hook_point_to_parents[
             hook.name
         ]  # pyright: ignore # hook.name is not typed correctly
-        ablation_values = self.get_activation_values(
-            parent_names, self.ablation_cache
-        )  # b s i d (i = parentindex)
-        forward_values = self.get_activation_values(
-            parent_names, self.forward_cache
-        )  # b s i d
-        mask = self.sample_mask(
+        assert self._current_mask is not None
+        mask = self._mask_logits_segments[
             hook.name  # pyright: ignore # hook.name is not typed correctly
-        )  # in_edges, nodes_per_mask, ...
+        ].view(
+            self._current_mask
+        )  # in_edges, nodes_per_mask, ...  (optionally with a leading batch dimension)
+        num_parent_rows = mask.shape[-2]
+        assert num_parent_rows == self._parent_row_offsets[parent_names[-1]][1]
+
+        ablation_values = self._get_stacked_ablation_values()[
+            :, :, :num_parent_rows
+        ]  # b s i d (i = parentindex)
+        assert self._forward_buffer is not None
+        forward_values = self._forward_buffer[:, :, :num_parent_rows]  # b s i d
+
+        parents = [self.forward_cache.cache_dict[name] for name in parent_names]
+        if self.checkpoint_activations and torch.is_grad_enabled():
+            # The mask was sampled at the start of the forward pass and is passed in explicitly, so the
+            # recomputation in the backward pass uses the same mask (also if there have been other forward passes
+            # in the meantime). The forward buffer is passed in through the closure, because it is written to
+            # in-place after this, which checkpoint does not allow for its (tensor) arguments; the prefix that we
+            # read is never overwritten (see `_WeightedSumOfForwardBuffer`).
+            return torch.utils.checkpoint.checkpoint(
+                lambda mask, ablation_values, *parents: _weighted_sum_of_values(
+                    mask, ablation_values, forward_values, *parents
+                ),
+                mask,
+                ablation_values,
+                *parents,
+                use_reentrant=False,
+            )
+        return _weighted_sum_of_values(mask, ablation_values, forward_values, *parents)
 
-        weighted_ablation_values = torch.einsum(
-            "b s i d, i o -> b s o d", ablation_values, 1 - mask
+    def set_up_masked_hook_points(self) -> None:
+        """Precalculates the `MaskedHookPointInfo` for every masked hook point.
+
+        This is done every time the hooks are set up (see `fwd_hooks`) rather than once in `__init__`,
+        because the model weights can be changed after the EdgeLevelMaskedTransformer is created
+        (e.g. by `reset_network`)."""
+        # cumulative_biases[i] is the sum of b_O over the first i attention layers
+        attention_biases = torch.stack(
+            [block.attn.b_O for block in self.model.blocks]  # pyright: ignore
         )
-        weighted_forward_values = torch.einsum(
-            "b s i d, i o -> b s o d", forward_values, mask
+        cumulative_biases = torch.cat(
+            [torch.zeros_like(attention_biases[:1]), attention_biases.cumsum(dim=0)]
         )
-        return weighted_ablation_values + weighted_forward_values
+
+        self._masked_hook_point_info = {}
+        for name in self.mask_parameter_names:
+            layer_index = int(name.split(".")[1])
+            is_attn = "mlp" not in name and "resid_post" not in name
+            # for the attention input we need all attention layers that come before the current layer;
+            # for mlp_in and resid_post also the attention layer in the current layer
+            last_attention_block_index = layer_index if is_attn else layer_index + 1
+            self._masked_hook_point_info[name] = MaskedHookPointInfo(
+                layer_index=layer_index,
+                is_attn=is_attn,
+                cumulative_attention_bias=(
+                    cumulative_biases[last_attention_block_index]
+                    if last_attention_block_index > 0
+                    else None
+                ),
+            )
 
     def activation_mask_hook(
         self, hook_point_out: torch.Tensor, hook: HookPoint, verbose=False
@@ -417,32 +953,21 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
         """
         show = print if verbose else lambda *args, **kwargs: None
         show(f"Doing ablation of {hook.name}")
-        mem1 = torch.cuda.memory_allocated()
-        show(f"Using memory {mem1:_} bytes at hook start")
-        is_attn = (
-            "mlp" not in hook.name and "resid_post" not in hook.name
-        )  # pyright: ignore # hook.name is not typed correctly
-
-        # To trade off CPU against memory, you can use
-        #    out = checkpoint(self.compute_weighted_values, hook, use_reentrant=False)
-        # However, that messes with the backward pass, so I've disabled it for now.
+        if self.profile_memory:
+            show(f"Using memory {torch.cuda.memory_allocated():_} bytes at hook start")
+        info = self._masked_hook_point_info[
+            hook.name  # pyright: ignore # hook.name is not typed correctly
+        ]
+
         out = self.compute_weighted_values(hook)
-        if not is_attn:
+        if not info.is_attn:
             out = rearrange(out, "b s 1 d -> b s d")
 
         # add back attention bias
         # Explanation: the attention bias is not part of the cached values (why not?), so we need to add it back here
-        # we need to iterate over all attention layers that come before current layer
-        current_block_index = int(
-            hook.name.split(".")[1]
-        )  # pyright: ignore # hook.name is not typed correctly
-        last_attention_block_index = (
-            current_block_index + 1
-            if ("resid_post" in hook.name or "mlp" in hook.name)
-            else current_block_index  # pyright: ignore # hook.name is not typed correctly
-        )
-        for layer in self.model.blocks[:last_attention_block_index]:  # pyright: ignore
-            out += layer.attn.b_O
+        # (the sum of the biases of all attention layers that come before the current layer is precalculated)
+        if info.cumulative_attention_bias is not None:
+            out += info.cumulative_attention_bias
 
         if self.no_ablate and not torch.allclose(hook_point_out, out, atol=1e-4):
             print(f"Warning: hook_point_out and out are not close for {hook.name}")
@@ -454,26 +979,68 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
             print(
                 f"Ablation hook {'did NOT' if no_change else 'DID'} change {hook.name} by {absdiff:.3f}"
             )
-        torch.cuda.empty_cache()
-        show(
-            f"Using memory {torch.cuda.memory_allocated():_} bytes after clearing cache"
-        )
+        if self.profile_memory:
+            torch.cuda.empty_cache()
+            show(
+                f"Using memory {torch.cuda.memory_allocated():_} bytes after clearing cache"
+            )
         return out
 
     def caching_hook(self, hook_point_out: torch.Tensor, hook: HookPoint):
         assert hook.name is not None
         self.forward_cache.cache_dict[hook.name] = hook_point_out
+
+        start, end = self._parent_row_offsets[hook.name]
+        value = (
+            hook_point_out if hook_point_out.ndim == 4 else hook_point_out.unsqueeze(2)
+        )
+        if start == 0:
+            batch, pos, _, d_model = value.shape
+            # This is the first hook point of a new forward pass, so we sample the masks for this forward pass.
+            self._current_mask = self.sample_all_masks()
+            if self._current_mask.ndim == 2 and self._current_mask.shape[0] != batch:
+                # one mask per mask set; the examples of mask set m are at m * (batch // num_mask_sets) + j
+                assert batch % self._current_mask.shape[0] == 0
+                self._current_mask = self._current_mask.repeat_interleave(
+                    batch // self._current_mask.shape[0], dim=0
+                )
+            # Allocate a new buffer rather than reusing the old one,
+            # because the backward pass of the previous forward pass may still need it.
+            self._forward_buffer = torch.empty(
+                (
+                    batch,
+                    pos,
+                    self._parent_row_offsets[self.forward_cache_hook_points[-1]][1],
+                    d_model,
+                ),
+                dtype=value.dtype,
+                device=value.device,
+            )
+        assert self._forward_buffer is not None
+        with torch.no_grad():
+            self._forward_buffer[:, :, start:end] = value
         return hook_point_out
 
     def fwd_hooks(self) -> list[tuple[str | Callable, Callable]]:
+        self.set_up_masked_hook_points()
+
+        # TransformerLens calls repr() on every hook that it adds. For a bound method, that includes the repr of
+        # this module and therefore of the whole model, which takes longer than the forward pass itself.
+        # Plain functions have a cheap repr.
+        def activation_mask_hook(hook_point_out: torch.Tensor, hook: HookPoint):
+            return self.activation_mask_hook(hook_point_out, hook)
+
+        def caching_hook(hook_point_out: torch.Tensor, hook: HookPoint):
+            return self.caching_hook(hook_point_out, hook)
+
         return cast(
             list[tuple[str | Callable, Callable]],
             [
-                (hook_point, self.activation_mask_hook)
+                (hook_point, activation_mask_hook)
                 for hook_point in self.mask_parameter_names
             ]
             + [
-                (hook_point, self.caching_hook)
+                (hook_point, caching_hook)
                 for hook_point in self.forward_cache_hook_points
             ],
         )
@@ -484,11 +1051,59 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
     def with_fwd_hooks_and_new_ablation_cache(
         self, patch_data: PatchData
     ) -> ContextManager[HookedTransformer]:
+        """The ablation cache is only recalculated if `patch_data` or the model weights have changed."""
         self.calculate_and_store_ablation_cache(
             patch_data, retain_cache_gradients=False
         )
         return self.with_fwd_hooks()
 
+    def evaluate_mask_samples(
+        self,
+        metrics: Mapping[str, Callable[[torch.Tensor], torch.Tensor]],
+        data: Num[torch.Tensor, "batch pos"],
+        patch_data: PatchData,
+        num_samples: int,
+        max_samples_per_forward: int | None = None,
+    ) -> dict[str, MaskSampleMetrics]:
+        """Evaluates `metrics` (which are defined for a batch of `data`) for `num_samples` independent samples of
+        the masks. All samples (of all mask sets) are evaluated in a single forward pass, with the samples stacked
+        along the batch dimension and sharing the ablation cache, unless `max_samples_per_forward` is set.
+        All metrics are evaluated on the same samples.
+        """
+        self.calculate_and_store_ablation_cache(
+            patch_data, retain_cache_gradients=False
+        )
+        # one row per mask set
+        mask_logits = self.flat_mask_parameters.detach().reshape(
+            -1, self.flat_mask_parameters.shape[-1]
+        )
+        replicated_data = self.replicate_for_mask_sets(data)
+        samples_per_forward = max_samples_per_forward or num_samples
+
+        values: dict[str, list[torch.Tensor]] = {name: [] for name in metrics}
+        with torch.no_grad():
+            for start in range(0, num_samples, samples_per_forward):
+                n = min(samples_per_forward, num_samples - start)
+                # sample s of mask set m is row s * num_mask_sets + m, and is used for the examples of that row
+                with self.with_mask_logits(mask_logits.repeat(n, 1)):
+                    with self.with_fwd_hooks() as hooked_model:
+                        logits = hooked_model(
+                            replicated_data.repeat(n, *([1] * (data.ndim - 1)))
+                        )
+                for name, metric in metrics.items():
+                    values[name].extend(
+                        metric(row_logits)
+                        for row_logits in logits.chunk(n * len(mask_logits))
+                    )
+        return {
+            name: MaskSampleMetrics(
+                torch.stack(metric_values).reshape(
+                    num_samples, *self.flat_mask_parameters.shape[:-1]
+                )
+            )
+            for name, metric_values in values.items()
+        }
+
     @contextmanager
     def hooks(
         self,
@@ -512,21 +1127,136 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
         for p in self.model.parameters():
             p.requires_grad = False
 
-    def num_edges(self):
-        values = []
-        for name, mask in self._mask_parameter_dict.items():
-            mask_value = self.sample_mask(name)
-            values.extend(mask_value.flatten().tolist())
-        values = torch.tensor(values)
-        return (values > 0.5).sum().item()
+    def num_edges(self, mask_set: int | None = None):
+        with torch.no_grad():
+            mask = self._sample_hard_concrete(self._mask_parameters_of_set(mask_set))
+        return (mask > 0.5).sum().item()
 
     def num_params(self):
         return sum(p.numel() for p in self.mask_parameter_list)
 
+    def _torch_indexes(self, name: HookPointName) -> list[TorchIndex]:
+        """The indexes of the nodes of a hook point in a `TLACDCCorrespondence`."""
+        if (
+            "mlp" in name
+            or "resid" in name
+            or "embed" in name
+            or name == "blocks.0.hook_resid_pre"
+        ):
+            return [TorchIndex((None,))]
+        return [TorchIndex((None, None, i)) for i in range(self.n_heads)]
+
+    def correspondence_table(self, use_pos_embed: bool) -> CorrespondenceTable:
+        """The `CorrespondenceTable` for a correspondence that is set up from the model with `use_pos_embed`.
+        This is calculated once and then cached."""
+        if use_pos_embed in self._correspondence_tables:
+            return self._correspondence_tables[use_pos_embed]
+
+        corr = TLACDCCorrespondence.setup_from_model(
+            self.model, use_pos_embed=use_pos_embed
+        )
+        edges = list(corr.edge_dict().keys())
+        edge_ids = {edge: edge_id for edge_id, edge in enumerate(edges)}
+
+        mask_edge_ids = torch.empty(
+            self.flat_mask_parameters.shape[-1], dtype=torch.long
+        )
+        for child in self.mask_parameter_names:
+            parent_row = 0
+            for parent in self.hook_point_to_parents[child]:
+                for parent_index in self._torch_indexes(parent):
+                    for child_col, child_index in enumerate(self._torch_indexes(child)):
+                        mask_edge_ids[
+                            self.flat_mask_index(child, parent_row, child_col)
+                        ] = edge_ids[(child, child_index, parent, parent_index)]
+                    parent_row += 1
+
+        # number the nodes such that every node comes after all of its children
+        output_node = (
+            f"blocks.{self.model.cfg.n_layers - 1}.hook_resid_post",
+            TorchIndex((None,)),
+        )
+        parents_per_node: dict[tuple[HookPointName, TorchIndex], list[tuple]] = {}
+        num_children: dict[tuple[HookPointName, TorchIndex], int] = {}
+        for child_name, child_index, parent_name, parent_index in edges:
+            child_node = (child_name, child_index)
+            parent_node = (parent_name, parent_index)
+            parents_per_node.setdefault(child_node, []).append(parent_node)
+            parents_per_node.setdefault(parent_node, [])
+            num_children[parent_node] = num_children.get(parent_node, 0) + 1
+        nodes_without_children = [
+            node for node in parents_per_node if num_children.get(node, 0) == 0
+        ]
+        ordered_nodes = []
+        while nodes_without_children:
+            node = nodes_without_children.pop()
+            ordered_nodes.append(node)
+            for parent_node in parents_per_node[node]:
+                num_children[parent_node] -= 1
+                if num_children[parent_node] == 0:
+                    nodes_without_children.append(parent_node)
+        assert len(ordered_nodes) == len(parents_per_node), "The graph has a cycle"
+        node_ids = {node: node_id for node_id, node in enumerate(ordered_nodes)}
+
+        child_node_ids = torch.tensor([node_ids[edge[:2]] for edge in edges])
+        parent_node_ids = torch.tensor([node_ids[edge[2:]] for edge in edges])
+        edge_order = torch.argsort(child_node_ids, stable=True)
+        child_slices = []
+        edge_counts = torch.bincount(child_node_ids, minlength=len(ordered_nodes))
+        edge_ends = edge_counts.cumsum(dim=0).tolist()
+        for node_id, (count, end) in enumerate(zip(edge_counts.tolist(), edge_ends)):
+            if count > 0:
+                child_slices.append((node_id, end - count, end))
+
+        table = CorrespondenceTable(
+            edges=edges,
+            mask_edge_ids=mask_edge_ids,
+            default_present=torch.tensor(
+                [edge_info.present for edge_info in _edge_infos(corr)]
+            ),
+            num_nodes=len(ordered_nodes),
+            child_node_ids=child_node_ids,
+            output_node_id=node_ids[output_node],
+            edge_order=edge_order,
+            sorted_parent_node_ids=parent_node_ids[edge_order],
+            child_slices=child_slices,
+        )
+        self._correspondence_tables[use_pos_embed] = table
+        return table
+
+    def get_edge_presence_from_masks(
+        self,
+        mask: Float[torch.Tensor, "... n_mask_logits"] | None = None,
+        use_pos_embed: bool | None = None,
+    ) -> Bool[torch.Tensor, "... n_edges"]:
+        """Which edges of the correspondence are present in the circuit for the (flat) `mask`, after removing the
+        edges that are not connected to the output. If `mask` is None, the masks are sampled from the mask parameters
+        (for all mask sets at once, if there are several).
+
+        The edges are in the order of `correspondence_table(use_pos_embed).edges`. The mask can have leading batch
+        dimensions, e.g. to extract several circuits at once."""
+        if use_pos_embed is None:
+            use_pos_embed = (
+                self.starting_point_type == CircuitStartingPointType.POS_EMBED
+            )
+        if mask is None:
+            with torch.no_grad():
+                mask = self._sample_hard_concrete(self.flat_mask_parameters)
+        table = self.correspondence_table(use_pos_embed)
+
+        present = table.default_present.expand(*mask.shape[:-1], -1).clone()
+        present[..., table.mask_edge_ids] = (mask > 0.5).cpu()
+        return table.prune(present)
+
     def get_edge_level_correspondence_from_masks(
-        self, use_pos_embed: bool | None = None, verbose=False
+        self,
+        use_pos_embed: bool | None = None,
+        verbose=False,
+        mask_set: int | None = None,
     ) -> TLACDCCorrespondence:
-        show = print if verbose else lambda *args, **kwargs: None
+        """Samples the masks and returns the circuit as a correspondence, where the edges that are not connected
+        to the output are removed. See `get_edge_presence_from_masks` for a cheaper representation of the circuit.
+        """
         if use_pos_embed is None:
             use_pos_embed = (
                 self.starting_point_type == CircuitStartingPointType.POS_EMBED
@@ -534,103 +1264,36 @@ class EdgeLevelMaskedTransformer(torch.nn.Module):
         corr = TLACDCCorrespondence.setup_from_model(
             self.model, use_pos_embed=use_pos_embed
         )
-
-        # Define edges
-        def indexes(name):
-            if (
-                "mlp" in name
-                or "resid" in name
-                or "embed" in name
-                or name == "blocks.0.hook_resid_pre"
-            ):
-                return [TorchIndex((None,))]
-            return [TorchIndex((None, None, i)) for i in range(self.n_heads)]
-
-        # Step 1: Set/unset edges based on samples from mask
-
-        all_edges = corr.edge_dict()
-        edge_present_in_mask = {k: 0 for k in all_edges.keys()}
-        for child, mask_logits in self._mask_parameter_dict.items():
-            # Sample mask for this child
-            sampled_mask = self.sample_mask(child)
-            mask_row = 0
-            for parent in self.hook_point_to_parents[child]:
-                for parent_index in indexes(parent):
-                    for mask_col, child_index in enumerate(indexes(child)):
-                        mask_value = sampled_mask[mask_row][mask_col].item()
-                        edge = corr.edges[child][child_index][parent][parent_index]
-                        edge_present_in_mask[
-                            (child, child_index, parent, parent_index)
-                        ] = 1
-                        edge.present = mask_value > 0.5
-                        edge.effect_size = mask_value
-                    mask_row += 1
-        show(f"\n-----\nNumber of present edges (num_edges):", self.num_edges())
-        present_nodes, all_nodes = get_present_nodes(corr)
-        show(f"Total number of nodes in edge_dict: {len(all_nodes)}")
-        show(f"Number of nodes present after sampling: {len(present_nodes)}")
-
-        # Step 2: Now we need to deal with edges that are not present in the mask
-
-        def get_nodes_with_out_edges(corr: TLACDCCorrespondence):
-            """Returns a set of nodes that have outgoing edges"""
-            nodes_with_out_edges = set()
-            for (
-                receiver_name,
-                receiver_index,
-                sender_name,
-                sender_index,
-            ), edge in corr.edge_dict().items():
-                if edge.present:  # only consider present edges
-                    nodes_with_out_edges.add((sender_name, sender_index))
-            return nodes_with_out_edges
-
-        # Recursively remove edges to nodes that have no outgoing edges and is not the output node
-        while True:
-            edges_removed = 0
-            nodes_to_keep = get_nodes_with_out_edges(corr)
-            nodes_to_keep.add(
-                (
-                    f"blocks.{self.model.cfg.n_layers - 1}.hook_resid_post",
-                    TorchIndex((None,)),
-                )
+        table = self.correspondence_table(use_pos_embed)
+
+        with torch.no_grad():
+            mask = self._sample_hard_concrete(self._mask_parameters_of_set(mask_set))
+        present = self.get_edge_presence_from_masks(mask, use_pos_embed=use_pos_embed)
+
+        edge_infos = _edge_infos(corr)
+        assert len(edge_infos) == len(table.edges)
+        for edge_info, edge_present in zip(edge_infos, present.tolist()):
+            edge_info.present = edge_present
+        for edge_id, mask_value in zip(table.mask_edge_ids.tolist(), mask.tolist()):
+            edge_infos[edge_id].effect_size = mask_value
+
+        if verbose:
+            print("Number of edges present in the mask:", (mask > 0.5).sum().item())
+            present_nodes, all_nodes = get_present_nodes(corr)
+            print(f"Total number of nodes in edge_dict: {len(all_nodes)}")
+            print(
+                f"Number of edges present after pruning leaf nodes: {present.sum().item()}"
+            )
+            print(
+                f"Number of nodes present after pruning leaf nodes: {len(present_nodes)}"
             )
-            for (
-                receiver_name,
-                receiver_index,
-                sender_name,
-                sender_index,
-            ), edge in corr.edge_dict().items():
-                if (receiver_name, receiver_index) not in nodes_to_keep:
-                    if (
-                        edge.present
-                    ):  # this condition is required to eventually break the loop
-                        show(
-                            f"Removing edge ({receiver_name}, {receiver_index}) <- ({sender_name}, {sender_index}) because it has no outgoing edges"
-                        )
-                        edge.present = False
-                        edges_removed += 1
-            if edges_removed == 0:  # this means we have pruned all nodes
-                break
-        show("\n\nremoved leaf nodes")
-        present_nodes, all_nodes = get_present_nodes(corr)
-        present_edges = sum([1 for edge in corr.edge_dict().values() if edge.present])
-        show(f"Number of edges present after pruning leaf nodes: {present_edges}")
-        show(f"Number of nodes present after pruning leaf nodes: {len(present_nodes)}")
 
         return corr
 
-    def proportion_of_binary_scores(self) -> float:
+    def proportion_of_binary_scores(self, mask_set: int | None = None) -> float:
         """How many of the scores are binary, i.e. 0 or 1
         (after going through the sigmoid with fp32 precision loss)
         """
-        binary_count = 0
-        total_count = 0
-
-        for mask_name in self.mask_parameter_names:
-            mask = self.sample_mask(mask_name)
-            for v in mask.view(-1):
-                total_count += 1
-                if v == 0 or v == 1:
-                    binary_count += 1
-        return binary_count / total_count
+        with torch.no_grad():
+            mask = self._sample_hard_concrete(self._mask_parameters_of_set(mask_set))
+        return ((mask == 0) | (mask == 1)).float().mean().item()
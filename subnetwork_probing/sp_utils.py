@@ -1,6 +1,11 @@
+import copy
+import functools
+from typing import Callable
+
+import torch
 import wandb
 
-from acdc.acdc_utils import get_edge_stats, get_node_stats
+from acdc.acdc_utils import MatchNLLMetric, get_edge_stats, get_node_stats
 from acdc.TLACDCCorrespondence import TLACDCCorrespondence
 
 
@@ -20,6 +25,35 @@ def set_ground_truth_edges(canonical_circuit_subgraph: TLACDCCorrespondence, gro
         edge.present = key in ground_truth_set
 
 
+def metric_for_examples(
+    metric: Callable[[torch.Tensor], torch.Tensor], batch_size: int, examples: slice
+) -> Callable[[torch.Tensor], torch.Tensor]:
+    """Restricts a metric of `AllDataThings` (which is bound to the data of a whole batch of `batch_size` examples)
+    to the logits of `examples`. The restricted metric returns the unreduced values (return_one_element=False),
+    so that the metric of the whole batch is the mean of the values of all its parts.
+
+    Every tensor that the metric is bound to whose first dimension is `batch_size` is sliced."""
+
+    def select(value):
+        if isinstance(value, torch.Tensor) and value.ndim > 0 and value.shape[0] == batch_size:
+            return value[examples]
+        return value
+
+    if isinstance(metric, functools.partial):
+        return functools.partial(
+            metric.func,
+            *map(select, metric.args),
+            **{k: select(v) for k, v in metric.keywords.items()} | {"return_one_element": False},
+        )
+    if isinstance(metric, MatchNLLMetric):
+        restricted_metric = copy.copy(metric)
+        for k, v in vars(metric).items():
+            setattr(restricted_metric, k, select(v))
+        restricted_metric.return_one_element = False
+        return restricted_metric
+    raise TypeError(f"Don't know how to restrict the metric {metric} to a part of the batch")
+
+
 def print_stats(recovered_corr, ground_truth_subgraph, do_print=True):
     """
     False positive = present in recovered_corr but not in ground_truth_set
@@ -3,6 +3,8 @@ import collections
 import gc
 import math
 import random
+import weakref
+from dataclasses import dataclass
 from typing import Callable, ContextManager, List, Optional
 
 import torch
@@ -22,11 +24,109 @@ from acdc.greaterthan.utils import get_all_greaterthan_things, get_greaterthan_t
 from acdc.induction.utils import get_all_induction_things
 from acdc.ioi.utils import get_all_ioi_things
 from acdc.TLACDCCorrespondence import TLACDCCorrespondence
-from acdc.TLACDCEdge import EdgeType, TorchIndex
+from acdc.TLACDCEdge import EdgeInfo, EdgeType, TorchIndex
 from acdc.TLACDCInterpNode import TLACDCInterpNode
 from acdc.tracr_task.utils import get_all_tracr_things
 
 
+class CorrespondenceEdgeIndex:
+    """Numbers the edges of a correspondence (in the order of `corr.edges`) and keeps the ids of the incoming and
+    outgoing edges of every node, so that the edges of a node can be found without looking at all the edges.
+
+    The index is only valid as long as no edges are added to or removed from the correspondence;
+    use `CorrespondenceEdgeIndex.of` to share the index of a correspondence."""
+
+    _indexes: "weakref.WeakKeyDictionary[TLACDCCorrespondence, CorrespondenceEdgeIndex]" = weakref.WeakKeyDictionary()
+
+    def __init__(self, corr: TLACDCCorrespondence):
+        self.corr = corr
+        self.edges: list[EdgeInfo] = []
+        # (node name, node index) -> ids of the edges where the node is the child/the parent
+        self.incoming: dict[tuple[str, TorchIndex], list[int]] = collections.defaultdict(list)
+        self.outgoing: dict[tuple[str, TorchIndex], list[int]] = collections.defaultdict(list)
+        for child_name, by_child_index in corr.edges.items():
+            for child_index, by_parent_name in by_child_index.items():
+                for parent_name, by_parent_index in by_parent_name.items():
+                    for parent_index, edge in by_parent_index.items():
+                        self.incoming[(child_name, child_index)].append(len(self.edges))
+                        self.outgoing[(parent_name, parent_index)].append(len(self.edges))
+                        self.edges.append(edge)
+
+    @classmethod
+    def of(cls, corr: TLACDCCorrespondence) -> "CorrespondenceEdgeIndex":
+        """The index of `corr`, which is only built the first time it is needed."""
+        if corr not in cls._indexes:
+            cls._indexes[corr] = cls(corr)
+        return cls._indexes[corr]
+
+    def edge_ids_of_node(self, name: str, index: TorchIndex) -> list[int]:
+        """The ids of the edges where the node is the child or the parent."""
+        return self.incoming.get((name, index), []) + self.outgoing.get((name, index), [])
+
+    def present(self) -> torch.Tensor:
+        """Which edges are present, as a bool tensor."""
+        return torch.tensor([edge.present for edge in self.edges], dtype=torch.bool)
+
+    def set_present(self, present: torch.Tensor) -> None:
+        for edge, edge_present in zip(self.edges, present.tolist()):
+            edge.present = edge_present
+
+
+@dataclass(frozen=True)
+class CorrespondenceSnapshot:
+    """A step recorded in `CorrespondenceSnapshots`."""
+
+    snapshots: "CorrespondenceSnapshots"
+    step: int
+
+    def correspondence(self) -> TLACDCCorrespondence:
+        return self.snapshots.correspondence(self.step)
+
+
+class CorrespondenceSnapshots:
+    """Records the circuits of a process that removes more and more edges from a correspondence (like
+    `iterative_correspondence_from_mask` with a growing set of nodes), without copying the correspondence for
+    every step: for every edge, we only store the step at which it was removed.
+
+    Use `record` after every step, and only look at the recorded circuits (with `correspondence` or
+    `CorrespondenceSnapshot.correspondence`) when all steps have been recorded: this sets the edges of the
+    correspondence itself to the circuit of that step."""
+
+    NEVER_REMOVED = torch.iinfo(torch.int64).max
+
+    def __init__(self, corr: TLACDCCorrespondence):
+        self.corr = corr
+        self.index = CorrespondenceEdgeIndex.of(corr)
+        self.initially_present = self.index.present()
+        self.removed_at_step = torch.full(self.initially_present.shape, self.NEVER_REMOVED, dtype=torch.int64)
+        self.num_steps = 0
+        self._last_present = self.initially_present
+
+    def record(self) -> CorrespondenceSnapshot:
+        """Records the current circuit of the correspondence as the next step."""
+        present = self.index.present()
+        if (present & ~self._last_present).any():
+            raise ValueError("Edges can only be removed from the correspondence between steps, not added")
+        self.removed_at_step[self._last_present & ~present] = self.num_steps
+        self._last_present = present
+        self.num_steps += 1
+        return CorrespondenceSnapshot(self, self.num_steps - 1)
+
+    def removed_edge_ids(self, step: int) -> torch.Tensor:
+        """The ids (see `CorrespondenceEdgeIndex`) of the edges that were removed in `step`."""
+        return (self.removed_at_step == step).nonzero().squeeze(-1)
+
+    def present(self, step: int) -> torch.Tensor:
+        """Which edges are present in the circuit of `step`, as a bool tensor."""
+        assert 0 <= step < self.num_steps, step
+        return self.initially_present & (self.removed_at_step > step)
+
+    def correspondence(self, step: int) -> TLACDCCorrespondence:
+        """Sets the edges of the correspondence to the circuit of `step`, and returns it."""
+        self.index.set_present(self.present(step))
+        return self.corr
+
+
 def iterative_correspondence_from_mask(
     model: HookedTransformer,
     nodes_to_mask: list[TLACDCInterpNode],  # Can be empty
@@ -79,18 +179,11 @@ def iterative_correspondence_from_mask(
         [v <= 3 for v in head_parents.values()]
     ), "We should have at most three parents (Q, K and V, connected via placeholders)"
 
+    # Mark edges where this is child or parent as not present
+    edge_index = CorrespondenceEdgeIndex.of(corr)
     for node in nodes_to_mask + additional_nodes_to_mask:
-        # Mark edges where this is child as not present
-        rest2 = corr.edges[node.name][node.index]
-        for rest3 in rest2.values():
-            for edge in rest3.values():
-                edge.present = False
-
-        # Mark edges where this is parent as not present
-        for rest1 in corr.edges.values():
-            for rest2 in rest1.values():
-                if node.name in rest2 and node.index in rest2[node.name]:
-                    rest2[node.name][node.index].present = False
+        for edge_id in edge_index.edge_ids_of_node(node.name, node.index):
+            edge_index.edges[edge_id].present = False
 
     return corr, head_parents
 
@@ -1,6 +1,7 @@
 # %%
 
 import argparse
+import dataclasses
 import gc
 import os
 import pickle
@@ -30,8 +31,9 @@ from acdc.tracr_task.utils import (
     get_tracr_proportion_edges,
     get_tracr_reverse_edges,
 )
-from subnetwork_probing.masked_transformer import EdgeLevelMaskedTransformer
+from subnetwork_probing.masked_transformer import EdgeLevelMaskedTransformer, MaskSampleMetrics
 from subnetwork_probing.sp_utils import (
+    metric_for_examples,
     print_stats,
     set_ground_truth_edges,
 )
@@ -47,6 +49,216 @@ def save_edges(corr: TLACDCCorrespondence, fname: str):
         pickle.dump(edges_list, f)
 
 
+def save_and_log_edges(
+    corr: TLACDCCorrespondence, edges_fname: str, extra_files: dict[str, torch.Tensor] | None = None
+):
+    """Saves the edges of `corr` (and the tensors in `extra_files`) and logs them as a wandb artifact."""
+    wandb_dir = os.environ.get("WANDB_DIR")
+    if wandb_dir is None:
+        save_edges(corr, edges_fname)
+    else:
+        save_edges(corr, os.path.join(wandb_dir, edges_fname))
+    artifact = wandb.Artifact(edges_fname, type="dataset")
+    artifact.add_file(edges_fname)
+    for fname, tensor in (extra_files or {}).items():
+        torch.save(tensor, fname)
+        artifact.add_file(fname)
+    wandb.log_artifact(artifact)
+    os.remove(edges_fname)
+    for fname in extra_files or {}:
+        os.remove(fname)
+
+
+def per_mask_set_metric(
+    masked_model: EdgeLevelMaskedTransformer,
+    metric: Callable[[torch.Tensor], torch.Tensor],
+    hooked_model: torch.nn.Module,
+    data: torch.Tensor,
+) -> torch.Tensor:
+    """Runs `data` through `hooked_model` for every mask set, and applies `metric` to the logits of every mask set
+    separately (because the metrics are defined for a batch of `data`).
+
+    Returns a scalar if there is a single set of masks, and one value per mask set otherwise."""
+    logits = hooked_model(masked_model.replicate_for_mask_sets(data))
+    if masked_model.num_mask_sets is None:
+        return metric(logits)
+    return torch.stack([metric(mask_set_logits) for mask_set_logits in logits.chunk(masked_model.num_mask_sets)])
+
+
+def micro_batched_metric(
+    masked_model: EdgeLevelMaskedTransformer,
+    metric: Callable[[torch.Tensor], torch.Tensor],
+    data: torch.Tensor,
+    patch_data: torch.Tensor | None,
+    micro_batch_size: int | None,
+    backward: bool = False,
+) -> torch.Tensor:
+    """The value of `metric` on `data` for every mask set (see `per_mask_set_metric`), ablating with `patch_data`.
+
+    If `micro_batch_size` is set, `data` and `patch_data` are split into micro-batches of that many examples, and
+    the ablation cache is calculated for one micro-batch at a time, so that the memory use scales with the
+    micro-batch size instead of the size of `data`. The metric is evaluated per example (see
+    `metric_for_examples`) and all masks are sampled once for all micro-batches, so the result is the same as for
+    a single batch.
+
+    If `backward` is set, the gradient of the sum over the mask sets of the metric is added to the gradient of the
+    mask parameters (one micro-batch at a time), and the returned value is detached."""
+    if micro_batch_size is None:
+        with masked_model.with_fwd_hooks_and_new_ablation_cache(patch_data) as hooked_model:
+            value = per_mask_set_metric(masked_model, metric, hooked_model, data)
+        if backward:
+            value.sum().backward()
+            value = value.detach()
+        return value
+
+    batch_size = len(data)
+    mask_params = [p for p in masked_model.mask_parameter_list if p.requires_grad]
+    grads = [torch.zeros_like(p) for p in mask_params]
+    sum_of_values = torch.zeros((), device=masked_model.device)
+    num_values = 0
+    with masked_model.with_fixed_mask_noise():
+        for start in range(0, batch_size, micro_batch_size):
+            examples = slice(start, start + micro_batch_size)
+            micro_batch_patch_data = None if patch_data is None else patch_data[examples]
+            with masked_model.with_fwd_hooks_and_new_ablation_cache(micro_batch_patch_data) as hooked_model:
+                values = per_mask_set_metric(
+                    masked_model, metric_for_examples(metric, batch_size, examples), hooked_model, data[examples]
+                )  # the unreduced values, for every mask set
+            if backward:
+                for grad, micro_batch_grad in zip(grads, torch.autograd.grad(values.sum(), mask_params)):
+                    grad += micro_batch_grad
+            sum_of_values = sum_of_values + values.detach().sum(dim=-1)
+            num_values += values.shape[-1]
+
+    if backward:
+        # the metric is the mean of the values of all micro-batches
+        for p, grad in zip(mask_params, grads):
+            grad /= num_values
+            if p.grad is None:
+                p.grad = grad
+            else:
+                p.grad += grad
+    return sum_of_values / num_values
+
+
+def evaluate_mask_samples(
+    masked_model: EdgeLevelMaskedTransformer,
+    metrics: dict[str, Callable[[torch.Tensor], torch.Tensor]],
+    data: torch.Tensor,
+    patch_data: torch.Tensor | None,
+    num_samples: int,
+    samples_per_forward: int | None,
+    micro_batch_size: int | None,
+) -> dict[str, MaskSampleMetrics]:
+    """Evaluates `metrics` for `num_samples` samples of the masks, `samples_per_forward` at a time (see
+    `EdgeLevelMaskedTransformer.evaluate_mask_samples`). With micro-batches, the samples are evaluated one at a
+    time instead, with the data split into micro-batches (see `micro_batched_metric`)."""
+    if micro_batch_size is None:
+        return masked_model.evaluate_mask_samples(
+            metrics, data, patch_data, num_samples, max_samples_per_forward=samples_per_forward
+        )
+
+    values: dict[str, list[torch.Tensor]] = {name: [] for name in metrics}
+    for _ in range(num_samples):
+        with masked_model.with_fixed_mask_noise():  # all metrics are evaluated on the same sample
+            for name, metric in metrics.items():
+                values[name].append(micro_batched_metric(masked_model, metric, data, patch_data, micro_batch_size))
+    return {name: MaskSampleMetrics(torch.stack(metric_values)) for name, metric_values in values.items()}
+
+
+def per_mask_set_log_dict(
+    values: dict[str, torch.Tensor | float], lambda_regs: list[float] | None, mask_set: int | None
+) -> dict[str, float]:
+    """The entries of `values` that belong to `mask_set`, with the regularization coefficient in the name
+    (unless there is a single set of masks). Values that are the same for every mask set are floats."""
+    if mask_set is None:
+        return {k: v.item() if isinstance(v, torch.Tensor) else v for k, v in values.items()}
+    assert lambda_regs is not None
+    return {
+        f"{k}/lambda_reg={lambda_regs[mask_set]:g}": v[mask_set].item() if isinstance(v, torch.Tensor) else v
+        for k, v in values.items()
+    }
+
+
+@dataclasses.dataclass
+class EarlyStopping:
+    """Decides when the masks have converged, i.e. when over the last `window` epochs
+    - the fraction of binary (0 or 1) mask values is at least `min_binary_fraction`,
+    - the number of edges has changed by at most `edge_count_tolerance` times the mean number of edges (but at least
+      by one edge, as the masks are sampled), and
+    - the mean of the loss in the second half of the window differs by at most `loss_tolerance` times (the absolute
+      value of) the mean in the first half.
+    With several mask sets, all of them have to have converged."""
+
+    window: int
+    min_binary_fraction: float
+    edge_count_tolerance: float
+    loss_tolerance: float
+    # (binary fraction, number of edges, loss) of the last `window` epochs, for every mask set
+    history: list[tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = dataclasses.field(default_factory=list)
+
+    def update(self, binary_fraction: torch.Tensor, num_edges: torch.Tensor, loss: torch.Tensor) -> bool:
+        """Adds the values of an epoch, and returns whether the masks have converged."""
+        self.history.append((binary_fraction.cpu(), num_edges.cpu(), loss.detach().cpu()))
+        self.history = self.history[-self.window :]
+        if len(self.history) < self.window:
+            return False
+
+        binary_fractions, edge_counts, losses = (torch.stack(values) for values in zip(*self.history))
+        edge_counts = edge_counts.float()
+        first_half_loss = losses[: self.window // 2].mean(dim=0)
+        second_half_loss = losses[self.window // 2 :].mean(dim=0)
+        converged = (
+            (binary_fractions.min(dim=0).values >= self.min_binary_fraction)
+            & (
+                edge_counts.max(dim=0).values - edge_counts.min(dim=0).values
+                <= (self.edge_count_tolerance * edge_counts.mean(dim=0)).clamp(min=1)
+            )
+            & ((second_half_loss - first_half_loss).abs() <= self.loss_tolerance * first_half_loss.abs())
+        )
+        return bool(converged.all())
+
+
+def save_checkpoint(
+    path: str,
+    epoch: int,
+    finished: bool,
+    masked_model: EdgeLevelMaskedTransformer,
+    trainer: torch.optim.Optimizer,
+    early_stopping: EarlyStopping | None,
+):
+    """Saves everything that is needed to continue training after `epoch` (see `load_checkpoint`)."""
+    checkpoint = {
+        "epoch": epoch,
+        "finished": finished,
+        "mask_parameters": masked_model.mask_parameter_list.state_dict(),
+        "optimizer": trainer.state_dict(),
+        "rng_state": torch.random.get_rng_state(),
+        "cuda_rng_state": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        "early_stopping_history": None if early_stopping is None else early_stopping.history,
+        "wandb_run_id": wandb.run.id if wandb.run is not None else None,
+    }
+    # write to a temporary file first, so that we never leave a partially written checkpoint behind
+    torch.save(checkpoint, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(
+    checkpoint: dict,
+    masked_model: EdgeLevelMaskedTransformer,
+    trainer: torch.optim.Optimizer,
+    early_stopping: EarlyStopping | None,
+):
+    """Restores the state of a checkpoint that was saved with `save_checkpoint`."""
+    masked_model.mask_parameter_list.load_state_dict(checkpoint["mask_parameters"])
+    trainer.load_state_dict(checkpoint["optimizer"])
+    if early_stopping is not None and checkpoint["early_stopping_history"] is not None:
+        early_stopping.history = checkpoint["early_stopping_history"]
+    torch.random.set_rng_state(checkpoint["rng_state"])
+    if checkpoint["cuda_rng_state"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(checkpoint["cuda_rng_state"])
+
+
 def train_edge_sp(
     args,
     masked_model: EdgeLevelMaskedTransformer,
@@ -56,10 +268,20 @@ def train_edge_sp(
 ):
     print(f"Using memory {torch.cuda.memory_allocated():_} bytes at training start")
     epochs = args.epochs
-    lambda_reg = args.lambda_reg
+    # with several mask sets, every mask set has its own regularization coefficient
+    lambda_regs = args.lambda_regs
+    assert (lambda_regs is None) == (masked_model.num_mask_sets is None)
+    mask_sets = [None] if lambda_regs is None else list(range(len(lambda_regs)))
+    lambda_reg = args.lambda_reg if lambda_regs is None else torch.tensor(lambda_regs, device=masked_model.device)
 
     torch.manual_seed(args.seed)
 
+    checkpoint_path = args.checkpoint_path or os.path.join(args.wandb_dir, "sp_checkpoint.pt")
+    checkpoint = None
+    if args.resume and os.path.exists(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, map_location=masked_model.device, weights_only=False)
+        print(f"Resuming from {checkpoint_path} after epoch {checkpoint['epoch']}")
+
     wandb.init(
         name=args.wandb_name,
         project=args.wandb_project,
@@ -68,6 +290,9 @@ def train_edge_sp(
         config=args,
         dir=args.wandb_dir,
         mode=args.wandb_mode,
+        # continue logging to the same run when resuming
+        id=None if checkpoint is None else checkpoint["wandb_run_id"],
+        resume=None if checkpoint is None else "allow",
     )
     test_metric_fns = all_task_things.test_metrics
     print(args)
@@ -90,7 +315,8 @@ def train_edge_sp(
                 {k: v(reset_logits).item() for k, v in all_task_things.test_metrics.items()},
             )
 
-    # one parameter per thing that is masked
+    # a single flat parameter with the mask logits of everything that is masked
+    # (Adam's state is per element, so every mask set effectively has its own optimizer)
     mask_params = list(p for p in masked_model.mask_parameter_list if p.requires_grad)
     # parameters for the probe (we don't use a probe)
     model_params = list(p for p in masked_model.model.parameters() if p.requires_grad)
@@ -111,99 +337,147 @@ def train_edge_sp(
     d_trues = set(get_true_edges())
     set_ground_truth_edges(canonical_circuit_subgraph, d_trues)
 
-    for epoch in tqdm(range(epochs)):  # tqdm.notebook.tqdm(range(epochs)):
+    early_stopping = None
+    if args.early_stopping_window > 0:
+        early_stopping = EarlyStopping(
+            window=args.early_stopping_window,
+            min_binary_fraction=args.early_stopping_binary_fraction,
+            edge_count_tolerance=args.early_stopping_edge_tolerance,
+            loss_tolerance=args.early_stopping_loss_tolerance,
+        )
+    start_epoch, finished = 0, False
+    if checkpoint is not None:
+        load_checkpoint(checkpoint, masked_model, trainer, early_stopping)
+        start_epoch, finished = checkpoint["epoch"] + 1, checkpoint["finished"]
+    epochs_trained = start_epoch
+
+    # (if the checkpoint is from after training has finished, there is nothing left to train)
+    for epoch in tqdm(range(start_epoch, start_epoch if finished else epochs)):  # tqdm.notebook.tqdm(range(epochs)):
         masked_model.train()
         trainer.zero_grad()
-        with masked_model.with_fwd_hooks_and_new_ablation_cache(validation_patch_data) as hooked_model:
-            # print(f"Using memory {torch.cuda.memory_allocated():_} bytes before forward")
-            metric_loss = all_task_things.validation_metric(hooked_model(all_task_things.validation_data))
-            # print(f"Using memory {torch.cuda.memory_allocated():_} bytes after forward")
+        # print(f"Using memory {torch.cuda.memory_allocated():_} bytes before forward")
+        # the mask sets are independent, so summing their losses trains each of them on its own loss
+        metric_loss = micro_batched_metric(
+            masked_model,
+            all_task_things.validation_metric,
+            all_task_things.validation_data,
+            validation_patch_data,
+            args.micro_batch_size,
+            backward=True,
+        )
+        # print(f"Using memory {torch.cuda.memory_allocated():_} bytes after forward")
         regularizer_term = masked_model.regularization_loss()
-        loss = metric_loss + regularizer_term * lambda_reg
-        loss.backward()
+        (regularizer_term * lambda_reg).sum().backward()
+        loss = metric_loss + regularizer_term.detach() * lambda_reg
 
         trainer.step()
 
         if epoch % print_every == 0 and args.print_stats:
-            statss = []
-            for i in range(3):  # sample multiple times to get average edge_tpr etc.
-                corr = masked_model.get_edge_level_correspondence_from_masks()
-                stats = print_stats(corr, canonical_circuit_subgraph, do_print=False)
-                statss.append(stats)
-            stats = {k: sum(s[k] for s in statss) / len(statss) for k in statss[0]}
             with torch.no_grad():
-                with masked_model.with_fwd_hooks_and_new_ablation_cache(test_patch_data) as hooked_model:
-                    test_metric_loss = all_task_things.validation_metric(hooked_model(all_task_things.test_data))
-            test_loss = test_metric_loss + regularizer_term * lambda_reg
-
-            wandb.log(
-                {
-                    "epoch": epoch,
-                    "num_edges": masked_model.num_edges(),
-                    "regularization_loss": regularizer_term.item(),
-                    "validation_metric_loss": metric_loss.item(),
-                    "test_metric_loss": test_metric_loss.item(),
-                    "total_loss": loss.item(),
-                    "test_total_loss": test_loss,
-                }
-                | stats
-            )
+                test_metric_loss = micro_batched_metric(
+                    masked_model,
+                    all_task_things.validation_metric,
+                    all_task_things.test_data,
+                    test_patch_data,
+                    args.micro_batch_size,
+                )
+            test_loss = test_metric_loss + regularizer_term.detach() * lambda_reg
+
+            log_dict = {"epoch": epoch}
+            for mask_set in mask_sets:
+                statss = []
+                for i in range(3):  # sample multiple times to get average edge_tpr etc.
+                    corr = masked_model.get_edge_level_correspondence_from_masks(mask_set=mask_set)
+                    stats = print_stats(corr, canonical_circuit_subgraph, do_print=False)
+                    statss.append(stats)
+                stats = {k: sum(s[k] for s in statss) / len(statss) for k in statss[0]}
+                log_dict |= per_mask_set_log_dict(
+                    {
+                        "num_edges": masked_model.num_edges(mask_set),
+                        "regularization_loss": regularizer_term.detach(),
+                        "validation_metric_loss": metric_loss.detach(),
+                        "test_metric_loss": test_metric_loss,
+                        "total_loss": loss,
+                        "test_total_loss": test_loss,
+                    }
+                    | stats,
+                    lambda_regs,
+                    mask_set,
+                )
+            wandb.log(log_dict)
             # TODO edit this to create a corr from masked edges
             # number_of_nodes, nodes_to_mask = visualize_mask(masked_model)
             # corr, _ = iterative_correspondence_from_mask(masked_model.model, nodes_to_mask)
             # print_stats(corr, d_trues, canonical_circuit_subgraph)
 
+        epochs_trained = epoch + 1
+        if early_stopping is not None:
+            # don't use the random number generator that is used for training, so that early stopping does not
+            # change the training run
+            with torch.random.fork_rng(devices=[masked_model.device] if masked_model.device.type == "cuda" else []):
+                finished = early_stopping.update(
+                    torch.tensor([masked_model.proportion_of_binary_scores(mask_set) for mask_set in mask_sets]),
+                    torch.tensor([masked_model.num_edges(mask_set) for mask_set in mask_sets]),
+                    loss.reshape(-1),
+                )
+            if finished:
+                print(f"Masks have converged after {epochs_trained} epochs, stopping early")
+        if args.checkpoint_every > 0 and (epochs_trained % args.checkpoint_every == 0 or finished):
+            save_checkpoint(checkpoint_path, epoch, finished, masked_model, trainer, early_stopping)
+        if finished:
+            break
+
     # Save edges to create data for plots later
-    corr = masked_model.get_edge_level_correspondence_from_masks()
-    edges_fname = "edges.pth"  # note this is a pickle file
-    wandb_dir = os.environ.get("WANDB_DIR")
-    if wandb_dir is None:
-        save_edges(corr, edges_fname)
+    # (note these are pickle files; with several mask sets, we also save the mask logits of every mask set)
+    if lambda_regs is None:
+        save_and_log_edges(masked_model.get_edge_level_correspondence_from_masks(), "edges.pth")
     else:
-        save_edges(corr, os.path.join(wandb_dir, edges_fname))
-    artifact = wandb.Artifact(edges_fname, type="dataset")
-    artifact.add_file(edges_fname)
-    wandb.log_artifact(artifact)
-    os.remove(edges_fname)
+        for mask_set, mask_set_lambda_reg in enumerate(lambda_regs):
+            save_and_log_edges(
+                masked_model.get_edge_level_correspondence_from_masks(mask_set=mask_set),
+                f"edges_lambda_reg_{mask_set_lambda_reg:g}.pth",
+                extra_files={
+                    f"mask_logits_lambda_reg_{mask_set_lambda_reg:g}.pt": masked_model.flat_mask_parameters[mask_set]
+                    .detach()
+                    .cpu()
+                },
+            )
 
     # Now calculate final metrics
     with torch.no_grad():
-        # The loss has a lot of variance so let's just average over a few runs with the same seed
-        rng_state = torch.random.get_rng_state()
-
-        # Final training loss
-        metric_loss = 0.0
-        masked_model.calculate_and_store_ablation_cache(
-            all_task_things.validation_patch_data if not args.zero_ablation else None
-        )
-
-        for _ in range(args.n_loss_average_runs):
-            with masked_model.with_fwd_hooks_and_new_ablation_cache(validation_patch_data) as hooked_model:
-                metric_loss += all_task_things.validation_metric(hooked_model(all_task_things.validation_data)).item()
-        print(f"Final train/validation metric: {metric_loss:.4f}")
-
-        masked_model.calculate_and_store_ablation_cache(
-            all_task_things.test_patch_data if not args.zero_ablation else None
+        # The loss has a lot of variance so let's just average over a few samples of the masks
+        # (as before, the logged metrics are the sums over the samples)
+        final_metrics = evaluate_mask_samples(
+            masked_model,
+            {"specific_metric": all_task_things.validation_metric},
+            all_task_things.validation_data,
+            validation_patch_data,
+            args.n_loss_average_runs,
+            args.eval_samples_per_forward or None,
+            args.micro_batch_size,
         )
-
-        test_specific_metrics = {}
-        for k, fn in test_metric_fns.items():
-            torch.random.set_rng_state(rng_state)
-            test_specific_metric_term = 0.0
-            # Test loss
-            for _ in range(args.n_loss_average_runs):
-                with masked_model.with_fwd_hooks_and_new_ablation_cache(validation_patch_data) as hooked_model:
-                    test_specific_metric_term += fn(hooked_model(all_task_things.test_data)).item()
-            test_specific_metrics[f"test_{k}"] = test_specific_metric_term
-
-        print(f"Final test metric: {test_specific_metrics}")
-
-        log_dict = dict(
-            # number_of_nodes=number_of_nodes,
-            specific_metric=metric_loss,
-            # nodes_to_mask=nodes_to_mask,
-            **test_specific_metrics,
+        print(f"Final train/validation metric: {final_metrics['specific_metric'].values.sum(dim=0).tolist()}")
+
+        test_specific_metrics = evaluate_mask_samples(
+            masked_model,
+            {f"test_{k}": fn for k, fn in test_metric_fns.items()},
+            all_task_things.test_data,
+            validation_patch_data,
+            args.n_loss_average_runs,
+            args.eval_samples_per_forward or None,
+            args.micro_batch_size,
         )
+        final_metrics |= test_specific_metrics
+        print(f"Final test metric: { {k: v.values.sum(dim=0).tolist() for k, v in test_specific_metrics.items()} }")
+
+        log_dict = {"epochs_trained": epochs_trained}
+        for mask_set in mask_sets:
+            log_dict |= per_mask_set_log_dict(
+                {k: v.values.sum(dim=0) for k, v in final_metrics.items()}
+                | {f"{k}_variance": v.variance for k, v in final_metrics.items()},
+                lambda_regs,
+                mask_set,
+            )
     return masked_model, log_dict
 
 
@@ -220,6 +494,28 @@ parser.add_argument("--loss-type", type=str, required=True)
 parser.add_argument("--epochs", type=int, default=3000)
 parser.add_argument("--verbose", type=int, default=1)
 parser.add_argument("--lambda-reg", type=float, default=100)
+parser.add_argument(
+    "--lambda-regs",
+    type=float,
+    nargs="+",
+    default=None,
+    help="Train one set of masks for each of these regularization coefficients at the same time, "
+    "sharing the model and the ablation cache (overrides --lambda-reg)",
+)
+parser.add_argument(
+    "--micro-batch-size",
+    type=int,
+    default=None,
+    help="Run the data through the model this many examples at a time, accumulating the gradient "
+    "(default: all examples at once)",
+)
+parser.add_argument(
+    "--checkpoint-activations",
+    type=int,
+    default=0,
+    help="Recompute the inputs of the masked hook points in the backward pass instead of storing them "
+    "(uses less memory, but is slower)",
+)
 parser.add_argument("--zero-ablation", type=int, required=True)
 parser.add_argument("--reset-subject", type=int, default=0)
 parser.add_argument(
@@ -231,6 +527,13 @@ parser.add_argument(
 parser.add_argument("--num-examples", type=int, default=50)
 parser.add_argument("--seq-len", type=int, default=300)
 parser.add_argument("--n-loss-average-runs", type=int, default=4)
+parser.add_argument(
+    "--eval-samples-per-forward",
+    type=int,
+    default=4,
+    help="For the final metrics, evaluate this many samples of the masks (of --n-loss-average-runs) in a single "
+    "forward pass; 0 means all of them",
+)
 parser.add_argument("--task", type=str, required=True)
 parser.add_argument(
     "--torch-num-threads",
@@ -239,6 +542,48 @@ parser.add_argument(
     help="How many threads to use for torch (0=all)",
 )
 parser.add_argument("--print-stats", type=int, default=1, required=False)
+parser.add_argument(
+    "--early-stopping-window",
+    type=int,
+    default=0,
+    help="Stop training when the masks have converged over this many epochs (default: 0, never stop early)",
+)
+parser.add_argument(
+    "--early-stopping-binary-fraction",
+    type=float,
+    default=0.99,
+    help="Early stopping: the minimum fraction of mask values that are 0 or 1",
+)
+parser.add_argument(
+    "--early-stopping-edge-tolerance",
+    type=float,
+    default=0.01,
+    help="Early stopping: the maximum change in the number of edges over the window, relative to the mean",
+)
+parser.add_argument(
+    "--early-stopping-loss-tolerance",
+    type=float,
+    default=0.01,
+    help="Early stopping: the maximum relative change of the mean loss between the two halves of the window",
+)
+parser.add_argument(
+    "--checkpoint-every",
+    type=int,
+    default=0,
+    help="Save a training checkpoint every this many epochs (default: 0, never)",
+)
+parser.add_argument(
+    "--checkpoint-path",
+    type=str,
+    default=None,
+    help="Where to save the training checkpoint (default: sp_checkpoint.pt in --wandb-dir)",
+)
+parser.add_argument(
+    "--resume",
+    type=int,
+    default=0,
+    help="Continue from the training checkpoint at --checkpoint-path, if it exists",
+)
 
 # %%
 if __name__ == "__main__":
@@ -298,7 +643,11 @@ if __name__ == "__main__":
     else:
         raise ValueError(f"Unknown task {args.task}")
 
-    masked_model = EdgeLevelMaskedTransformer(all_task_things.tl_model)
+    masked_model = EdgeLevelMaskedTransformer(
+        all_task_things.tl_model,
+        num_mask_sets=None if args.lambda_regs is None else len(args.lambda_regs),
+        checkpoint_activations=bool(args.checkpoint_activations),
+    )
     masked_model = masked_model.to(args.device)
 
     masked_model.freeze_weights()
@@ -310,12 +659,15 @@ if __name__ == "__main__":
         get_true_edges=get_true_edges,
     )
 
-    percentage_binary = masked_model.proportion_of_binary_scores()
-
     # Update dict with some different things
     # log_dict["nodes_to_mask"] = list(map(str, log_dict["nodes_to_mask"]))
     # to_log_dict["number_of_edges"] = corr.count_no_edges() TODO
-    log_dict["percentage_binary"] = percentage_binary
+    for mask_set in [None] if args.lambda_regs is None else range(len(args.lambda_regs)):
+        log_dict |= per_mask_set_log_dict(
+            {"percentage_binary": masked_model.proportion_of_binary_scores(mask_set)},
+            args.lambda_regs,
+            mask_set,
+        )
 
     wandb.log(log_dict)
 
@@ -0,0 +1,144 @@
+import importlib.metadata
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from acdc.tracr_task import utils
+from acdc.tracr_task.utils import _TracrModelParts, get_tracr_model_input_and_tl_model
+
+CFG_KWARGS = dict(
+    n_layers=1,
+    d_model=8,
+    d_head=4,
+    n_ctx=5,
+    d_vocab=5,
+    d_vocab_out=3,
+    d_mlp=8,
+    n_heads=2,
+    act_fn="relu",
+    attention_dir="bidirectional",
+    normalization_type=None,
+    use_attn_result=True,
+    use_split_qkv_input=True,
+)
+
+
+def make_parts() -> _TracrModelParts:
+    torch.manual_seed(0)
+    return _TracrModelParts(
+        cfg_kwargs=CFG_KWARGS,
+        state_dict=HookedTransformer(HookedTransformerConfig(**CFG_KWARGS, device="cpu")).state_dict(),
+        input_encoding_map=[(1, 0), (2, 1), (3, 2), ("BOS", 3), ("compiler_pad", 4)],
+        output_encoding_map=[(1, 0), (2, 1), (3, 2)],
+    )
+
+
+@pytest.fixture
+def compile_calls(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    calls = []
+
+    def compile_tracr_model_parts(task: str) -> _TracrModelParts:
+        calls.append(task)
+        return make_parts()
+
+    monkeypatch.setattr(utils, "_compile_tracr_model_parts", compile_tracr_model_parts)
+    monkeypatch.setattr(utils, "_package_version", lambda name: "1.0.0+abc")
+    return calls
+
+
+def test_model_is_only_compiled_once(tmp_path: Path, compile_calls: list[str]):
+    create_model_input, tl_model = get_tracr_model_input_and_tl_model("reverse", device="cpu", cache_dir=tmp_path)
+    cached_create_model_input, cached_tl_model = get_tracr_model_input_and_tl_model(
+        "reverse", device="cpu", cache_dir=tmp_path
+    )
+    assert compile_calls == ["reverse"]
+
+    input = cached_create_model_input(["BOS", 3, 1, 2])
+    assert input.tolist() == [[3, 2, 0, 1]]
+    assert torch.equal(cached_tl_model(input), tl_model(create_model_input(["BOS", 3, 1, 2])))
+    assert cached_tl_model.cfg.use_hook_mlp_in
+
+    get_tracr_model_input_and_tl_model("proportion", device="cpu", cache_dir=tmp_path)
+    get_tracr_model_input_and_tl_model("reverse", device="cpu", cache_dir=None)
+    assert compile_calls == ["reverse", "proportion", "reverse"]
+
+
+def test_other_tracr_version_is_compiled_again(
+    tmp_path: Path, compile_calls: list[str], monkeypatch: pytest.MonkeyPatch
+):
+    get_tracr_model_input_and_tl_model("reverse", device="cpu", cache_dir=tmp_path)
+    monkeypatch.setattr(utils, "_package_version", lambda name: "1.0.0+def" if name == "tracr" else "1.0.0+abc")
+    get_tracr_model_input_and_tl_model("reverse", device="cpu", cache_dir=tmp_path)
+    assert compile_calls == ["reverse", "reverse"]
+
+
+def test_cache_that_does_not_fit_the_model_is_compiled_again(tmp_path: Path, compile_calls: list[str]):
+    get_tracr_model_input_and_tl_model("reverse", device="cpu", cache_dir=tmp_path)
+    (model_dir,) = tmp_path.iterdir()
+    state_dict = torch.load(model_dir / "state_dict.pt")
+    del state_dict["blocks.0.attn.W_Q"]  # like a parameter that a later transformer_lens added
+    torch.save(state_dict, model_dir / "state_dict.pt")
+
+    get_tracr_model_input_and_tl_model("reverse", device="cpu", cache_dir=tmp_path)
+    get_tracr_model_input_and_tl_model("reverse", device="cpu", cache_dir=tmp_path)
+    assert compile_calls == ["reverse", "reverse"]
+
+
+def test_valid_cache_entry_is_kept(tmp_path: Path, compile_calls: list[str]):
+    get_tracr_model_input_and_tl_model("reverse", device="cpu", cache_dir=tmp_path)
+    (model_dir,) = tmp_path.iterdir()
+    inode = (model_dir / "state_dict.pt").stat().st_ino
+
+    # like another process that compiled the model at the same time, and stores it after this one
+    utils._save_tracr_model_parts(model_dir, make_parts())
+    assert (model_dir / "state_dict.pt").stat().st_ino == inode
+    assert list(tmp_path.iterdir()) == [model_dir]
+
+
+def test_cache_entry_that_disappears_while_loading_is_a_miss(tmp_path: Path, compile_calls: list[str]):
+    get_tracr_model_input_and_tl_model("reverse", device="cpu", cache_dir=tmp_path)
+    (model_dir,) = tmp_path.iterdir()
+    (model_dir / "state_dict.pt").unlink()  # like another process that is replacing the entry
+
+    assert utils._load_tracr_model_parts(model_dir) is None
+    get_tracr_model_input_and_tl_model("reverse", device="cpu", cache_dir=tmp_path)
+    assert compile_calls == ["reverse", "reverse"]
+
+
+def test_no_cache_without_tracr_version(tmp_path: Path, compile_calls: list[str], monkeypatch: pytest.MonkeyPatch):
+    def package_version(name: str) -> str:
+        raise importlib.metadata.PackageNotFoundError(name)
+
+    monkeypatch.setattr(utils, "_package_version", package_version)
+    get_tracr_model_input_and_tl_model("reverse", device="cpu", cache_dir=tmp_path)
+    get_tracr_model_input_and_tl_model("reverse", device="cpu", cache_dir=tmp_path)
+    assert compile_calls == ["reverse", "reverse"]
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("task", ["reverse", "proportion"])
+def test_compiled_model_survives_the_cache(tmp_path: Path, task: str):
+    pytest.importorskip("tracr.compiler")
+    create_model_input, tl_model = get_tracr_model_input_and_tl_model(task, device="cpu", cache_dir=None)
+    get_tracr_model_input_and_tl_model(task, device="cpu", cache_dir=tmp_path)  # compiles and stores it
+    (model_dir,) = tmp_path.iterdir()
+    # the cached entry is complete, so it is loaded strictly
+    utils._tl_model_from_parts(utils._load_tracr_model_parts(model_dir), device="cpu", strict=True)
+
+    cached_create_model_input, cached_tl_model = get_tracr_model_input_and_tl_model(
+        task, device="cpu", cache_dir=tmp_path
+    )
+    input = ["BOS", 1, 2, 3] if task == "reverse" else ["BOS", "x", "w", "w", "x"]
+    assert torch.equal(cached_create_model_input(input), create_model_input(input))
+    assert torch.equal(cached_tl_model(cached_create_model_input(input)), tl_model(create_model_input(input)))
+
+
+def test_importing_does_not_import_tracr():
+    subprocess.run(
+        [sys.executable, "-c", "import sys, acdc.tracr_task.utils; assert 'tracr' not in sys.modules"], check=True
+    )
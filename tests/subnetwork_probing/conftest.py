@@ -0,0 +1,44 @@
+import pytest
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+
+def make_tiny_transformer(attn_only: bool = False, seed: int = 0) -> HookedTransformer:
+    """A small randomly initialised transformer, so that tests don't need to download any weights."""
+    torch.manual_seed(seed)
+    cfg = HookedTransformerConfig(
+        n_layers=2,
+        d_model=16,
+        n_heads=2,
+        d_head=8,
+        d_mlp=None if attn_only else 32,
+        act_fn=None if attn_only else "relu",
+        attn_only=attn_only,
+        d_vocab=11,
+        n_ctx=6,
+        use_attn_result=True,
+        use_split_qkv_input=True,
+        use_hook_mlp_in=True,
+        device="cpu",
+    )
+    model = HookedTransformer(cfg)
+    with torch.no_grad():
+        # the biases are initialised to zero; make them non-zero so that mistakes in handling them show up
+        for block in model.blocks:
+            block.attn.b_O.normal_()
+    return model
+
+
+@pytest.fixture(params=[False, True], ids=["with_mlp", "attn_only"])
+def tiny_transformer(request) -> HookedTransformer:
+    return make_tiny_transformer(attn_only=request.param)
+
+
+@pytest.fixture
+def tiny_data() -> tuple[torch.Tensor, torch.Tensor]:
+    """Returns (data, patch_data)."""
+    generator = torch.Generator().manual_seed(1)
+    return (
+        torch.randint(0, 11, (4, 6), generator=generator),
+        torch.randint(0, 11, (4, 6), generator=generator),
+    )
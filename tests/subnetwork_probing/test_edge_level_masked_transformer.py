@@ -0,0 +1,231 @@
+import math
+
+import pytest
+import torch
+from transformer_lens import HookedTransformer
+
+from acdc.TLACDCEdge import TorchIndex
+from subnetwork_probing.masked_transformer import EdgeLevelMaskedTransformer
+
+
+@pytest.mark.parametrize("checkpoint_activations", [False, True])
+def test_backward_after_several_forward_passes(
+    tiny_transformer: HookedTransformer, tiny_data: tuple[torch.Tensor, torch.Tensor], checkpoint_activations: bool
+):
+    """Test: the forward buffer (and, with checkpointing, the masks) of one forward pass must not be overwritten by
+    the next one, because the backward pass of the first forward pass may still need it."""
+    data, patch_data = tiny_data
+    masked_model = EdgeLevelMaskedTransformer(tiny_transformer, checkpoint_activations=checkpoint_activations)
+    masked_model.freeze_weights()
+    masked_model.calculate_and_store_ablation_cache(patch_data)
+
+    def mask_gradients() -> list[torch.Tensor]:
+        gradients = [p.grad.clone() for p in masked_model.mask_parameter_list]  # pyright: ignore
+        masked_model.zero_grad()
+        return gradients
+
+    rng_state = torch.random.get_rng_state()
+    with masked_model.with_fwd_hooks() as hooked_model:
+        hooked_model(data).norm().backward()
+        gradients_first = mask_gradients()
+        hooked_model(patch_data).norm().backward()
+        gradients_second = mask_gradients()
+
+    torch.random.set_rng_state(rng_state)
+    with masked_model.with_fwd_hooks() as hooked_model:
+        loss = hooked_model(data).norm() + hooked_model(patch_data).norm()
+    loss.backward()
+    gradients_together = mask_gradients()
+
+    for first, second, together in zip(gradients_first, gradients_second, gradients_together):
+        assert torch.allclose(first + second, together, atol=1e-6)
+
+
+@pytest.mark.parametrize("num_mask_sets", [None, 2])
+def test_checkpointing_gives_the_same_outputs_and_gradients(
+    tiny_transformer: HookedTransformer, tiny_data: tuple[torch.Tensor, torch.Tensor], num_mask_sets: int | None
+):
+    data, patch_data = tiny_data
+    outputs, gradients = [], []
+    for checkpoint_activations in [False, True]:
+        masked_model = EdgeLevelMaskedTransformer(
+            tiny_transformer, num_mask_sets=num_mask_sets, checkpoint_activations=checkpoint_activations
+        )
+        masked_model.freeze_weights()
+        masked_model.calculate_and_store_ablation_cache(patch_data, retain_cache_gradients=False)
+        torch.manual_seed(0)
+        with masked_model.with_fwd_hooks() as hooked_model:
+            output = hooked_model(masked_model.replicate_for_mask_sets(data))
+        output.norm().backward()
+        outputs.append(output.detach())
+        gradients.append(masked_model.flat_mask_parameters.grad)
+
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-6)
+    assert torch.allclose(gradients[0], gradients[1], atol=1e-6)
+
+
+def test_flat_mask_statistics_agree_with_per_hook_point_statistics(tiny_transformer: HookedTransformer):
+    masked_model = EdgeLevelMaskedTransformer(tiny_transformer)
+    with torch.no_grad():
+        masked_model.flat_mask_parameters.normal_(std=3)
+    masks_per_hook_point = {name: masked_model.mask_logits(name) for name in masked_model.mask_parameter_names}
+
+    # the segments of the hook points tile the flat parameter, and the views share its storage
+    assert sum(logits.numel() for logits in masks_per_hook_point.values()) == masked_model.num_params()
+    for name, logits in masks_per_hook_point.items():
+        last_parent = masked_model.hook_point_to_parents[name][-1]
+        assert logits.shape[0] == masked_model._parent_row_offsets[last_parent][1]
+        assert logits.untyped_storage().data_ptr() == masked_model.flat_mask_parameters.untyped_storage().data_ptr()
+
+    center = masked_model.beta * math.log(-masked_model.gamma / masked_model.zeta)
+    expected_regularization_loss = torch.stack(
+        [torch.sigmoid(logits - center).mean() for logits in masks_per_hook_point.values()]
+    ).mean()
+    assert torch.allclose(masked_model.regularization_loss(), expected_regularization_loss)
+
+    rng_state = torch.random.get_rng_state()
+    mask = masked_model.sample_all_masks()
+    torch.random.set_rng_state(rng_state)
+    assert masked_model.num_edges() == (mask > 0.5).sum().item()
+    torch.random.set_rng_state(rng_state)
+    expected_proportion = ((mask == 0) | (mask == 1)).sum().item() / mask.numel()
+    assert masked_model.proportion_of_binary_scores() == pytest.approx(expected_proportion)
+
+
+def test_edge_presence_agrees_with_fixed_point_pruning(tiny_transformer: HookedTransformer):
+    """The single pruning pass must give the same circuit as repeatedly removing the edges into nodes that
+    have no present outgoing edges, until nothing changes."""
+    masked_model = EdgeLevelMaskedTransformer(tiny_transformer)
+    table = masked_model.correspondence_table(use_pos_embed=True)
+    output_node = (f"blocks.{tiny_transformer.cfg.n_layers - 1}.hook_resid_post", TorchIndex((None,)))
+
+    for sparsity in [0.1, 0.5, 0.9]:
+        mask = (torch.rand(masked_model.num_params()) > sparsity).float()
+        present = dict(zip(table.edges, table.default_present.tolist()))
+        for edge_id, mask_value in zip(table.mask_edge_ids.tolist(), mask.tolist()):
+            present[table.edges[edge_id]] = mask_value > 0.5
+        while True:
+            nodes_to_keep = {edge[2:] for edge, is_present in present.items() if is_present} | {output_node}
+            edges_to_remove = [
+                edge for edge, is_present in present.items() if is_present and edge[:2] not in nodes_to_keep
+            ]
+            if not edges_to_remove:
+                break
+            for edge in edges_to_remove:
+                present[edge] = False
+
+        assert masked_model.get_edge_presence_from_masks(mask).tolist() == list(present.values())
+
+
+def test_ablation_cache_is_only_recalculated_when_needed(
+    tiny_transformer: HookedTransformer, tiny_data: tuple[torch.Tensor, torch.Tensor]
+):
+    _, patch_data = tiny_data
+    masked_model = EdgeLevelMaskedTransformer(tiny_transformer)
+    masked_model.freeze_weights()
+
+    def recalculates(patch_data: torch.Tensor | None, retain_cache_gradients: bool = False) -> bool:
+        cache_before = masked_model.ablation_cache
+        masked_model.calculate_and_store_ablation_cache(patch_data, retain_cache_gradients=retain_cache_gradients)
+        return masked_model.ablation_cache is not cache_before
+
+    assert recalculates(patch_data)
+    assert not recalculates(patch_data)
+    with masked_model.with_fwd_hooks() as hooked_model:  # training the masks does not change the ablation cache
+        hooked_model(patch_data).sum().backward()
+    assert not recalculates(patch_data)
+
+    assert recalculates(patch_data.clone())  # we don't compare the contents of the patch data
+    assert recalculates(None)
+    assert not recalculates(None)
+    assert recalculates(patch_data)
+
+    assert recalculates(patch_data, retain_cache_gradients=True)
+    assert recalculates(patch_data)
+    with masked_model.hooks(fwd_hooks=[("hook_embed", lambda tensor, hook: tensor)]):
+        assert recalculates(patch_data)
+    assert recalculates(patch_data)
+
+    masked_model.invalidate_ablation_cache()
+    assert recalculates(patch_data)
+    patch_data[0, 0] = (patch_data[0, 0] + 1) % tiny_transformer.cfg.d_vocab
+    assert recalculates(patch_data)
+    with torch.no_grad():
+        tiny_transformer.blocks[0].attn.W_V.mul_(2)
+    assert recalculates(patch_data)
+    assert not recalculates(patch_data)
+
+
+def test_mask_sets_agree_with_separate_models(
+    tiny_transformer: HookedTransformer, tiny_data: tuple[torch.Tensor, torch.Tensor], monkeypatch
+):
+    """Test: training several mask sets together gives the same outputs and gradients as training them separately."""
+    # make sampling deterministic, so that we can compare the models
+    monkeypatch.setattr(
+        EdgeLevelMaskedTransformer,
+        "_sample_hard_concrete",
+        lambda self, logits, uniform_sample=None: torch.sigmoid(logits),
+    )
+    data, patch_data = tiny_data
+    num_mask_sets = 3
+    masked_model = EdgeLevelMaskedTransformer(tiny_transformer, num_mask_sets=num_mask_sets)
+    masked_model.freeze_weights()
+    with torch.no_grad():
+        masked_model.flat_mask_parameters.normal_()
+    lambda_reg = torch.tensor([0.1, 1.0, 10.0])
+
+    masked_model.calculate_and_store_ablation_cache(patch_data, retain_cache_gradients=False)
+    with masked_model.with_fwd_hooks() as hooked_model:
+        outputs = hooked_model(masked_model.replicate_for_mask_sets(data)).chunk(num_mask_sets)
+    loss = torch.stack([output.norm() for output in outputs]) + lambda_reg * masked_model.regularization_loss()
+    loss.sum().backward()
+
+    for mask_set in range(num_mask_sets):
+        single_model = EdgeLevelMaskedTransformer(tiny_transformer)
+        with torch.no_grad():
+            single_model.flat_mask_parameters.copy_(masked_model.flat_mask_parameters[mask_set])
+        single_model.calculate_and_store_ablation_cache(patch_data, retain_cache_gradients=False)
+        with single_model.with_fwd_hooks() as hooked_model:
+            output = hooked_model(data)
+        (output.norm() + lambda_reg[mask_set] * single_model.regularization_loss()).backward()
+
+        assert torch.allclose(outputs[mask_set], output, atol=1e-5)
+        assert torch.allclose(
+            masked_model.flat_mask_parameters.grad[mask_set], single_model.flat_mask_parameters.grad, atol=1e-5
+        )
+        assert masked_model.num_edges(mask_set) == single_model.num_edges()
+
+
+@pytest.mark.parametrize("num_mask_sets", [None, 2])
+def test_evaluate_mask_samples_agrees_with_separate_forward_passes(
+    tiny_transformer: HookedTransformer,
+    tiny_data: tuple[torch.Tensor, torch.Tensor],
+    monkeypatch,
+    num_mask_sets: int | None,
+):
+    # make sampling deterministic, so that every sample should give the same values as a normal forward pass
+    monkeypatch.setattr(
+        EdgeLevelMaskedTransformer,
+        "_sample_hard_concrete",
+        lambda self, logits, uniform_sample=None: torch.sigmoid(logits),
+    )
+    data, patch_data = tiny_data
+    masked_model = EdgeLevelMaskedTransformer(tiny_transformer, num_mask_sets=num_mask_sets)
+    with torch.no_grad():
+        masked_model.flat_mask_parameters.normal_()
+    metrics = {"norm": lambda logits: logits.norm(), "mean": lambda logits: logits.mean()}
+
+    evaluations = masked_model.evaluate_mask_samples(
+        metrics, data, patch_data, num_samples=3, max_samples_per_forward=2
+    )
+
+    with torch.no_grad(), masked_model.with_fwd_hooks_and_new_ablation_cache(patch_data) as hooked_model:
+        logits = hooked_model(masked_model.replicate_for_mask_sets(data)).chunk(num_mask_sets or 1)
+    for name, metric in metrics.items():
+        expected = torch.stack([metric(mask_set_logits) for mask_set_logits in logits]).reshape(
+            () if num_mask_sets is None else (num_mask_sets,)
+        )
+        assert evaluations[name].values.shape == (3, *expected.shape)
+        assert torch.allclose(evaluations[name].values, expected, atol=1e-5)
+        assert torch.allclose(evaluations[name].mean, expected, atol=1e-5)
+        assert torch.allclose(evaluations[name].variance, torch.zeros_like(expected), atol=1e-8)
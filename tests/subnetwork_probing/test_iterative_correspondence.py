@@ -0,0 +1,50 @@
+from transformer_lens import HookedTransformer
+
+from acdc.TLACDCInterpNode import TLACDCInterpNode
+from subnetwork_probing.train import CorrespondenceSnapshots, iterative_correspondence_from_mask
+
+
+def removed_nodes(nodes_to_mask: list[TLACDCInterpNode]) -> set[tuple[str, object]]:
+    """The (name, index) of every node whose edges `iterative_correspondence_from_mask` removes, computed
+    from scratch for all the nodes at once."""
+    removed = set()
+    for node in nodes_to_mask:
+        removed.add((node.name, node.index))
+        removed.add((node.name.replace(".attn.", ".") + "_input", node.index))
+        if node.name.endswith(("_q", "_k", "_v")):
+            child_name = node.name[: -len("_q")] + "_result"
+            removed.add((child_name + "_input", node.index))
+            siblings = {n.name for n in nodes_to_mask if n.index == node.index}
+            if all(child_name.replace("_result", suffix) in siblings for suffix in ["_q", "_k", "_v"]):
+                removed.add((child_name, node.index))
+        if node.name.endswith(("mlp_in", "resid_mid")):
+            removed.add((node.name.replace("resid_mid", "mlp_out").replace("mlp_in", "mlp_out"), node.index))
+    return removed
+
+
+def test_pruning_step_by_step_matches_pruning_at_once(tiny_transformer: HookedTransformer):
+    corr, head_parents = iterative_correspondence_from_mask(tiny_transformer, [])
+    nodes = [node for node in corr.nodes_list() if node.name.endswith(("_q", "_k", "_v", "mlp_in"))]
+    assert nodes
+    steps = [nodes[i : i + 2] for i in range(0, len(nodes), 2)]
+
+    snapshots = CorrespondenceSnapshots(corr)
+    recorded = [snapshots.record()]
+    for step in steps:
+        corr, head_parents = iterative_correspondence_from_mask(
+            tiny_transformer, step, corr=corr, head_parents=head_parents
+        )
+        recorded.append(snapshots.record())
+
+    # look at the snapshots in a different order than they were recorded in
+    for num_steps in reversed(range(len(recorded))):
+        masked = [node for step in steps[:num_steps] for node in step]
+        removed = removed_nodes(masked)
+        for (child_name, child_index, parent_name, parent_index), edge in (
+            recorded[num_steps].correspondence().edge_dict().items()
+        ):
+            expected = (child_name, child_index) not in removed and (parent_name, parent_index) not in removed
+            assert edge.present == expected, (num_steps, child_name, child_index, parent_name, parent_index)
+        assert sum(len(snapshots.removed_edge_ids(step)) for step in range(num_steps + 1)) == sum(
+            not present for present in snapshots.present(num_steps)
+        )
@@ -387,8 +387,8 @@ def test_create_mask_parameters_and_forward_cache_hook_points(circuit_start_type
 
     ordered_forward_cache_hook_points = outputs[0]
     hook_point_to_parents = outputs[1]
-    # mask_parameter_list = outputs[2]
-    # mask_parameter_dict = outputs[3]
+    # mask_logits = outputs[2]
+    # mask_logits_segments = outputs[3]
 
     for parent_list in hook_point_to_parents.values():
         for parent in parent_list:
@@ -0,0 +1,195 @@
+import random
+
+import torch
+from transformer_lens import HookedTransformer
+
+from acdc.nudb.adv_opt.masked_runner import MaskedRunner, convex_combination, sparse_support
+from subnetwork_probing.masked_transformer import CircuitStartingPointType
+
+
+def test_run_many_agrees_with_run(tiny_transformer: HookedTransformer, tiny_data: tuple[torch.Tensor, torch.Tensor]):
+    """Test: running several circuits in one batched forward pass gives the same result as running them one by one."""
+    data, patch_data = tiny_data
+    masked_runner = MaskedRunner(tiny_transformer, starting_point_type=CircuitStartingPointType.POS_EMBED)
+    all_edges = sorted(masked_runner.all_ablatable_edges, key=str)
+
+    random.seed(0)
+    edges_to_ablate_per_circuit = [[], all_edges, random.sample(all_edges, k=len(all_edges) // 2)]
+
+    outputs = masked_runner.run_many(data, patch_data, edges_to_ablate_per_circuit)
+    outputs_in_small_batches = masked_runner.run_many(
+        data, patch_data, edges_to_ablate_per_circuit, max_batch_size=len(data)
+    )
+
+    assert outputs.shape == (len(edges_to_ablate_per_circuit), *data.shape, tiny_transformer.cfg.d_vocab)
+    for circuit_index, edges_to_ablate in enumerate(edges_to_ablate_per_circuit):
+        expected = masked_runner.run(data, patch_data, edges_to_ablate=edges_to_ablate)
+        assert torch.allclose(outputs[circuit_index], expected, atol=1e-5)
+        assert torch.allclose(outputs_in_small_batches[circuit_index], expected, atol=1e-5)
+
+    assert torch.allclose(outputs[0], tiny_transformer(data), atol=1e-4)
+    assert torch.allclose(outputs[1], tiny_transformer(patch_data), atol=1e-4)
+
+
+def test_compiled_edges_are_cached_and_masks_are_reset(
+    tiny_transformer: HookedTransformer, tiny_data: tuple[torch.Tensor, torch.Tensor]
+):
+    """Test: ablating a set of edges compiles it once, gives the same output as the edges one by one, and leaves all
+    the masks at +inf afterwards."""
+    data, patch_data = tiny_data
+    masked_runner = MaskedRunner(tiny_transformer, starting_point_type=CircuitStartingPointType.POS_EMBED)
+    all_edges = sorted(masked_runner.all_ablatable_edges, key=str)
+    random.seed(0)
+    edges_to_ablate = frozenset(random.sample(all_edges, k=len(all_edges) // 2))
+
+    indices = masked_runner.compile_edges(edges_to_ablate)
+    assert masked_runner.compile_edges(list(edges_to_ablate)) is indices
+    assert sorted(indices.tolist()) == sorted(masked_runner._flat_mask_index(edge) for edge in edges_to_ablate)
+
+    output = masked_runner.run(data, patch_data, edges_to_ablate=edges_to_ablate)
+    assert (masked_runner.masked_transformer.flat_mask_parameters == float("inf")).all()
+    expected = masked_runner.run_many(data, patch_data, [sorted(edges_to_ablate, key=str)])[0]
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_ablation_caches_are_reused_for_the_same_patch_input(
+    tiny_transformer: HookedTransformer, tiny_data: tuple[torch.Tensor, torch.Tensor]
+):
+    """Test: the ablation cache is reused for a patch input with the same contents (also if it's a different tensor),
+    but not after the weights have changed, and it gives the same output as a newly calculated ablation cache."""
+    data, patch_data = tiny_data
+    masked_runner = MaskedRunner(tiny_transformer, starting_point_type=CircuitStartingPointType.POS_EMBED)
+    edges_to_ablate = masked_runner.all_ablatable_edges
+
+    expected = masked_runner.run(data, patch_data, edges_to_ablate=edges_to_ablate)
+    masked_runner.run(data, data, edges_to_ablate=edges_to_ablate)
+    output = masked_runner.run(data, patch_data.clone(), edges_to_ablate=edges_to_ablate)
+    assert (masked_runner.ablation_cache_hits, masked_runner.ablation_cache_misses) == (1, 2)
+    assert torch.allclose(output, expected)
+
+    with torch.no_grad():
+        tiny_transformer.unembed.W_U.mul_(2)
+    masked_runner.run(data, patch_data.clone(), edges_to_ablate=edges_to_ablate)
+    assert (masked_runner.ablation_cache_hits, masked_runner.ablation_cache_misses) == (1, 3)
+
+    masked_runner.clear_ablation_caches()
+    masked_runner.ablation_cache_max_bytes = 0
+    masked_runner.run(data, patch_data, edges_to_ablate=edges_to_ablate)
+    masked_runner.run(data, patch_data.clone(), edges_to_ablate=edges_to_ablate)
+    assert (masked_runner.ablation_cache_hits, masked_runner.ablation_cache_misses) == (0, 2)
+
+
+def test_circuit_and_full_model_in_one_forward_pass(
+    tiny_transformer: HookedTransformer, tiny_data: tuple[torch.Tensor, torch.Tensor]
+):
+    """Test: running the circuit and the full model together on convex combinations of inputs gives the same outputs
+    and gradients as running them one by one."""
+    data, patch_data = tiny_data
+    masked_runner = MaskedRunner(tiny_transformer, starting_point_type=CircuitStartingPointType.POS_EMBED)
+    random.seed(0)
+    edges_to_ablate = random.sample(sorted(masked_runner.all_ablatable_edges, key=str), k=10)
+    input_embedded, patch_input_embedded = tiny_transformer.embed(data), tiny_transformer.embed(patch_data)
+
+    outputs, gradients = [], []
+    for combined in [False, True]:
+        coefficients = torch.linspace(0, 1, len(data), requires_grad=True)
+        coefficients_patch = torch.linspace(1, 0, len(data), requires_grad=True)
+        kwargs = dict(
+            input_embedded=input_embedded,
+            patch_input_embedded=patch_input_embedded,
+            dummy_input=data[0],
+            coefficients=coefficients,
+            coefficients_patch=coefficients_patch,
+            retain_patch_gradient=True,
+        )
+        if combined:
+            circuit_output, full_output = (
+                masked_runner.run_circuit_and_full_model_with_linear_combination_of_input_and_patch(
+                    edges_to_ablate=edges_to_ablate, **kwargs
+                )
+            )
+        else:
+            circuit_output = masked_runner.run_with_linear_combination_of_input_and_patch(
+                edges_to_ablate=edges_to_ablate, **kwargs
+            )
+            full_output = masked_runner.run_with_linear_combination_of_input_and_patch(edges_to_ablate=[], **kwargs)
+        (circuit_output - full_output).pow(2).sum().backward(retain_graph=True)
+        outputs.append((circuit_output, full_output))
+        gradients.append((coefficients.grad, coefficients_patch.grad))
+
+    for separate, combined in zip(outputs[0] + gradients[0], outputs[1] + gradients[1]):
+        assert torch.allclose(separate, combined, atol=1e-5)
+    assert not torch.allclose(outputs[0][0], outputs[0][1])
+    assert gradients[1][1].abs().sum() > 0
+
+
+def test_restarts_in_one_forward_pass(
+    tiny_transformer: HookedTransformer, tiny_data: tuple[torch.Tensor, torch.Tensor]
+):
+    """Test: running several restarts (rows of coefficients) at once gives the same outputs and gradients as
+    running each restart by itself."""
+    data, patch_data = tiny_data
+    masked_runner = MaskedRunner(tiny_transformer, starting_point_type=CircuitStartingPointType.POS_EMBED)
+    random.seed(0)
+    edges_to_ablate = random.sample(sorted(masked_runner.all_ablatable_edges, key=str), k=10)
+    input_embedded, patch_input_embedded = tiny_transformer.embed(data), tiny_transformer.embed(patch_data)
+    generator = torch.Generator().manual_seed(0)
+    coefficients = torch.randn(3, len(data), generator=generator, requires_grad=True)
+    coefficients_patch = torch.randn(3, len(data), generator=generator, requires_grad=True)
+
+    def run(coefficients: torch.Tensor, coefficients_patch: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        return masked_runner.run_circuit_and_full_model_with_linear_combination_of_input_and_patch(
+            input_embedded=input_embedded,
+            patch_input_embedded=patch_input_embedded,
+            dummy_input=data[0],
+            coefficients=coefficients,
+            coefficients_patch=coefficients_patch,
+            edges_to_ablate=edges_to_ablate,
+            retain_patch_gradient=True,
+        )
+
+    circuit_output, full_output = run(coefficients, coefficients_patch)
+    assert circuit_output.shape[0] == full_output.shape[0] == 3
+    (circuit_output - full_output).pow(2).sum().backward()
+    gradients = (coefficients.grad, coefficients_patch.grad)
+
+    for restart in range(3):
+        coefficients.grad, coefficients_patch.grad = None, None
+        separate_circuit_output, separate_full_output = run(coefficients[restart], coefficients_patch[restart])
+        (separate_circuit_output - separate_full_output).pow(2).sum().backward()
+        assert torch.allclose(separate_circuit_output, circuit_output[restart : restart + 1], atol=1e-5)
+        assert torch.allclose(separate_full_output, full_output[restart : restart + 1], atol=1e-5)
+        assert torch.allclose(coefficients.grad[restart], gradients[0][restart], atol=1e-5)
+        assert torch.allclose(coefficients_patch.grad[restart], gradients[1][restart], atol=1e-5)
+    assert not torch.allclose(circuit_output[0], circuit_output[1])
+
+
+def test_sparse_support():
+    coefficients = torch.tensor([[0.0, 5.0, 1.0, 4.9, -3.0], [8.0, 0.0, 0.0, 0.0, 0.0]])
+    # restart 0 has three coefficients with a weight above 0.005, so both restarts get three indices
+    support = sparse_support(coefficients, k=1, epsilon=0.005)
+    assert support.shape == (2, 3)
+    assert set(support[0].tolist()) == {1, 2, 3}
+    assert support[1, 0] == 0
+    assert sparse_support(coefficients, k=2).shape == (2, 2)
+    assert sparse_support(coefficients, k=10).shape == (2, 5)
+
+
+def test_sparse_convex_combination(tiny_transformer: HookedTransformer, tiny_data: tuple[torch.Tensor, torch.Tensor]):
+    """Test: the convex combination on a support equals the one on all examples if the other coefficients are very
+    small, and only the coefficients on the support get a gradient."""
+    data, _ = tiny_data
+    embedded = tiny_transformer.embed(data)
+    coefficients = torch.full((2, len(data)), -1e4)
+    coefficients[0, [0, 2]] = torch.tensor([1.0, 2.0])
+    coefficients[1, [1, 2]] = torch.tensor([0.5, 0.0])
+    coefficients.requires_grad_(True)
+
+    support = sparse_support(coefficients, k=2)
+    sparse = convex_combination(coefficients, embedded, support)
+    assert torch.allclose(sparse, convex_combination(coefficients, embedded), atol=1e-5)
+
+    sparse.pow(2).sum().backward()
+    has_gradient = coefficients.grad != 0
+    assert has_gradient.sum(dim=-1).tolist() == [2, 2]
+    assert has_gradient[0, [0, 2]].all() and has_gradient[1, [1, 2]].all()
@@ -0,0 +1,69 @@
+from functools import partial
+
+import pytest
+import torch
+import torch.nn.functional as F
+from transformer_lens import HookedTransformer
+
+from acdc.acdc_utils import kl_divergence
+from subnetwork_probing.masked_transformer import EdgeLevelMaskedTransformer
+from subnetwork_probing.train_edge_sp import EarlyStopping, micro_batched_metric
+
+
+@pytest.mark.parametrize("num_mask_sets", [None, 2])
+@pytest.mark.parametrize("micro_batch_size", [1, 3])
+def test_micro_batches_agree_with_a_single_batch(
+    tiny_transformer: HookedTransformer,
+    tiny_data: tuple[torch.Tensor, torch.Tensor],
+    num_mask_sets: int | None,
+    micro_batch_size: int,
+):
+    """Test: the metric and its gradient are the same with and without micro-batches, also if the number of
+    values that the metric averages over differs between the micro-batches."""
+    data, patch_data = tiny_data
+    with torch.no_grad():
+        base_model_logprobs = F.log_softmax(tiny_transformer(data), dim=-1)
+    mask_repeat_candidates = torch.rand(data.shape, generator=torch.Generator().manual_seed(2)) < 0.5
+    metric = partial(
+        kl_divergence,
+        base_model_logprobs=base_model_logprobs,
+        mask_repeat_candidates=mask_repeat_candidates,
+        last_seq_element_only=False,
+    )
+    masked_model = EdgeLevelMaskedTransformer(tiny_transformer, num_mask_sets=num_mask_sets)
+    masked_model.freeze_weights()
+    with torch.no_grad():
+        masked_model.flat_mask_parameters.normal_()
+
+    values, grads = [], []
+    for batch_size in [None, micro_batch_size]:
+        masked_model.flat_mask_parameters.grad = None
+        torch.manual_seed(0)  # the same masks, because with_fixed_mask_noise samples all of them at once
+        with masked_model.with_fixed_mask_noise():
+            values.append(micro_batched_metric(masked_model, metric, data, patch_data, batch_size, backward=True))
+        grads.append(masked_model.flat_mask_parameters.grad)
+
+    assert values[0].shape == (() if num_mask_sets is None else (num_mask_sets,))
+    assert torch.allclose(values[0], values[1], atol=1e-5)
+    assert torch.allclose(grads[0], grads[1], atol=1e-5)
+
+
+def test_early_stopping_waits_until_every_mask_set_has_converged():
+    early_stopping = EarlyStopping(window=4, min_binary_fraction=0.9, edge_count_tolerance=0.1, loss_tolerance=0.01)
+
+    def update(binary_fraction: list[float], num_edges: list[int], loss: list[float]) -> bool:
+        return early_stopping.update(torch.tensor(binary_fraction), torch.tensor(num_edges), torch.tensor(loss))
+
+    # the second mask set is not binary enough yet
+    assert not any(update([1.0, 0.8], [100, 50], [1.0, 2.0]) for _ in range(4))
+    assert not update([1.0, 1.0], [100, 50], [1.0, 2.0])
+    assert not update([1.0, 1.0], [100, 50], [1.0, 2.0])
+    assert not update([1.0, 1.0], [100, 50], [1.0, 2.0])
+    # now the window only contains binary masks, with a stable number of edges and loss
+    assert update([1.0, 1.0], [100, 50], [1.0, 2.0])
+
+    # the number of edges changes too much
+    assert not update([1.0, 1.0], [100, 40], [1.0, 2.0])
+    early_stopping.history.clear()
+    # the loss is still going down
+    assert not any(update([1.0], [100], [loss]) for loss in [4.0, 3.0, 2.0, 1.0])